@@ -5,6 +5,7 @@ import llm                  # LLMモジュール
 import database             # データベースモジュール
 import metrics              # 評価指標モジュール
 import data                 # データモジュール
+import metrics_worker       # 評価指標のバックグラウンド計算
 import torch
 from transformers import pipeline
 from config import MODEL_NAME
@@ -20,6 +21,9 @@ metrics.initialize_nltk()
 # データベースの初期化（テーブルが存在しない場合、作成）
 database.init_db()
 
+# 評価指標を計算するワーカーを起動（前回の実行で未計算の行も計算する）
+metrics_worker.get_metrics_worker()
+
 # データベースが空ならサンプルデータを投入
 data.ensure_initial_data()
 
@@ -0,0 +1,126 @@
+# benchmark_database.py
+# チャット履歴のデータベース操作について、呼び出しごとに接続する以前の方法と、接続のプール（WALモード）の速度を比較します
+#   before: 呼び出しごとに sqlite3.connect し、既定のジャーナル（DELETE）と synchronous=FULL で1行ずつコミットする
+#   after:  database.py の ConnectionPool（WAL、synchronous=NORMAL、ページキャッシュ、mmap、コンパイル済みのSQL文の再利用）
+# 複数のスレッド（Streamlitのセッション）から同時に書き込み・読み取りを行う場合のスループットも測ります。
+# 使い方:
+#   python benchmark_database.py
+#   python benchmark_database.py --inserts 2000 --reads 2000 --threads 8 --output db_benchmark.json
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import database
+
+
+@contextmanager
+def legacy_connection(db_file):
+    """以前の方法: 呼び出しごとに接続して閉じる"""
+    conn = sqlite3.connect(db_file)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def insert_row(get_connection, i):
+    with get_connection() as conn:
+        conn.execute(database.INSERT_SQL, ("2025-01-01 00:00:00", f"質問{i}", f"回答{i}", "正確", "", 1.0,
+                                           1.0, 0.1, database.METRICS_DONE))
+
+
+def count_rows(get_connection):
+    with get_connection() as conn:
+        return conn.execute(database.COUNT_SQL).fetchone()[0]
+
+
+def read_recent(get_connection):
+    # 履歴ページと同じ並び順で、先頭の数件を読む
+    with get_connection() as conn:
+        return conn.execute(database.HISTORY_SQL + " LIMIT 20").fetchall()
+
+
+def run_mixed(get_connection, threads, operations):
+    """threads 個のスレッドで、書き込み1回に対して読み取り4回の割合で operations 回ずつ実行する"""
+    def worker(thread_index):
+        for i in range(operations):
+            if i % 5 == 0:
+                insert_row(get_connection, thread_index * operations + i)
+            elif i % 5 in (1, 2):
+                count_rows(get_connection)
+            else:
+                read_recent(get_connection)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * operations / (time.perf_counter() - start)
+
+
+def throughput(fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return n / (time.perf_counter() - start)
+
+
+def benchmark(name, db_file, get_connection, args):
+    with get_connection() as conn:
+        conn.execute(database.SCHEMA)
+    result = {
+        "mode": name,
+        "inserts_per_s": throughput(lambda i: insert_row(get_connection, i), args.inserts),
+        "count_reads_per_s": throughput(lambda i: count_rows(get_connection), args.reads),
+        "history_reads_per_s": throughput(lambda i: read_recent(get_connection), args.reads),
+        "mixed_ops_per_s": run_mixed(get_connection, args.threads, args.mixed_operations),
+    }
+    with get_connection() as conn:
+        result["journal_mode"] = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="データベース操作の接続方法ごとのスループットを比較します")
+    parser.add_argument("--inserts", type=int, default=1000, help="1行ずつコミットする書き込みの回数")
+    parser.add_argument("--reads", type=int, default=2000, help="読み取りの回数")
+    parser.add_argument("--threads", type=int, default=4, help="同時に操作するスレッド数")
+    parser.add_argument("--mixed-operations", type=int, default=250, help="スレッドごとの操作の回数")
+    parser.add_argument("--dir", default=None, help="データベースファイルを作成するディレクトリ（未指定なら一時ディレクトリ）")
+    parser.add_argument("--output", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        before_file = os.path.join(tmp, "before.db")
+        after_file = os.path.join(tmp, "after.db")
+        before = benchmark("before", before_file, lambda: legacy_connection(before_file), args)
+        pool = database.ConnectionPool(after_file)
+        try:
+            after = benchmark("after", after_file, pool.connection, args)
+        finally:
+            pool.close()
+
+    results = [before, after]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print("\n| 操作 | before (/s) | after (/s) | 速度比 |")
+    print("|---|---|---|---|")
+    for key, label in [("inserts_per_s", "書き込み（1行ずつコミット）"), ("count_reads_per_s", "件数の取得"),
+                       ("history_reads_per_s", "履歴の読み取り"),
+                       ("mixed_ops_per_s", f"{args.threads}スレッドで書き込み・読み取り")]:
+        print(f"| {label} | {before[key]:.0f} | {after[key]:.0f} | {after[key] / before[key]:.1f}x |")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
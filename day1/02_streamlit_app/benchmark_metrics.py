@@ -0,0 +1,138 @@
+# benchmark_metrics.py
+# 評価指標の計算について、1組あたりのコストを以前の実装・1件ずつの MetricsScorer・まとめて計算する MetricsScorer で比較します
+#   legacy: 呼び出しごとに Janome の Tokenizer と TfidfVectorizer を作成する（以前の calculate_metrics）
+#   single: 共有の MetricsScorer で1組ずつ score を呼ぶ
+#   batch:  共有の MetricsScorer の score_batch で全件をまとめて計算する
+# 使い方:
+#   python benchmark_metrics.py                          # サンプルデータから数千件の履歴を作って比較
+#   python benchmark_metrics.py --rows 5000 --db chat_feedback.db   # 既存の履歴データベースの行を使う
+import argparse
+import json
+import random
+import re
+import sqlite3
+import time
+
+from janome.tokenizer import Tokenizer
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+from metrics import MetricsScorer, nltk_sentence_bleu, nltk_word_tokenize
+
+
+def legacy_calculate_metrics(answer, correct_answer):
+    """以前の calculate_metrics（呼び出しごとにトークナイザーとベクトライザーを作成する）"""
+    bleu_score = similarity_score = relevance_score = 0.0
+    if not answer:
+        return bleu_score, similarity_score, 0, relevance_score
+    word_count = len(list(Tokenizer().tokenize(answer)))
+    if correct_answer:
+        answer_lower = answer.lower()
+        correct_answer_lower = correct_answer.lower()
+        try:
+            candidate = nltk_word_tokenize(answer_lower)
+            if candidate:
+                bleu_score = nltk_sentence_bleu([nltk_word_tokenize(correct_answer_lower)], candidate,
+                                                weights=(0.25, 0.25, 0.25, 0.25))
+        except Exception:
+            bleu_score = 0.0
+        try:
+            if answer_lower.strip() and correct_answer_lower.strip():
+                tfidf_matrix = TfidfVectorizer().fit_transform([answer_lower, correct_answer_lower])
+                similarity_score = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
+        except Exception:
+            similarity_score = 0.0
+        answer_words = set(re.findall(r'\w+', answer_lower))
+        correct_words = set(re.findall(r'\w+', correct_answer_lower))
+        if correct_words:
+            relevance_score = len(answer_words & correct_words) / len(correct_words)
+    return bleu_score, similarity_score, word_count, relevance_score
+
+
+def load_pairs(args):
+    """(回答, 正解) の組を args.rows 件作成する"""
+    if args.db:
+        conn = sqlite3.connect(args.db)
+        try:
+            rows = conn.execute("SELECT answer, correct_answer FROM chat_history").fetchall()
+        finally:
+            conn.close()
+    else:
+        from data import SAMPLE_QUESTIONS_DATA
+        rows = [(item["answer"], item["correct_answer"]) for item in SAMPLE_QUESTIONS_DATA]
+    if not rows:
+        raise SystemExit("履歴の行がありません")
+    # 同じ文の組ばかりにならないよう、文を入れ替えたり正解を空にしたりした組も混ぜる
+    rng = random.Random(args.seed)
+    answers = [answer for answer, _ in rows]
+    pairs = []
+    while len(pairs) < args.rows:
+        answer, correct_answer = rng.choice(rows)
+        kind = rng.random()
+        if kind < 0.2:
+            answer = rng.choice(answers)
+        elif kind < 0.3:
+            correct_answer = ""
+        pairs.append((answer, correct_answer))
+    return pairs
+
+
+def time_per_pair(fn, pairs):
+    start = time.perf_counter()
+    results = fn(pairs)
+    return (time.perf_counter() - start) / len(pairs), results
+
+
+def max_difference(expected, actual):
+    """2つの結果の各指標の差の最大値"""
+    return max((abs(float(e) - float(a)) for exp, act in zip(expected, actual) for e, a in zip(exp, act)),
+               default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="評価指標の計算の1組あたりのコストを比較します")
+    parser.add_argument("--rows", type=int, default=3000, help="計算する (回答, 正解) の組の数")
+    parser.add_argument("--legacy-rows", type=int, default=300, help="以前の実装で計算する組の数（遅いため一部だけ）")
+    parser.add_argument("--db", default=None, help="組を読み込む履歴のデータベース（未指定ならサンプルデータ）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    pairs = load_pairs(args)
+    legacy_pairs = pairs[:args.legacy_rows]
+
+    start = time.perf_counter()
+    scorer = MetricsScorer()
+    init_s = time.perf_counter() - start
+    scorer.score_batch(pairs[:10])  # ウォームアップ
+
+    legacy_s, legacy_results = time_per_pair(lambda p: [legacy_calculate_metrics(a, c) for a, c in p], legacy_pairs)
+    single_s, single_results = time_per_pair(lambda p: [scorer.score(a, c) for a, c in p], pairs)
+    batch_s, batch_results = time_per_pair(scorer.score_batch, pairs)
+
+    result = {
+        "rows": len(pairs),
+        "legacy_rows": len(legacy_pairs),
+        "scorer_init_ms": init_s * 1000,
+        "legacy_ms_per_pair": legacy_s * 1000,
+        "single_ms_per_pair": single_s * 1000,
+        "batch_ms_per_pair": batch_s * 1000,
+        "single_speedup": legacy_s / single_s,
+        "batch_speedup": legacy_s / batch_s,
+        "max_diff_legacy_vs_batch": max_difference(legacy_results, batch_results[:len(legacy_pairs)]),
+        "max_diff_single_vs_batch": max_difference(single_results, batch_results),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    print("\n| 方法 | 1組あたり (ms) | 速度比 |")
+    print("|---|---|---|")
+    print(f"| legacy（{len(legacy_pairs)}組） | {result['legacy_ms_per_pair']:.3f} | 1.0x |")
+    print(f"| single（{len(pairs)}組） | {result['single_ms_per_pair']:.3f} | {result['single_speedup']:.1f}x |")
+    print(f"| batch（{len(pairs)}組） | {result['batch_ms_per_pair']:.3f} | {result['batch_speedup']:.1f}x |")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": result}, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,17 @@
 # config.py
 DB_FILE = "chat_feedback.db"
-MODEL_NAME = "google/gemma-2-2b-jpn-it"
\ No newline at end of file
+MODEL_NAME = "google/gemma-2-2b-jpn-it"
+# 接頭辞KVキャッシュの設定（同じシステムプロンプトやチャットテンプレートのプリフィルを省略する）
+PREFIX_CACHE_ENABLED = True
+PREFIX_CACHE_MAX_BYTES = 512 * 1024 ** 2
+PREFIX_CACHE_BLOCK_SIZE = 16
+# GPUがない場合の推論プロファイル: "default"（float32）, "int8"（動的量子化）, "onnx"（ONNX Runtime）
+CPU_PROFILE = "default"
+CPU_NUM_THREADS = None  # torchのスレッド数（Noneなら利用できるコア数から決める）
+ONNX_EXPORT_DIR = None  # onnx プロファイルで書き出したモデルの保存先（次回の起動で再利用する）
+# SQLiteの接続の設定（接続はプールして使い回し、WALモードで読み取りと書き込みを並行させる）
+DB_POOL_SIZE = 4               # 同時に使う接続の最大数（Streamlitのセッションごとのスレッドで共有する）
+DB_BUSY_TIMEOUT_SECONDS = 30   # 他の接続が書き込み中のときに待つ最大の秒数
+DB_CACHE_SIZE_KB = 16 * 1024   # 接続ごとのページキャッシュ（KB）
+DB_MMAP_SIZE = 256 * 1024 ** 2 # メモリマップで読み込む最大のバイト数
+DB_STATEMENT_CACHE_SIZE = 128  # 接続ごとに保持するコンパイル済みのSQL文の数
@@ -1,7 +1,7 @@
 # data.py
 import streamlit as st
 from datetime import datetime
-from database import save_to_db, get_db_count # DB操作関数をインポート
+from database import bulk_save_to_db, get_db_count # DB操作関数をインポート
 
 # サンプルデータのリスト
 SAMPLE_QUESTIONS_DATA = [
@@ -92,21 +92,8 @@ SAMPLE_QUESTIONS_DATA = [
 def create_sample_evaluation_data():
     """定義されたサンプルデータをデータベースに保存する"""
     try:
-        count_before = get_db_count()
-        added_count = 0
-        # 各サンプルをデータベースに保存
-        for item in SAMPLE_QUESTIONS_DATA:
-            # save_to_dbが必要な引数のみ渡す
-            save_to_db(
-                question=item["question"],
-                answer=item["answer"],
-                feedback=item["feedback"],
-                correct_answer=item["correct_answer"],
-                is_correct=item["is_correct"],
-                response_time=item["response_time"]
-            )
-            added_count += 1
-
+        # 評価指標をまとめて計算し、全件を1つのトランザクションで保存する
+        added_count = bulk_save_to_db(SAMPLE_QUESTIONS_DATA)
         count_after = get_db_count()
         st.success(f"{added_count} 件のサンプル評価データが正常に追加されました。(合計: {count_after} 件)")
 
@@ -1,10 +1,13 @@
 # database.py
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 import pandas as pd
 from datetime import datetime
 import streamlit as st
-from config import DB_FILE
-from metrics import calculate_metrics # metricsを計算するために必要
+from config import DB_FILE, DB_POOL_SIZE, DB_BUSY_TIMEOUT_SECONDS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE
+from config import DB_STATEMENT_CACHE_SIZE
 
 # --- スキーマ定義 ---
 TABLE_NAME = "chat_history"
@@ -17,62 +20,260 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME}
  feedback TEXT,
  correct_answer TEXT,
  is_correct REAL,      -- INTEGERからREALに変更 (0.5を許容するため)
- response_time REAL,
+ response_time REAL,   -- 質問の送信から回答の生成が終わるまでの合計時間
+ ttft REAL,            -- 最初のテキストが表示されるまでの時間（Time To First Token）
  bleu_score REAL,
  similarity_score REAL,
  word_count INTEGER,
- relevance_score REAL)
+ relevance_score REAL,
+ metrics_status TEXT DEFAULT 'done')  -- 評価指標の計算状態（pending / done / error）
 '''
 
+# 評価指標の計算状態（保存時は pending にし、バックグラウンドで計算して done にする）
+METRICS_PENDING = "pending"
+METRICS_DONE = "done"
+METRICS_ERROR = "error"
+
+# 既存のデータベースに後から追加した列（列名, 型）
+# 既存の行は評価指標を保存時に計算済みのため、metrics_status は done になる
+ADDED_COLUMNS = [("ttft", "REAL"), ("metrics_status", "TEXT DEFAULT 'done'")]
+
+# 接続ごとに設定するPRAGMA
+# WALモードでは書き込み中も読み取りが待たされず、synchronous=NORMAL でもWALでは破損しない（電源断で直近のコミットが失われることはある）
+PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -DB_CACHE_SIZE_KB),  # 負の値はKB単位
+    ("mmap_size", DB_MMAP_SIZE),
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", int(DB_BUSY_TIMEOUT_SECONDS * 1000)),
+]
+
+# 何度も実行するSQL文（同じ文字列を使うことで、接続ごとのコンパイル済みの文のキャッシュが再利用される）
+INSERT_SQL = f'''
+INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
+                         response_time, ttft, metrics_status)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+BULK_INSERT_SQL = f'''
+INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
+                         response_time, ttft, bleu_score, similarity_score, word_count, relevance_score,
+                         metrics_status)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+UPDATE_METRICS_SQL = f'''
+UPDATE {TABLE_NAME}
+SET bleu_score = ?, similarity_score = ?, word_count = ?, relevance_score = ?, metrics_status = ?
+WHERE id = ?
+'''
+UPDATE_METRICS_STATUS_SQL = f"UPDATE {TABLE_NAME} SET metrics_status = ? WHERE id = ?"
+COUNT_SQL = f"SELECT COUNT(*) FROM {TABLE_NAME}"
+HISTORY_SQL = f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC"
+
+# --- 接続の管理 ---
+class ConnectionPool:
+    """
+    SQLiteの接続を保持して使い回すプール
+
+    Streamlitはセッション（と再実行）ごとに別のスレッドでスクリプトを実行するため、接続はスレッドに結び付けず、
+    connection() で借りている間だけ1つのスレッドが使うようにします。同時に使う接続は max_connections 個までで、
+    それを超えると返却されるまで待ちます。
+    """
+
+    def __init__(self, db_file, max_connections=DB_POOL_SIZE):
+        self.db_file = db_file
+        self.max_connections = max_connections
+        self._idle = queue.LifoQueue()  # 最近使った接続（キャッシュが温まっている）から使う
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE_SIZE)
+        for name, value in PRAGMAS:
+            conn.execute(f"PRAGMA {name}={value}")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        接続を借りる（with ブロックを抜けると返却する）
+
+        正常に抜けた場合は未コミットの変更をコミットし、例外の場合はロールバックしてから返却する。
+        """
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+                if conn.in_transaction:
+                    conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """すべての接続を閉じる"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._idle = queue.LifoQueue()
+
+# 接続のプールはStreamlitのセッションをまたいで共有する
+@st.cache_resource
+def get_connection_pool(db_file):
+    """データベースファイルごとの接続のプールを返す"""
+    return ConnectionPool(db_file)
+
+def get_connection():
+    """現在のデータベースの接続を借りる（with 文で使う）"""
+    return get_connection_pool(DB_FILE).connection()
+
 # --- データベース初期化 ---
 def init_db():
     """データベースとテーブルを初期化する"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(SCHEMA)
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            conn.execute(SCHEMA)
+            # 以前のスキーマで作成されたテーブルには不足している列を追加する
+            existing_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+            for column, column_type in ADDED_COLUMNS:
+                if column not in existing_columns:
+                    conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {column} {column_type}")
+                    print(f"Added column '{column}' to {TABLE_NAME}.")
         print(f"Database '{DB_FILE}' initialized successfully.")
     except Exception as e:
         st.error(f"データベースの初期化に失敗しました: {e}")
         raise e # エラーを再発生させてアプリの起動を止めるか、適切に処理する
 
 # --- データ操作関数 ---
-def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time):
-    """チャット履歴と評価指標をデータベースに保存する"""
-    conn = None
+def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time, ttft=None):
+    """
+    チャット履歴をデータベースに保存する（ttft は最初のテキストが表示されるまでの秒数）
+
+    評価指標は計算せずに metrics_status を pending として保存し、
+    バックグラウンドのワーカー（metrics_worker.py）が計算して行を更新します。
+
+    Returns:
+        int: 保存した行のID（保存に失敗した場合はNone）
+    """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # 追加の評価指標を計算
-        bleu_score, similarity_score, word_count, relevance_score = calculate_metrics(
-            answer, correct_answer
-        )
-
-        c.execute(f'''
-        INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
-                                 response_time, bleu_score, similarity_score, word_count, relevance_score)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp, question, answer, feedback, correct_answer, is_correct,
-             response_time, bleu_score, similarity_score, word_count, relevance_score))
-        conn.commit()
+        with get_connection() as conn:
+            cursor = conn.execute(INSERT_SQL, (timestamp, question, answer, feedback, correct_answer, is_correct,
+                                               response_time, ttft, METRICS_PENDING))
+            row_id = cursor.lastrowid
         print("Data saved to DB successfully.") # デバッグ用
     except sqlite3.Error as e:
         st.error(f"データベースへの保存中にエラーが発生しました: {e}")
-    finally:
-        if conn:
-            conn.close()
+        return None
+
+    # 評価指標の計算をバックグラウンドのワーカーに依頼する（循環インポートを避けるためここで読み込む）
+    from metrics_worker import get_metrics_worker
+    get_metrics_worker().submit(row_id)
+    return row_id
+
+def bulk_save_to_db(records, score_metrics=True, conn=None):
+    """
+    複数のチャット履歴を1つのトランザクションでまとめて保存する
+
+    Args:
+        records (list): 保存する行の辞書のリスト。question と answer は必須で、feedback, correct_answer,
+            is_correct, response_time, ttft, timestamp（省略時は現在時刻）を指定できる
+        score_metrics (bool): 評価指標をまとめて計算してから保存するかどうか。
+            False の場合は metrics_status を pending として保存し、評価指標は metrics_worker.py で計算する
+        conn (sqlite3.Connection, optional): 呼び出し側のトランザクションで保存する場合の接続（コミットは呼び出し側で行う）
+
+    Returns:
+        int: 保存した行数
+    """
+    records = list(records)
+    if not records:
+        return 0
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if score_metrics:
+        # 評価指標は全件をまとめて計算する（TF-IDFとコサイン類似度はバッチ全体で一度に計算される）
+        from metrics import calculate_metrics_batch
+        scores = calculate_metrics_batch([(record["answer"], record.get("correct_answer")) for record in records])
+        status = METRICS_DONE
+    else:
+        scores = [(None, None, None, None)] * len(records)
+        status = METRICS_PENDING
+    rows = [
+        (record.get("timestamp") or timestamp, record["question"], record["answer"], record.get("feedback"),
+         record.get("correct_answer"), record.get("is_correct"), record.get("response_time"), record.get("ttft"),
+         *score, status)
+        for record, score in zip(records, scores)
+    ]
+    if conn is not None:
+        conn.executemany(BULK_INSERT_SQL, rows)
+    else:
+        with get_connection() as conn:
+            conn.executemany(BULK_INSERT_SQL, rows)
+    print(f"{len(rows)} rows saved to DB successfully.") # デバッグ用
+    return len(rows)
+
+def get_metrics_inputs(row_ids=None, after_id=0, limit=None, pending_only=False):
+    """
+    評価指標の計算に必要な (id, answer, correct_answer) を取得する
+
+    Args:
+        row_ids (list, optional): 取得する行のID（省略時はすべての行）
+        after_id (int): このIDより後の行だけを取得する（まとめて再計算する際のページング用）
+        limit (int, optional): 取得する最大の行数
+        pending_only (bool): 評価指標が未計算の行だけを取得する
+
+    Returns:
+        list: (id, answer, correct_answer) のタプルのリスト（ID順）
+    """
+    conditions, params = ["id > ?"], [after_id]
+    if row_ids is not None:
+        conditions.append(f"id IN ({', '.join('?' * len(row_ids))})")
+        params.extend(row_ids)
+    if pending_only:
+        conditions.append("metrics_status = ?")
+        params.append(METRICS_PENDING)
+    query = f"SELECT id, answer, correct_answer FROM {TABLE_NAME} WHERE {' AND '.join(conditions)} ORDER BY id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    with get_connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+def update_metrics(results, status=METRICS_DONE):
+    """
+    計算した評価指標で行を更新する
+
+    Args:
+        results (list): (id, bleu_score, similarity_score, word_count, relevance_score) のタプルのリスト
+        status (str): 更新後の metrics_status
+    """
+    with get_connection() as conn:
+        conn.executemany(UPDATE_METRICS_SQL, [(bleu, similarity, word_count, relevance, status, row_id)
+                                              for row_id, bleu, similarity, word_count, relevance in results])
+
+def mark_metrics_status(row_ids, status):
+    """評価指標を計算せずに metrics_status だけを更新する（計算に失敗した行など）"""
+    with get_connection() as conn:
+        conn.executemany(UPDATE_METRICS_STATUS_SQL, [(status, row_id) for row_id in row_ids])
 
 def get_chat_history():
     """データベースから全てのチャット履歴を取得する"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        # is_correctがREAL型なので、それに応じて読み込む
-        df = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC", conn)
+        with get_connection() as conn:
+            # is_correctがREAL型なので、それに応じて読み込む
+            df = pd.read_sql_query(HISTORY_SQL, conn)
         # is_correct カラムのデータ型を確認し、必要なら変換
         if 'is_correct' in df.columns:
              df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce') # 数値に変換、失敗したらNaN
@@ -80,29 +281,18 @@ def get_chat_history():
     except sqlite3.Error as e:
         st.error(f"履歴の取得中にエラーが発生しました: {e}")
         return pd.DataFrame() # 空のDataFrameを返す
-    finally:
-        if conn:
-            conn.close()
 
 def get_db_count():
     """データベース内のレコード数を取得する"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}")
-        count = c.fetchone()[0]
-        return count
+        with get_connection() as conn:
+            return conn.execute(COUNT_SQL).fetchone()[0]
     except sqlite3.Error as e:
         st.error(f"レコード数の取得中にエラーが発生しました: {e}")
         return 0
-    finally:
-        if conn:
-            conn.close()
 
 def clear_db():
     """データベースの全レコードを削除する"""
-    conn = None
     confirmed = st.session_state.get("confirm_clear", False)
 
     if not confirmed:
@@ -111,17 +301,12 @@ def clear_db():
         return False # 削除は実行されなかった
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"DELETE FROM {TABLE_NAME}")
-        conn.commit()
+        with get_connection() as conn:
+            conn.execute(f"DELETE FROM {TABLE_NAME}")
         st.success("データベースが正常にクリアされました。")
         st.session_state.confirm_clear = False # 確認状態をリセット
         return True # 削除成功
     except sqlite3.Error as e:
         st.error(f"データベースのクリア中にエラーが発生しました: {e}")
         st.session_state.confirm_clear = False # エラー時もリセット
-        return False # 削除失敗
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        return False # 削除失敗
\ No newline at end of file
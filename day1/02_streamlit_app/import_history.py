@@ -0,0 +1,153 @@
+# import_history.py
+# JSONLまたはCSVのファイルから過去の質問と回答をチャット履歴のデータベースにまとめて取り込むスクリプトです
+# 各行は question と answer が必須で、feedback, correct_answer, is_correct, response_time, ttft, timestamp を指定できます。
+# ファイルごとに1つのトランザクションで保存し（batch_size 行ずつ database.bulk_save_to_db で書き込む）、
+# 取り込んだファイルの内容のハッシュを imported_files テーブルに同じトランザクションで記録します。
+# 途中で失敗したファイルは何も保存されず、再実行すると取り込み済みのファイルを飛ばして続きから取り込みます。
+# 評価指標の計算は時間がかかるため、既定では計算せずに保存し（metrics_status = pending）、
+# アプリの起動時のワーカーまたは `python metrics_worker.py --pending-only` で計算します。
+# 使い方:
+#   python import_history.py history.jsonl
+#   python import_history.py old_history.csv --db chat_feedback.db --batch-size 20000
+#   python import_history.py history.jsonl --score     # 取り込みながら評価指標も計算する
+#   python import_history.py history.jsonl --force     # 取り込み済みのファイルも取り込み直す
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+
+import database
+
+NUMERIC_FIELDS = ("is_correct", "response_time", "ttft")
+TEXT_FIELDS = ("timestamp", "question", "answer", "feedback", "correct_answer")
+
+IMPORTED_FILES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS imported_files (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT,
+    rows INTEGER,
+    imported_at TEXT DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+
+def normalize_record(record, source, line_number):
+    """読み込んだ行を bulk_save_to_db に渡す辞書にする（数値の列を変換し、空の値はNoneにする）"""
+    if not record.get("question") or record.get("answer") is None:
+        raise ValueError(f"{source}:{line_number}: question と answer は必須です")
+    normalized = {field: record.get(field) or None for field in TEXT_FIELDS}
+    normalized["answer"] = record["answer"]
+    for field in NUMERIC_FIELDS:
+        value = record.get(field)
+        if value in (None, ""):
+            normalized[field] = None
+            continue
+        try:
+            normalized[field] = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{source}:{line_number}: {field} は数値で指定してください（{value!r}）")
+    return normalized
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                yield normalize_record(json.loads(line), path, line_number)
+
+
+def read_csv(path):
+    # Excelで保存したCSVの先頭のBOMを読み飛ばす
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for line_number, record in enumerate(csv.DictReader(f), start=2):
+            yield normalize_record(record, path, line_number)
+
+
+def read_records(path, file_format="auto"):
+    """ファイルの行を順に返す（file_format が auto なら拡張子で判断する）"""
+    if file_format == "auto":
+        file_format = "csv" if os.path.splitext(path)[1].lower() == ".csv" else "jsonl"
+    return read_csv(path) if file_format == "csv" else read_jsonl(path)
+
+
+def file_sha256(path):
+    """ファイルの内容のハッシュ（取り込み済みかどうかの判定に使う）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def import_file(conn, path, file_format="auto", batch_size=10000, score_metrics=False):
+    """
+    1つのファイルの行を batch_size 行ずつ conn のトランザクションで保存する
+
+    Returns:
+        int: 保存した行数
+    """
+    imported = 0
+    batch = []
+    for record in read_records(path, file_format):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            imported += database.bulk_save_to_db(batch, score_metrics=score_metrics, conn=conn)
+            batch = []
+    if batch:
+        imported += database.bulk_save_to_db(batch, score_metrics=score_metrics, conn=conn)
+    return imported
+
+
+def import_files(paths, file_format="auto", batch_size=10000, score_metrics=False, force=False):
+    """
+    ファイルごとに1つのトランザクションで行をデータベースに保存する
+
+    取り込んだファイルは imported_files に記録し、同じ内容のファイルは force を指定しない限り取り込みません。
+    途中でエラーになったファイルはロールバックされるため、再実行すると続きのファイルから取り込めます。
+
+    Returns:
+        int: 保存した行数
+    """
+    with database.get_connection() as conn:
+        conn.execute(IMPORTED_FILES_SCHEMA)
+    imported = 0
+    for path in paths:
+        sha256 = file_sha256(path)
+        with database.get_connection() as conn:
+            done = conn.execute("SELECT path, rows FROM imported_files WHERE sha256 = ?", (sha256,)).fetchone()
+            if done is not None and not force:
+                print(f"{path}: 取り込み済みのため飛ばします（{done[0]}、{done[1]} 件）")
+                continue
+            rows = import_file(conn, path, file_format, batch_size, score_metrics)
+            conn.execute("INSERT OR REPLACE INTO imported_files (sha256, path, rows) VALUES (?, ?, ?)",
+                         (sha256, path, rows))
+        print(f"{path}: {rows} 件を取り込みました")
+        imported += rows
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL/CSVのファイルから過去の質問と回答をチャット履歴に取り込みます")
+    parser.add_argument("paths", nargs="+", help="取り込むファイル（.jsonl または .csv）")
+    parser.add_argument("--format", choices=["auto", "jsonl", "csv"], default="auto", help="ファイルの形式")
+    parser.add_argument("--db", default=None, help="データベースファイル（未指定なら config.DB_FILE）")
+    parser.add_argument("--batch-size", type=int, default=10000, help="まとめて書き込む（評価指標を計算する）行数")
+    parser.add_argument("--score", action="store_true", help="取り込みながら評価指標を計算する（遅い）")
+    parser.add_argument("--force", action="store_true", help="取り込み済みのファイルも取り込み直す")
+    args = parser.parse_args()
+
+    if args.db:
+        database.DB_FILE = args.db
+    database.init_db()
+    start = time.perf_counter()
+    imported = import_files(args.paths, args.format, args.batch_size, args.score, args.force)
+    elapsed = time.perf_counter() - start
+    print(f"完了: {imported} 件を取り込みました（{elapsed:.2f}秒、{imported / elapsed if elapsed > 0 else 0:.0f} 件/秒）")
+    if imported and not args.score:
+        print("評価指標は未計算です。アプリを起動するか `python metrics_worker.py --pending-only` を実行すると計算されます。")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,22 @@
 # llm.py
 import os
+import sys
 import torch
 from transformers import pipeline
 import streamlit as st
 import time
-from config import MODEL_NAME
+import threading
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from config import MODEL_NAME, PREFIX_CACHE_ENABLED, PREFIX_CACHE_MAX_BYTES, PREFIX_CACHE_BLOCK_SIZE
+from config import CPU_PROFILE, CPU_NUM_THREADS, ONNX_EXPORT_DIR
 from huggingface_hub import login
 
+# 03_FastAPI と共有する day1/common を読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.prefix_cache import PrefixKVCache, generate_with_prefix_cache
+from common.cpu_profile import create_cpu_pipeline, is_onnx_model
+from common.inference import chat_input_ids, clean_response, generate_from_ids
+
 # モデルをキャッシュして再利用
 @st.cache_resource
 def load_model():
@@ -18,12 +28,17 @@ def load_model():
         
         device = "cuda" if torch.cuda.is_available() else "cpu"
         st.info(f"Using device: {device}") # 使用デバイスを表示
-        pipe = pipeline(
-            "text-generation",
-            model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
+        if device == "cpu":
+            # CPUではbfloat16が遅いため、CPU向けのプロファイル（float32 / int8動的量子化 / ONNX Runtime）で読み込む
+            st.info(f"CPU profile: {CPU_PROFILE}")
+            pipe = create_cpu_pipeline(MODEL_NAME, CPU_PROFILE, CPU_NUM_THREADS, onnx_dir=ONNX_EXPORT_DIR)
+        else:
+            pipe = pipeline(
+                "text-generation",
+                model=MODEL_NAME,
+                model_kwargs={"torch_dtype": torch.bfloat16},
+                device=device
+            )
         st.success(f"モデル '{MODEL_NAME}' の読み込みに成功しました。")
         return pipe
     except Exception as e:
@@ -31,57 +46,133 @@ def load_model():
         st.error("GPUメモリ不足の可能性があります。不要なプロセスを終了するか、より小さいモデルの使用を検討してください。")
         return None
 
-def generate_response(pipe, user_question):
-    """LLMを使用して質問に対する回答を生成する"""
-    if pipe is None:
-        return "モデルがロードされていないため、回答を生成できません。", 0
+# 接頭辞KVキャッシュもモデルと同様にキャッシュして再利用
+@st.cache_resource
+def get_prefix_cache():
+    """接頭辞KVキャッシュを作成する"""
+    return PrefixKVCache(max_bytes=PREFIX_CACHE_MAX_BYTES, block_size=PREFIX_CACHE_BLOCK_SIZE)
+
+class StopRequested(StoppingCriteria):
+    """停止が要求されたら次のデコードステップで生成を打ち切る停止条件"""
+
+    def __init__(self, stop_event):
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.stop_event.is_set()
+
+
+class ResponseStream:
+    """
+    回答をバックグラウンドスレッドで生成し、テキストの断片を逐次返すイテレーター
+
+    st.write_stream に渡すと、生成されたテキストが届いた順に表示されます。
+    イテレートし終えると answer（整形済みの回答）、ttft（最初のテキストが届くまでの秒数）、
+    response_time（生成が終わるまでの合計秒数）が利用できます。
+    Streamlitの停止・再実行などで読み出しが途中で打ち切られると、バックグラウンドの生成も止めます。
+    """
+
+    def __init__(self, pipe, user_question, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9):
+        self.pipe = pipe
+        self.user_question = user_question
+        self.generate_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": do_sample,
+                                "temperature": temperature, "top_p": top_p}
+        self.answer = ""
+        self.ttft = 0.0
+        self.response_time = 0.0
+        self.error = None
+        self.stop_event = threading.Event()
+
+    def close(self):
+        """生成の中止を要求する（次のデコードステップで止まる）"""
+        self.stop_event.set()
+
+    def _run(self, input_ids, streamer, prefix_cache):
+        stopping_criteria = StoppingCriteriaList([StopRequested(self.stop_event)])
+        try:
+            if prefix_cache is not None:
+                # 共通の接頭辞（チャットテンプレートなど）のKVキャッシュを再利用し、新しい部分だけをプリフィルする
+                generate_with_prefix_cache(self.pipe, input_ids, prefix_cache, streamer=streamer,
+                                           stopping_criteria=stopping_criteria, **self.generate_kwargs)
+                print(f"Prefix cache: {prefix_cache.stats()}") # デバッグ用
+            else:
+                generate_from_ids(self.pipe, input_ids, streamer=streamer, stopping_criteria=stopping_criteria,
+                                  **self.generate_kwargs)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self.error = e
+            # 読み出し側が待ち続けないように終了を通知
+            streamer.end()
+
+    def __iter__(self):
+        if self.pipe is None:
+            self.answer = "モデルがロードされていないため、回答を生成できません。"
+            yield self.answer
+            return
 
-    try:
         start_time = time.time()
-        messages = [
-            {"role": "user", "content": user_question},
-        ]
-        # max_new_tokensを調整可能にする（例）
-        outputs = pipe(messages, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9)
-
-        # Gemmaの出力形式に合わせて調整が必要な場合がある
-        # 最後のassistantのメッセージを取得
-        assistant_response = ""
-        if outputs and isinstance(outputs, list) and outputs[0].get("generated_text"):
-           if isinstance(outputs[0]["generated_text"], list) and len(outputs[0]["generated_text"]) > 0:
-               # messages形式の場合
-               last_message = outputs[0]["generated_text"][-1]
-               if last_message.get("role") == "assistant":
-                   assistant_response = last_message.get("content", "").strip()
-           elif isinstance(outputs[0]["generated_text"], str):
-               # 単純な文字列の場合（古いtransformers？） - プロンプト部分を除く処理が必要かも
-               # この部分はモデルやtransformersのバージョンによって調整が必要
-               full_text = outputs[0]["generated_text"]
-               # 簡単な方法：ユーザーの質問以降の部分を取得
-               prompt_end = user_question
-               response_start_index = full_text.find(prompt_end) + len(prompt_end)
-               # 応答部分のみを抽出（より堅牢な方法が必要な場合あり）
-               possible_response = full_text[response_start_index:].strip()
-               # 特定の開始トークンを探すなど、モデルに合わせた調整
-               if "<start_of_turn>model" in possible_response:
-                    assistant_response = possible_response.split("<start_of_turn>model\n")[-1].strip()
-               else:
-                    assistant_response = possible_response # フォールバック
-
-        if not assistant_response:
-             # 上記で見つからない場合のフォールバックやデバッグ
-             print("Warning: Could not extract assistant response. Full output:", outputs)
-             assistant_response = "回答の抽出に失敗しました。"
-
-
-        end_time = time.time()
-        response_time = end_time - start_time
-        print(f"Generated response in {response_time:.2f}s") # デバッグ用
-        return assistant_response, response_time
+        chunks = []
+        try:
+            messages = [
+                {"role": "user", "content": self.user_question},
+            ]
+            input_ids = chat_input_ids(self.pipe.tokenizer, messages)
+            # st.cache_resource はスクリプトのスレッドで取得しておく
+            prefix_cache = get_prefix_cache() if PREFIX_CACHE_ENABLED and not is_onnx_model(self.pipe.model) else None
+            streamer = TextIteratorStreamer(self.pipe.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            # 生成はバックグラウンドスレッドで行い、このスレッドではテキストが届くたびに返す
+            thread = threading.Thread(target=self._run, args=(input_ids, streamer, prefix_cache), daemon=True)
+            thread.start()
+            for text in streamer:
+                if not text:
+                    continue
+                if not chunks:
+                    self.ttft = time.time() - start_time
+                chunks.append(text)
+                yield text
+            thread.join()
+        except Exception as e:
+            self.error = e
+        finally:
+            # 最後まで読み出されなかった場合（Streamlitの停止・再実行でジェネレーターが閉じられた場合）は生成を止める
+            self.close()
+        self.response_time = time.time() - start_time
 
-    except Exception as e:
-        st.error(f"回答生成中にエラーが発生しました: {e}")
-        # エラーの詳細をログに出力
-        import traceback
-        traceback.print_exc()
-        return f"エラーが発生しました: {str(e)}", 0
\ No newline at end of file
+        if self.error is not None:
+            st.error(f"回答生成中にエラーが発生しました: {self.error}")
+            self.answer = f"エラーが発生しました: {str(self.error)}"
+            self.ttft = self.response_time = 0
+            yield "\n\n" + self.answer
+            return
+        self.answer = clean_response("".join(chunks), fallback="回答の抽出に失敗しました。")
+        if not chunks:
+            yield self.answer
+        print(f"Generated response in {self.response_time:.2f}s (TTFT {self.ttft:.2f}s)") # デバッグ用
+
+
+def generate_response_stream(pipe, user_question):
+    """
+    LLMを使用して質問に対する回答をストリーミングで生成する
+
+    Args:
+        pipe: transformersのtext-generationパイプライン
+        user_question (str): 質問
+
+    Returns:
+        ResponseStream: テキストの断片を返すイテレーター（st.write_stream に渡す）
+    """
+    return ResponseStream(pipe, user_question)
+
+
+def generate_response(pipe, user_question):
+    """
+    LLMを使用して質問に対する回答を生成する（ストリーミングせずに回答全体を待つ）
+
+    Returns:
+        tuple: (回答, 応答時間（秒）)
+    """
+    stream = ResponseStream(pipe, user_question)
+    for _ in stream:
+        pass
+    return stream.answer, stream.response_time
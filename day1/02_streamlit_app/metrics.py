@@ -3,8 +3,9 @@ import streamlit as st
 import nltk
 from janome.tokenizer import Tokenizer
 import re
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
+import threading
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
 
 # NLTKのヘルパー関数（エラー時フォールバック付き）
 try:
@@ -34,72 +35,140 @@ def initialize_nltk():
     except Exception as e:
         st.error(f"NLTKデータのダウンロードに失敗しました: {e}")
 
-def calculate_metrics(answer, correct_answer):
-    """回答と正解から評価指標を計算する"""
-    word_count = 0
-    bleu_score = 0.0
-    similarity_score = 0.0
-    relevance_score = 0.0
+class MetricsScorer:
+    """
+    回答と正解から評価指標を計算するクラス
 
-    if not answer: # 回答がない場合は計算しない
-        return bleu_score, similarity_score, word_count, relevance_score
+    Janomeのトークナイザー（辞書の読み込みに時間がかかる）は1回だけ作成して使い回します。
+    score_batch では、複数の組の TF-IDF とコサイン類似度を疎行列でまとめて計算します。
+    類似度は calculate_metrics と同じく組ごとの2文書から求めたIDFを使うため、1件ずつ計算した値と一致します。
+    """
 
-    # 単語数のカウント
-    tokenizer = Tokenizer()
-    tokens = list(tokenizer.tokenize(answer))  # ← list() でイテレータをリストに変換
-    word_count = len(tokens)
+    def __init__(self):
+        # 単語数を数えるだけなので、品詞情報を作らない分かち書きモードを使う
+        self._tokenizer = Tokenizer(wakati=True)
+        self._lock = threading.Lock()  # Janomeのトークナイザーはスレッドセーフではない
 
-    # 正解がある場合のみBLEUと類似度を計算
-    if correct_answer:
-        answer_lower = answer.lower()
-        correct_answer_lower = correct_answer.lower()
+    def word_count(self, text):
+        """テキストの単語数（Janomeで分割したトークン数）"""
+        if not text:
+            return 0
+        with self._lock:
+            return sum(1 for _ in self._tokenizer.tokenize(text))
 
-        # BLEU スコアの計算
+    @staticmethod
+    def _bleu(answer_lower, correct_answer_lower):
         try:
             reference = [nltk_word_tokenize(correct_answer_lower)]
             candidate = nltk_word_tokenize(answer_lower)
             # ゼロ除算エラーを防ぐ
-            if candidate:
-                bleu_score = nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25)) # 4-gram BLEU
-            else:
-                bleu_score = 0.0
-        except Exception as e:
-            # st.warning(f"BLEUスコア計算エラー: {e}")
-            bleu_score = 0.0 # エラー時は0
-
-        # コサイン類似度の計算
-        try:
-            vectorizer = TfidfVectorizer()
-            # fit_transformはリストを期待するため、リストで渡す
-            if answer_lower.strip() and correct_answer_lower.strip(): # 空文字列でないことを確認
-                tfidf_matrix = vectorizer.fit_transform([answer_lower, correct_answer_lower])
-                similarity_score = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            else:
-                similarity_score = 0.0
-        except Exception as e:
-            # st.warning(f"類似度スコア計算エラー: {e}")
-            similarity_score = 0.0 # エラー時は0
+            if not candidate:
+                return 0.0
+            return nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25)) # 4-gram BLEU
+        except Exception:
+            return 0.0 # エラー時は0
 
+    @staticmethod
+    def _relevance(answer_lower, correct_answer_lower):
         # 関連性スコア（キーワードの一致率などで簡易的に計算）
+        answer_words = set(re.findall(r'\w+', answer_lower))
+        correct_words = set(re.findall(r'\w+', correct_answer_lower))
+        if not correct_words:
+            return 0.0
+        return len(answer_words.intersection(correct_words)) / len(correct_words)
+
+    @staticmethod
+    def _similarities(answers, correct_answers):
+        """
+        組ごとの TF-IDF ベクトルのコサイン類似度をまとめて計算する
+
+        TfidfVectorizer を2文書で学習した場合と同じ重み（smooth_idf: 両方に現れる語は1、
+        片方だけの語は 1 + ln(3/2)）を、バッチ全体の語彙で作った出現回数の行列に掛けて求める。
+        """
         try:
-            answer_words = set(re.findall(r'\w+', answer_lower))
-            correct_words = set(re.findall(r'\w+', correct_answer_lower))
-            if len(correct_words) > 0:
-                common_words = answer_words.intersection(correct_words)
-                relevance_score = len(common_words) / len(correct_words)
-            else:
-                relevance_score = 0.0
-        except Exception as e:
-            # st.warning(f"関連性スコア計算エラー: {e}")
-            relevance_score = 0.0 # エラー時は0
-
-    return bleu_score, similarity_score, word_count, relevance_score
+            counts = CountVectorizer().fit_transform(list(answers) + list(correct_answers)).astype(np.float64)
+        except ValueError:
+            return np.zeros(len(answers))  # どの文書にも単語がない
+        a = counts[:len(answers)].tocsr()
+        b = counts[len(answers):].tocsr()
+        # 片方の文書だけに現れる語の重みを上乗せする
+        only_one_weight = np.log(1.5)
+        both = a.multiply(b > 0)
+        a_weighted = a * (1 + only_one_weight) - both * only_one_weight
+        b_weighted = b * (1 + only_one_weight) - b.multiply(a > 0) * only_one_weight
+        dot = np.asarray(a_weighted.multiply(b_weighted).sum(axis=1)).ravel()
+        norms = (np.sqrt(np.asarray(a_weighted.multiply(a_weighted).sum(axis=1)).ravel())
+                 * np.sqrt(np.asarray(b_weighted.multiply(b_weighted).sum(axis=1)).ravel()))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(norms > 0, dot / norms, 0.0)
+
+    def score(self, answer, correct_answer):
+        """1組の評価指標を計算する（calculate_metrics と同じ値を返す）"""
+        return self.score_batch([(answer, correct_answer)])[0]
+
+    def score_batch(self, pairs):
+        """
+        複数の (回答, 正解) の組の評価指標をまとめて計算する
+
+        Args:
+            pairs (list): (answer, correct_answer) のタプルのリスト
+
+        Returns:
+            list: 組ごとの (bleu_score, similarity_score, word_count, relevance_score) のリスト
+        """
+        results = [(0.0, 0.0, 0, 0.0)] * len(pairs)
+        # 類似度を計算する組（回答と正解がどちらも空白だけでない）
+        similarity_indices, similarity_answers, similarity_corrects = [], [], []
+        for i, (answer, correct_answer) in enumerate(pairs):
+            if not answer: # 回答がない場合は計算しない
+                continue
+            word_count = self.word_count(answer)
+            bleu_score = relevance_score = 0.0
+            # 正解がある場合のみBLEUと類似度を計算
+            if correct_answer:
+                answer_lower = answer.lower()
+                correct_answer_lower = correct_answer.lower()
+                bleu_score = self._bleu(answer_lower, correct_answer_lower)
+                relevance_score = self._relevance(answer_lower, correct_answer_lower)
+                if answer_lower.strip() and correct_answer_lower.strip():
+                    similarity_indices.append(i)
+                    similarity_answers.append(answer_lower)
+                    similarity_corrects.append(correct_answer_lower)
+            results[i] = (bleu_score, 0.0, word_count, relevance_score)
+
+        if similarity_indices:
+            similarities = self._similarities(similarity_answers, similarity_corrects)
+            for i, similarity_score in zip(similarity_indices, similarities):
+                bleu_score, _, word_count, relevance_score = results[i]
+                results[i] = (bleu_score, float(similarity_score), word_count, relevance_score)
+        return results
+
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+def get_metrics_scorer():
+    """プロセス全体で共有する MetricsScorer を返す（初回の呼び出しで作成する）"""
+    global _scorer
+    with _scorer_lock:
+        if _scorer is None:
+            _scorer = MetricsScorer()
+        return _scorer
+
+def calculate_metrics(answer, correct_answer):
+    """回答と正解から評価指標を計算する"""
+    return get_metrics_scorer().score(answer, correct_answer)
+
+def calculate_metrics_batch(pairs):
+    """複数の (回答, 正解) の組の評価指標をまとめて計算する"""
+    return get_metrics_scorer().score_batch(pairs)
 
 def get_metrics_descriptions():
     """評価指標の説明を返す"""
     return {
         "正確性スコア (is_correct)": "回答の正確さを3段階で評価: 1.0 (正確), 0.5 (部分的に正確), 0.0 (不正確)",
         "応答時間 (response_time)": "質問を投げてから回答を得るまでの時間（秒）。モデルの効率性を表す",
+        "最初の応答までの時間 (ttft)": "質問を投げてから回答の最初のテキストが表示されるまでの時間（秒）。体感的な待ち時間を表す",
         "BLEU スコア (bleu_score)": "機械翻訳評価指標で、正解と回答のn-gramの一致度を測定 (0〜1の値、高いほど類似)",
         "類似度スコア (similarity_score)": "TF-IDFベクトルのコサイン類似度による、正解と回答の意味的な類似性 (0〜1の値)",
         "単語数 (word_count)": "回答に含まれる単語の数。情報量や詳細さの指標",
@@ -0,0 +1,149 @@
+# metrics_worker.py
+# 保存済みのチャット履歴の評価指標（BLEU、類似度、単語数、関連性）をバックグラウンドで計算するモジュールです
+# フィードバックの保存時には評価指標を計算せずに行を追加し（metrics_status = pending）、
+# このワーカーがまとめて計算して行を更新するため、保存ボタンを押してからの待ち時間に計算が含まれません。
+# 使い方（評価指標の計算方法を変更したときに、すべての行を再計算する）:
+#   python metrics_worker.py                   # すべての行を再計算
+#   python metrics_worker.py --pending-only    # 未計算の行だけを計算
+import argparse
+import queue
+import threading
+import time
+import traceback
+
+import database
+from metrics import calculate_metrics_batch
+
+
+def compute_metrics(rows):
+    """
+    (id, answer, correct_answer) の行の評価指標をまとめて計算し、データベースを更新する
+
+    Returns:
+        int: 更新した行数
+    """
+    if not rows:
+        return 0
+    scores = calculate_metrics_batch([(answer, correct_answer) for _, answer, correct_answer in rows])
+    database.update_metrics([(row[0], *score) for row, score in zip(rows, scores)])
+    return len(rows)
+
+
+class MetricsWorker:
+    """
+    評価指標を計算するバックグラウンドのスレッド
+
+    submit() で渡された行IDをキューに入れ、届いたものをまとめて（最大 batch_size 件）計算します。
+    起動時には、前回の実行で計算されずに残った行（metrics_status = pending）も計算します。
+    """
+
+    def __init__(self, batch_size=64):
+        self.batch_size = batch_size
+        self.processed = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="metrics-worker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, row_id):
+        """評価指標を計算する行を追加する"""
+        if row_id is not None:
+            self._queue.put(row_id)
+
+    def wait(self, timeout=None):
+        """キューの行の計算が終わるまで待つ（終わればTrue）"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def pending(self):
+        """計算待ちの行数"""
+        return self._queue.unfinished_tasks
+
+    def _process(self, row_ids):
+        try:
+            self.processed += compute_metrics(database.get_metrics_inputs(row_ids=row_ids))
+        except Exception as e:
+            print(f"評価指標の計算中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            self.failed += len(row_ids)
+            try:
+                database.mark_metrics_status(row_ids, database.METRICS_ERROR)
+            except Exception:
+                traceback.print_exc()
+
+    def _run(self):
+        # 前回の実行で計算されずに残った行を先に計算する
+        try:
+            for row_id, _, _ in database.get_metrics_inputs(pending_only=True):
+                self._queue.put(row_id)
+        except Exception as e:
+            print(f"未計算の行の取得中にエラーが発生しました: {e}")
+
+        while True:
+            row_ids = [self._queue.get()]
+            # 届いているものをまとめて計算する
+            while len(row_ids) < self.batch_size:
+                try:
+                    row_ids.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._process(row_ids)
+            for _ in row_ids:
+                self._queue.task_done()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+def get_metrics_worker():
+    """プロセス全体で共有する MetricsWorker を返す（初回の呼び出しで起動する）"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = MetricsWorker().start()
+        return _worker
+
+
+def recompute_all(batch_size=500, pending_only=False):
+    """
+    すべての行（または未計算の行）の評価指標を batch_size 件ずつ計算し直す
+
+    Returns:
+        int: 更新した行数
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        rows = database.get_metrics_inputs(after_id=last_id, limit=batch_size, pending_only=pending_only)
+        if not rows:
+            return updated
+        updated += compute_metrics(rows)
+        last_id = rows[-1][0]
+        print(f"{updated} 件の評価指標を更新しました（ID {last_id} まで）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャット履歴の評価指標をまとめて計算し直します")
+    parser.add_argument("--db", default=None, help="データベースファイル（未指定なら config.DB_FILE）")
+    parser.add_argument("--batch-size", type=int, default=500, help="1回にまとめて計算する行数")
+    parser.add_argument("--pending-only", action="store_true", help="未計算の行だけを計算する")
+    args = parser.parse_args()
+
+    if args.db:
+        database.DB_FILE = args.db
+    database.init_db()
+    start = time.perf_counter()
+    updated = recompute_all(args.batch_size, args.pending_only)
+    elapsed = time.perf_counter() - start
+    print(f"完了: {updated} 件（{elapsed:.2f}秒）")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,8 @@
 import streamlit as st
 import pandas as pd
 import time
-from database import save_to_db, get_chat_history, get_db_count, clear_db
-from llm import generate_response
+from database import save_to_db, get_chat_history, get_db_count, clear_db, METRICS_PENDING, METRICS_ERROR
+from llm import generate_response_stream
 from data import create_sample_evaluation_data
 from metrics import get_metrics_descriptions
 
@@ -21,6 +21,8 @@ def display_chat_page(pipe):
         st.session_state.current_answer = ""
     if "response_time" not in st.session_state:
         st.session_state.response_time = 0.0
+    if "ttft" not in st.session_state:
+        st.session_state.ttft = 0.0
     if "feedback_given" not in st.session_state:
         st.session_state.feedback_given = False
 
@@ -30,18 +32,25 @@ def display_chat_page(pipe):
         st.session_state.current_answer = "" # 回答をリセット
         st.session_state.feedback_given = False # フィードバック状態もリセット
 
-        with st.spinner("モデルが回答を生成中..."):
-            answer, response_time = generate_response(pipe, user_question)
-            st.session_state.current_answer = answer
-            st.session_state.response_time = response_time
-            # ここでrerunすると回答とフィードバックが一度に表示される
-            st.rerun()
+        # 生成されたテキストを届いた順に表示する
+        st.subheader("回答:")
+        stream = generate_response_stream(pipe, user_question)
+        try:
+            st.write_stream(stream)
+        finally:
+            # 停止・再実行で表示が打ち切られた場合も、バックグラウンドの生成を止める
+            stream.close()
+        st.session_state.current_answer = stream.answer
+        st.session_state.response_time = stream.response_time
+        st.session_state.ttft = stream.ttft
+        # ここでrerunすると回答とフィードバックが一度に表示される
+        st.rerun()
 
     # 回答が表示されるべきか判断 (質問があり、回答が生成済みで、まだフィードバックされていない)
     if st.session_state.current_question and st.session_state.current_answer:
         st.subheader("回答:")
         st.markdown(st.session_state.current_answer) # Markdownで表示
-        st.info(f"応答時間: {st.session_state.response_time:.2f}秒")
+        st.info(f"最初の応答まで: {st.session_state.ttft:.2f}秒 / 応答時間: {st.session_state.response_time:.2f}秒")
 
         # フィードバックフォームを表示 (まだフィードバックされていない場合)
         if not st.session_state.feedback_given:
@@ -53,6 +62,7 @@ def display_chat_page(pipe):
                   st.session_state.current_question = ""
                   st.session_state.current_answer = ""
                   st.session_state.response_time = 0.0
+                  st.session_state.ttft = 0.0
                   st.session_state.feedback_given = False
                   st.rerun() # 画面をクリア
 
@@ -81,10 +91,11 @@ def display_feedback_form():
                 combined_feedback,
                 correct_answer,
                 is_correct,
-                st.session_state.response_time
+                st.session_state.response_time,
+                ttft=st.session_state.ttft
             )
             st.session_state.feedback_given = True
-            st.success("フィードバックが保存されました！")
+            st.success("フィードバックが保存されました！（評価指標はバックグラウンドで計算されます）")
             # フォーム送信後に状態をリセットしない方が、ユーザーは結果を確認しやすいかも
             # 必要ならここでリセットして st.rerun()
             st.rerun() # フィードバックフォームを消すために再実行
@@ -157,20 +168,36 @@ def display_history_list(history_df):
 
             # 評価指標の表示
             st.markdown("---")
-            cols = st.columns(3)
+            metrics_status = row.get('metrics_status')
+            metrics_pending = metrics_status == METRICS_PENDING
+            if metrics_pending:
+                st.caption("評価指標を計算中です。しばらくしてからページを更新してください。")
+            elif metrics_status == METRICS_ERROR:
+                st.caption("評価指標の計算に失敗しました。")
+            cols = st.columns(4)
             cols[0].metric("正確性スコア", f"{row['is_correct']:.1f}")
             cols[1].metric("応答時間(秒)", f"{row['response_time']:.2f}")
-            cols[2].metric("単語数", f"{row['word_count']}")
+            # TTFTを記録する前の履歴やサンプルデータにはTTFTがない
+            ttft = row.get('ttft')
+            cols[2].metric("TTFT(秒)", f"{ttft:.2f}" if pd.notna(ttft) else "-")
+            # 計算中の指標は「計算中」、値がない場合はハイフン表示
+            cols[3].metric("単語数", format_metric(row['word_count'], "{:.0f}", metrics_pending))
 
             cols = st.columns(3)
-            # NaNの場合はハイフン表示
-            cols[0].metric("BLEU", f"{row['bleu_score']:.4f}" if pd.notna(row['bleu_score']) else "-")
-            cols[1].metric("類似度", f"{row['similarity_score']:.4f}" if pd.notna(row['similarity_score']) else "-")
-            cols[2].metric("関連性", f"{row['relevance_score']:.4f}" if pd.notna(row['relevance_score']) else "-")
+            cols[0].metric("BLEU", format_metric(row['bleu_score'], "{:.4f}", metrics_pending))
+            cols[1].metric("類似度", format_metric(row['similarity_score'], "{:.4f}", metrics_pending))
+            cols[2].metric("関連性", format_metric(row['relevance_score'], "{:.4f}", metrics_pending))
 
     st.caption(f"{total_items} 件中 {start_idx+1} - {min(end_idx, total_items)} 件を表示")
 
 
+def format_metric(value, fmt, pending):
+    """評価指標の表示用の文字列（計算中なら「計算中」、NaNならハイフン）"""
+    if pending:
+        return "計算中"
+    return fmt.format(value) if pd.notna(value) else "-"
+
+
 def display_metrics_analysis(history_df):
     """評価指標の分析結果を表示する"""
     st.write("#### 評価指標の分析")
@@ -180,6 +207,10 @@ def display_metrics_analysis(history_df):
     if analysis_df.empty:
         st.warning("分析可能な評価データがありません。")
         return
+    if 'metrics_status' in analysis_df.columns:
+        pending_count = int((analysis_df['metrics_status'] == METRICS_PENDING).sum())
+        if pending_count:
+            st.caption(f"{pending_count} 件は評価指標を計算中のため、BLEUなどの指標の分析に含まれていません。")
 
     accuracy_labels = {1.0: '正確', 0.5: '部分的に正確', 0.0: '不正確'}
     analysis_df['正確性'] = analysis_df['is_correct'].map(accuracy_labels)
@@ -222,7 +253,7 @@ def display_metrics_analysis(history_df):
 
     # 全体の評価指標の統計
     st.write("##### 評価指標の統計")
-    stats_cols = ['response_time', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
+    stats_cols = ['response_time', 'ttft', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
     valid_stats_cols = [c for c in stats_cols if c in analysis_df.columns and analysis_df[c].notna().any()]
     if valid_stats_cols:
         metrics_stats = analysis_df[valid_stats_cols].describe()
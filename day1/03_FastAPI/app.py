@@ -1,25 +1,103 @@
-import os
-import torch
-from transformers import pipeline
 import time
+_import_start = time.perf_counter()  # 起動時間の内訳を計測するため最初に記録
+import os
+import sys
+import json
+import asyncio
 import traceback
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from typing import Optional, List, Dict, Any
+from contextlib import asynccontextmanager
 import uvicorn
-import nest_asyncio
-from pyngrok import ngrok
+# torch / transformers / pyngrok / nest_asyncio は使うときに読み込み、プロセスをすぐに起動できるようにする
+from batching import BatchResult, BatchScheduler, params_key
+from executor import InferenceExecutor, QueueFullError, init_worker, call_worker_pipeline, call_with_worker_pipeline
+from cache import ResponseCache, SingleFlight, make_cache_key
+from registry import ModelRegistry, UnknownModelError
+from engine import ContinuousBatchingEngine
+from speculative import SpeculativeStats, check_draft_compatible, speculative_generate
+from scheduler import PRIORITIES, DeadlineExceededError, TokenBudgetScheduler, estimate_cost
+import monitoring
+
+# 02_streamlit_app と共有する day1/common を読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.prefix_cache import PrefixKVCache, generate_with_prefix_cache
+from common.cpu_profile import create_cpu_pipeline, is_onnx_model
+from common.inference import GenerationTimer, clean_response, generate_texts
+from sessions import SessionStore, generate_chat_turn
+from tokenization import PromptTooLongError, TokenizedPromptCache, context_window, prepare_prompt
 
 # --- 設定 ---
 # モデル名を設定
-MODEL_NAME = "google/gemma-2-2b-jpn-it"  # お好みのモデルに変更可能です
+# お好みのモデルに変更可能です（環境変数 LLM_MODEL_NAME でも指定できます。ベンチマークでは小さなモデルのパスを指定します）
+MODEL_NAME = os.environ.get("LLM_MODEL_NAME", "google/gemma-2-2b-jpn-it")
 print(f"モデル名を設定: {MODEL_NAME}")
 
 # --- モデル設定クラス ---
 class Config:
     def __init__(self, model_name=MODEL_NAME):
-        self.MODEL_NAME = model_name
+        self.MODEL_NAME = model_name  # デフォルトモデル（常にメモリに保持する）
+        # リクエストで指定できるモデルの一覧（デフォルトモデルは常に含まれる）
+        self.AVAILABLE_MODELS = [model_name]
+        self.MODEL_MEMORY_BUDGET_BYTES = 16 * 1024 ** 3  # 読み込み済みモデルの合計メモリの上限
+        # GPUがない場合の推論プロファイル: "default"（float32）, "int8"（動的量子化）, "onnx"（ONNX Runtime）
+        self.CPU_PROFILE = os.environ.get("LLM_CPU_PROFILE", "default")
+        self.CPU_NUM_THREADS = None  # torchのスレッド数（Noneなら利用できるコア数から決める）
+        self.ONNX_EXPORT_DIR = None  # onnx プロファイルで書き出したモデルの保存先（次回の起動で再利用する）
+        # 動的バッチングの設定
+        self.BATCH_MAX_SIZE = 8        # 1回のパイプライン呼び出しでまとめる最大リクエスト数
+        self.BATCH_MAX_WAIT_MS = 10.0  # 最初のリクエストから追加のリクエストを待つ最大時間（ミリ秒）
+        self.BATCH_ENDPOINT_SUB_BATCH_SIZE = 16  # /generate/batch で1回のパイプライン呼び出しに渡す件数
+        # ウォームアップの設定（モデル読み込み後、readyにする前に短い生成を1回実行する）
+        self.WARMUP_PROMPT = "こんにちは"
+        self.WARMUP_MAX_NEW_TOKENS = 8
+        # 推論ワーカーの設定
+        self.EXECUTOR_KIND = "thread"  # "thread" または "process"（プロセスではワーカーごとにモデルを読み込む）
+        self.EXECUTOR_MAX_WORKERS = 1  # 推論を並行実行するワーカー数
+        self.MAX_QUEUE_SIZE = 32       # 同時に受け付けるリクエストの上限。超えると429を返す
+        self.RETRY_AFTER_SECONDS = 5   # 429応答のRetry-Afterヘッダーに設定する秒数
+        # 応答キャッシュの設定（do_sample=Falseのリクエストのみ対象）
+        self.CACHE_ENABLED = True
+        self.CACHE_MAX_ENTRIES = 1024
+        self.CACHE_TTL_SECONDS = 3600
+        self.CACHE_MAX_BYTES = 64 * 1024 * 1024
+        self.CACHE_PERSIST_PATH = None  # 例: "response_cache.db" を指定すると再起動後もキャッシュを保持
+        # 接頭辞KVキャッシュの設定（共通のシステムプロンプトなどのプリフィルを省略する）
+        self.PREFIX_CACHE_ENABLED = True
+        self.PREFIX_CACHE_MAX_BYTES = 512 * 1024 ** 2  # モデルごとのKVキャッシュの合計バイト数の上限
+        self.PREFIX_CACHE_BLOCK_SIZE = 16              # 接頭辞を区切るトークン数
+        # 連続バッチングの設定（有効にするとデフォルトモデルの/generateはデコードのステップ単位でバッチを組み替える）
+        self.CONTINUOUS_BATCHING_ENABLED = False
+        self.ENGINE_MAX_BATCH_SIZE = 8         # 同時に生成する系列数の上限
+        self.ENGINE_MAX_TOKENS_PER_STEP = 512  # 1ステップで処理するトークン数の上限（デコード + プリフィル）
+        # 投機的デコーディングの設定（do_sample=False の1件ずつの生成で、ドラフトモデルの提案を本体がまとめて検証する）
+        self.SPECULATIVE_DRAFT_MODEL = os.environ.get("LLM_DRAFT_MODEL_NAME")  # 本体と同じトークナイザーの小さなモデル（Noneなら無効）
+        self.SPECULATIVE_LOOKAHEAD = 4  # ドラフトモデルが1回に提案するトークン数
+        # プロンプトのトークン化の設定（推論の前にトークン化し、コンテキスト長を確認する）
+        self.PROMPT_TOKEN_CACHE_ENTRIES = 4096                # トークン化したプロンプトを保持する件数
+        self.PROMPT_TOKEN_CACHE_MAX_BYTES = 64 * 1024 * 1024
+        self.MAX_CONTEXT_TOKENS = None  # コンテキスト長（Noneならモデルの設定から取得する）
+        self.PROMPT_OVERFLOW = "reject"  # 長すぎるプロンプトの扱い: "reject"（400を返す）または "truncate"（先頭を削る）
+        # /chat の会話セッションの設定（会話のトークン列とKVキャッシュをサーバー側で保持する）
+        self.CHAT_MAX_CONTEXT_TOKENS = 4096          # 会話（プロンプト + 生成）のトークン数の上限。超えると古いターンから削除する
+        self.CHAT_KV_CACHE_ENABLED = True            # ターン間でKVキャッシュを保持し、追加分だけをプリフィルする
+        self.CHAT_MAX_SESSIONS = 1000
+        self.CHAT_SESSION_MAX_BYTES = 1024 ** 3      # 全セッションのKVキャッシュ等の合計バイト数の上限
+        self.CHAT_SESSION_IDLE_SECONDS = 1800        # この時間使われなかったセッションは削除する
+        # 停止処理の設定（新しいリクエストの受付を止め、実行中・待機中の生成が終わるまで待ってから停止する）
+        self.SHUTDOWN_DRAIN_TIMEOUT_SECONDS = 30  # 生成の完了を待つ最大時間（秒）
+        self.METRICS_SNAPSHOT_PATH = os.environ.get("LLM_METRICS_SNAPSHOT_PATH")  # 停止時にメトリクスを書き出すファイル
+        # トークン予算スケジューラの設定（コスト = プロンプトのトークン数 + max_new_tokens）
+        self.SCHEDULER_MAX_INFLIGHT_TOKENS = 8192  # 同時に実行するリクエストのコストの合計の上限
+        self.SCHEDULER_MAX_TOKENS_PER_KEY = 4096   # 1つのAPIキーが同時に使えるコストの上限（Noneなら無制限）
+        self.SCHEDULER_KEY_WEIGHTS = {}            # APIキーごとの配分の重み（例: {"premium-key": 2.0}）
+        self.SCHEDULER_INITIAL_TOKENS_PER_SECOND = 20.0  # 実績がないときに締め切りの判定に使うスループット
+        self.API_KEY_HEADER = "X-API-Key"          # 公平な配分の単位とするAPIキーのヘッダー
+        # ストリーミングの設定
+        self.STREAM_TOKEN_TIMEOUT_SECONDS = 300.0  # 生成が始まった後、次のテキストが届くまで待つ最大時間（秒）
 
 config = Config(MODEL_NAME)
 
@@ -39,39 +117,163 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# リクエスト数とレイテンシを記録するミドルウェアを追加
+app.add_middleware(monitoring.MetricsMiddleware)
+
 # --- データモデル定義 ---
 class Message(BaseModel):
     role: str
     content: str
 
+# max_new_tokens を省略した（nullを指定した）場合の生成トークン数の上限
+DEFAULT_MAX_NEW_TOKENS = 512
+
+def default_max_new_tokens(value):
+    """max_new_tokens に null が指定された場合は既定値にする（トークン化やコストの見積もりで数値が必要なため）"""
+    return DEFAULT_MAX_NEW_TOKENS if value is None else value
+
 # 直接プロンプトを使用した簡略化されたリクエスト
 class SimpleGenerationRequest(BaseModel):
     prompt: str
-    max_new_tokens: Optional[int] = 512
+    model: Optional[str] = None  # 使用するモデル名（省略時はデフォルトモデル）
+    max_new_tokens: Optional[int] = DEFAULT_MAX_NEW_TOKENS
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    priority: Optional[str] = "interactive"  # "interactive"（対話）または "batch"（後回しにしてよい処理）
+    deadline_ms: Optional[float] = None      # この時間内に生成を終えられない場合は早めに拒否する（ミリ秒）
+    truncate_prompt: Optional[bool] = None   # 長すぎるプロンプトの先頭を削る（Noneなら Config.PROMPT_OVERFLOW に従う）
+
+    _default_max_new_tokens = field_validator("max_new_tokens")(default_max_new_tokens)
+
+# 会話の新しいメッセージを送るリクエスト（session_id を省略すると新しい会話を始める）
+class ChatRequest(BaseModel):
+    messages: List[Message]             # 追加するメッセージ（新しい会話ではsystemメッセージを含めてもよい）
+    session_id: Optional[str] = None
+    model: Optional[str] = None
+    max_new_tokens: Optional[int] = DEFAULT_MAX_NEW_TOKENS
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+    priority: Optional[str] = "interactive"
+    deadline_ms: Optional[float] = None
+
+    _default_max_new_tokens = field_validator("max_new_tokens")(default_max_new_tokens)
+
+class ChatResponse(BaseModel):
+    session_id: str
+    message: Message                    # アシスタントの応答
+    response_time: float
+    model: Optional[str] = None
+    prompt_tokens: int = 0              # 会話全体のプロンプトのトークン数
+    prefill_tokens: int = 0             # このターンで実際にプリフィルしたトークン数
+    reused_tokens: int = 0              # KVキャッシュを再利用したトークン数
+    completion_tokens: int = 0
+    truncated: bool = False             # 上限を超えたため古いターンを削除した場合はTrue
+    scheduler_wait: float = 0.0
 
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    model: Optional[str] = None  # 生成に使用したモデル名
+    queue_time: float = 0.0  # バッチ処理が始まるまでキューで待った時間（秒）
+    batch_size: int = 1      # まとめて処理されたリクエスト数
+    cached: bool = False     # 応答キャッシュから返された場合はTrue
+    scheduler_wait: float = 0.0  # スケジューラで推論の開始を待った時間（秒）
+    prompt_tokens: int = 0       # プロンプトのトークン数（切り詰めた場合は切り詰め後）
+    completion_tokens: int = 0   # 生成したテキストのトークン数
+    prompt_truncated: bool = False  # コンテキスト長に収めるためプロンプトの先頭を削った場合はTrue
+
+# バッチ生成の結果（1件分）
+class BatchItemResult(BaseModel):
+    index: int                            # 入力リスト内の位置
+    generated_text: Optional[str] = None
+    response_time: float = 0.0            # この項目を含むサブバッチの推論時間（秒）
+    queue_time: float = 0.0               # バッチ受付からサブバッチ開始までの時間（秒）
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    prompt_truncated: bool = False
+    error: Optional[str] = None           # 失敗した場合のエラー内容
+
+class BatchGenerationResponse(BaseModel):
+    results: List[BatchItemResult]
+    total_time: float
+    succeeded: int
+    failed: int
 
 # --- モデル関連の関数 ---
 # モデルのグローバル変数
 model = None
+# モデルの状態: "loading"（読み込み・ウォームアップ中）, "ready"（利用可能）, "failed"（読み込み失敗）
+model_status = "loading"
+model_error = None
+# 起動処理の各フェーズにかかった時間（秒）
+startup_timings = {}
 
-def load_model():
-    """推論用のLLMモデルを読み込む"""
-    global model  # グローバル変数を更新するために必要
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"使用デバイス: {device}")
+def import_inference_libraries():
+    """torch と transformers を読み込み、初回の読み込み時間を startup_timings に記録する"""
+    if "import_torch_transformers" in startup_timings:
+        return
+    import_start = time.perf_counter()
+    import torch  # noqa: F401
+    # transformers はクラスを参照したときに各モジュールを読み込むため、モデルの読み込みで使うものをここで参照する
+    from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline  # noqa: F401
+    startup_timings["import_torch_transformers"] = time.perf_counter() - import_start
+
+def create_pipeline(model_name):
+    """テキスト生成パイプラインを作成する（プロセスワーカーからも呼び出される）"""
+    import_inference_libraries()
+    import torch
+    from transformers import pipeline
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"使用デバイス: {device}")
+    if device == "cpu":
+        # CPUではbfloat16が遅いため、CPU向けのプロファイル（float32 / int8動的量子化 / ONNX Runtime）で読み込む
+        onnx_dir = None
+        if config.ONNX_EXPORT_DIR:
+            onnx_dir = os.path.join(config.ONNX_EXPORT_DIR, model_name.replace("/", "--"))
+        pipe = create_cpu_pipeline(model_name, config.CPU_PROFILE, config.CPU_NUM_THREADS, onnx_dir=onnx_dir)
+    else:
         pipe = pipeline(
             "text-generation",
-            model=config.MODEL_NAME,
+            model=model_name,
             model_kwargs={"torch_dtype": torch.bfloat16},
             device=device
         )
+    # バッチ推論のためにパディングを設定（デコーダのみのモデルは左詰めが必要）
+    if pipe.tokenizer.pad_token_id is None:
+        pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+    pipe.tokenizer.padding_side = "left"
+    return pipe
+
+def load_registered_model(model_name):
+    """レジストリから呼び出されるモデルの読み込み関数（読み込み時間をメトリクスに記録する）"""
+    # ライブラリの読み込み時間は startup_timings に別に記録し、モデルの読み込み時間に含めない
+    import_inference_libraries()
+    load_start = time.perf_counter()
+    pipe = create_pipeline(model_name)
+    load_time = time.perf_counter() - load_start
+    monitoring.MODEL_LOAD_SECONDS.set(load_time, model=model_name)
+    print(f"モデル '{model_name}' の読み込み時間: {load_time:.2f}秒")
+    return pipe
+
+# 複数モデルを名前で管理するレジストリ（デフォルトモデル以外は最初のリクエスト時に読み込む）
+model_registry = ModelRegistry(
+    load_registered_model,
+    default_model=config.MODEL_NAME,
+    memory_budget_bytes=config.MODEL_MEMORY_BUDGET_BYTES,
+    allowed_models=config.AVAILABLE_MODELS,
+)
+
+def load_model():
+    """推論用のLLMモデル（デフォルトモデル）を読み込む"""
+    global model  # グローバル変数を更新するために必要
+    try:
+        import_inference_libraries()
+        load_start = time.perf_counter()
+        pipe = model_registry.get(config.MODEL_NAME)
+        startup_timings["model_load"] = time.perf_counter() - load_start
         print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
         model = pipe  # グローバル変数を更新
         return pipe
@@ -81,64 +283,547 @@ def load_model():
         traceback.print_exc()  # 詳細なエラー情報を出力
         return None
 
-def extract_assistant_response(outputs, user_prompt):
-    """モデルの出力からアシスタントの応答を抽出する"""
-    assistant_response = ""
+# --- 推論ワーカー ---
+# 推論はワーカープールで実行し、イベントループ（/healthなど）をブロックしない
+inference_executor = InferenceExecutor(
+    kind=config.EXECUTOR_KIND,
+    max_workers=config.EXECUTOR_MAX_WORKERS,
+    max_queue_size=config.MAX_QUEUE_SIZE,
+    retry_after=config.RETRY_AFTER_SECONDS,
+    initializer=init_worker,
+    initargs=(create_pipeline, config.MODEL_NAME),
+)
+
+# --- モデルの選択 ---
+def resolve_model_name(name):
+    """リクエストで指定されたモデル名を確定する。利用できないモデルなら HTTPException を送出する"""
     try:
-        if outputs and isinstance(outputs, list) and len(outputs) > 0 and outputs[0].get("generated_text"):
-            generated_output = outputs[0]["generated_text"]
-            
-            if isinstance(generated_output, list):
-                # メッセージフォーマットの場合
-                if len(generated_output) > 0:
-                    last_message = generated_output[-1]
-                    if isinstance(last_message, dict) and last_message.get("role") == "assistant":
-                        assistant_response = last_message.get("content", "").strip()
-                    else:
-                        # 予期しないリスト形式の場合は最後の要素を文字列として試行
-                        print(f"警告: 最後のメッセージの形式が予期しないリスト形式です: {last_message}")
-                        assistant_response = str(last_message).strip()
-
-            elif isinstance(generated_output, str):
-                # 文字列形式の場合
-                full_text = generated_output
-                
-                # 単純なプロンプト入力の場合、プロンプト後の全てを抽出
-                if user_prompt:
-                    prompt_end_index = full_text.find(user_prompt)
-                    if prompt_end_index != -1:
-                        prompt_end_pos = prompt_end_index + len(user_prompt)
-                        assistant_response = full_text[prompt_end_pos:].strip()
-                    else:
-                        # 元のプロンプトが見つからない場合は、生成されたテキストをそのまま返す
-                        assistant_response = full_text
-                else:
-                    assistant_response = full_text
-            else:
-                print(f"警告: 予期しない出力タイプ: {type(generated_output)}")
-                assistant_response = str(generated_output).strip()  # 文字列に変換
+        resolved = model_registry.resolve(name)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if inference_executor.kind == "process" and resolved != config.MODEL_NAME:
+        raise HTTPException(status_code=400, detail="プロセスワーカーではデフォルトモデルのみ利用できます。")
+    return resolved
+
+@asynccontextmanager
+async def acquire_pipeline(model_name):
+    """推論中にモデルが削除されないよう確保して、パイプラインを返す"""
+    if inference_executor.kind == "process":
+        yield call_worker_pipeline
+        return
+    # 未読み込みのモデルは読み込みに時間がかかるため別スレッドで確保する
+    pipe = await asyncio.to_thread(model_registry.acquire, model_name)
+    try:
+        yield pipe
+    finally:
+        model_registry.release(model_name)
+
+def generation_params(request: SimpleGenerationRequest, model_name):
+    """リクエストから生成パラメータ（モデル名を含む）を作成する"""
+    return {
+        "model": model_name,
+        "max_new_tokens": request.max_new_tokens,
+        "do_sample": request.do_sample,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+    }
+
+# --- プロンプトのトークン化 ---
+prompt_token_cache = TokenizedPromptCache(
+    max_entries=config.PROMPT_TOKEN_CACHE_ENTRIES,
+    max_bytes=config.PROMPT_TOKEN_CACHE_MAX_BYTES,
+)
+
+def tokenizer_pipeline(model_name=None):
+    """トークン化に使うパイプラインとそのモデル名（未読み込みのモデルはデフォルトモデルのトークナイザーで見積もる）"""
+    if model_name and model_name != config.MODEL_NAME and model_registry.is_loaded(model_name):
+        return model_registry.get(model_name), model_name
+    return model, config.MODEL_NAME
+
+def prompt_token_ids(prompt, model_name=None):
+    """プロンプトのトークンID列を返す（同じプロンプトは再びトークン化しない）"""
+    pipe, name = tokenizer_pipeline(model_name)
+    return prompt_token_cache.encode(pipe.tokenizer, name, prompt)
+
+def context_limit(model_name=None):
+    """モデルのコンテキスト長（Config.MAX_CONTEXT_TOKENS が指定されていればそれ以下にする）"""
+    pipe, _ = tokenizer_pipeline(model_name)
+    window = context_window(pipe)
+    if config.MAX_CONTEXT_TOKENS:
+        return min(window, config.MAX_CONTEXT_TOKENS) if window else config.MAX_CONTEXT_TOKENS
+    return window
+
+def tokenize_request(request: SimpleGenerationRequest, model_name):
+    """
+    推論の前にプロンプトをトークン化し、コンテキスト長を超える場合は拒否または先頭を削る
+
+    Returns:
+        TokenizedPrompt: トークン化済みのプロンプト（長すぎて拒否する場合は400の HTTPException を送出する）
+    """
+    truncate = request.truncate_prompt if request.truncate_prompt is not None else config.PROMPT_OVERFLOW == "truncate"
+    pipe, name = tokenizer_pipeline(model_name)
+    try:
+        tokenized = prepare_prompt(prompt_token_cache, pipe.tokenizer, name, request.prompt, request.max_new_tokens,
+                                   context_limit(model_name), overflow="truncate" if truncate else "reject")
+    except PromptTooLongError as e:
+        monitoring.PROMPT_OVERFLOWS.inc(action="reject")
+        print(f"プロンプトが長すぎるため拒否しました: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    if tokenized.truncated:
+        monitoring.PROMPT_OVERFLOWS.inc(action="truncate")
+        print(f"プロンプトの先頭を削りました: {tokenized.original_tokens} -> {tokenized.token_count}トークン")
+    return tokenized
+
+async def run_inference(prompts, params, timer=None):
+    """
+    指定モデルでプロンプトのリストを推論し、プロンプトごとの (生成された部分のテキスト, 生成したトークン数) を返す
+    （params["model"]でモデルを指定。timer にはプリフィルとデコードの時間を計測する GenerationTimer を渡せる）
+
+    生成結果のトークンIDからプロンプトの部分を切り落としてデコードするため、出力からプロンプトを探す必要がなく、
+    生成したトークン数もテキストをトークン化し直さずに得られる
+    """
+    generate_kwargs = {key: value for key, value in params.items() if key != "model"}
+    if inference_executor.kind == "process":
+        # 別プロセスには timer を渡せないため計測しない
+        texts, counts = await inference_executor.run(call_with_worker_pipeline, generate_texts, prompts,
+                                                     return_token_counts=True, **generate_kwargs)
+    else:
+        async with acquire_pipeline(params["model"]) as pipe:
+            texts, counts = await inference_executor.run(generate_texts, pipe, prompts, streamer=timer,
+                                                          return_token_counts=True, **generate_kwargs)
+    return [(clean_response(text), count) for text, count in zip(texts, counts)]
 
+# --- バッチ推論 ---
+async def run_pipeline_batch(prompts, params):
+    """まとめられたプロンプトをパイプラインで一度に推論し、プロンプトごとの (テキスト, 生成したトークン数) を返す"""
+    print(f"バッチ推論を開始: {len(prompts)}件, params={params}")
+    inference_start = time.perf_counter()
+    timer = GenerationTimer()
+    if use_speculative(prompts, params):
+        # 貪欲法ではドラフトモデルの提案をまとめて検証し、本体のモデルの順伝播の回数を減らす
+        outputs = [await run_speculative(prompts[0], params)]
+    elif len(prompts) == 1 and config.PREFIX_CACHE_ENABLED and inference_executor.kind == "thread" \
+            and config.CPU_PROFILE != "onnx":
+        # 1件だけのときは接頭辞KVキャッシュを使い、共通の接頭辞のプリフィルを省略する
+        outputs = [await run_with_prefix_cache(prompts[0], params, timer)]
+    else:
+        outputs = await run_inference(prompts, params, timer)
+    inference_time = time.perf_counter() - inference_start
+    record_generation_metrics("generate", inference_time, prompts, [count for _, count in outputs], params["model"])
+    record_phase_times("generate", timer.prefill_time, timer.decode_time)
+    return outputs
+
+# --- 投機的デコーディング ---
+# デフォルトモデル用のドラフトモデル（読み込み後に設定する）
+draft_pipe = None
+speculative_stats = SpeculativeStats()
+
+def load_draft_model():
+    """ドラフトモデルを読み込む。本体と語彙が異なるなど利用できない場合はNoneを返す"""
+    global draft_pipe
+    if not config.SPECULATIVE_DRAFT_MODEL or inference_executor.kind != "thread" or is_onnx_model(model.model):
+        return None
+    try:
+        pipe = create_pipeline(config.SPECULATIVE_DRAFT_MODEL)
+        check_draft_compatible(model.model, pipe.model)
+    except Exception as e:
+        print(f"警告: ドラフトモデル '{config.SPECULATIVE_DRAFT_MODEL}' を利用できません。投機的デコーディングは無効です: {e}")
+        return None
+    draft_pipe = pipe
+    print(f"ドラフトモデル '{config.SPECULATIVE_DRAFT_MODEL}' を読み込みました（先読み: {config.SPECULATIVE_LOOKAHEAD}トークン）")
+    return draft_pipe
+
+def use_speculative(prompts, params):
+    """投機的デコーディングを使うかどうか（貪欲法の1件ずつの生成で、デフォルトモデルの場合のみ）"""
+    return (draft_pipe is not None and len(prompts) == 1 and not params["do_sample"]
+            and params["model"] == config.MODEL_NAME)
+
+async def run_speculative(prompt, params):
+    """投機的デコーディングで1件のプロンプトから生成し、受理率をメトリクスに記録する（(テキスト, 生成したトークン数) を返す）"""
+    async with acquire_pipeline(params["model"]) as pipe:
+        input_ids = list(prompt_token_ids(prompt, params["model"]))
+        eos_token_id = pipe.model.generation_config.eos_token_id
+        eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        stats = SpeculativeStats()
+        token_ids = await inference_executor.run(
+            speculative_generate, pipe.model, draft_pipe.model, input_ids,
+            max_new_tokens=params["max_new_tokens"], lookahead=config.SPECULATIVE_LOOKAHEAD,
+            eos_token_ids=[token for token in eos_token_ids if token is not None], stats=stats)
+        text = pipe.tokenizer.decode(token_ids, skip_special_tokens=True)
+    speculative_stats.add(stats)
+    record_phase_times("generate", stats.prefill_time, stats.elapsed - stats.prefill_time)
+    monitoring.SPECULATIVE_PROPOSED_TOKENS.inc(stats.proposed)
+    monitoring.SPECULATIVE_ACCEPTED_TOKENS.inc(stats.accepted)
+    if stats.proposed:
+        monitoring.SPECULATIVE_ACCEPTANCE_RATE.observe(stats.acceptance_rate)
+    if stats.target_forwards:
+        monitoring.SPECULATIVE_TOKENS_PER_FORWARD.observe(stats.tokens_per_target_forward)
+    return clean_response(text), len(token_ids)
+
+# --- 接頭辞KVキャッシュ ---
+# KVキャッシュはモデルごとに異なるため、モデル名ごとに持つ
+prefix_caches = {}
+
+def get_prefix_cache(model_name):
+    """モデルの接頭辞KVキャッシュを返す"""
+    if model_name not in prefix_caches:
+        prefix_caches[model_name] = PrefixKVCache(
+            max_bytes=config.PREFIX_CACHE_MAX_BYTES,
+            block_size=config.PREFIX_CACHE_BLOCK_SIZE,
+        )
+    return prefix_caches[model_name]
+
+async def run_with_prefix_cache(prompt, params, timer=None):
+    """接頭辞KVキャッシュを使って1件のプロンプトから生成する（(テキスト, 生成したトークン数) を返す）"""
+    model_name = params["model"]
+    generate_kwargs = {key: value for key, value in params.items() if key != "model"}
+    async with acquire_pipeline(model_name) as pipe:
+        input_ids = list(prompt_token_ids(prompt, model_name))
+        text, count = await inference_executor.run(
+            generate_with_prefix_cache, pipe, input_ids, get_prefix_cache(model_name), streamer=timer,
+            return_token_count=True, **generate_kwargs)
+    return clean_response(text), count
+
+def record_generation_metrics(endpoint, inference_time, prompts, output_counts, model_name=None):
+    """推論1回分のトークン数（output_counts は生成したトークン数のリスト）と生成速度をメトリクスに記録する"""
+    monitoring.INFERENCE_TIME.observe(inference_time, endpoint=endpoint)
+    for prompt in prompts:
+        monitoring.PROMPT_TOKENS.observe(len(prompt_token_ids(prompt, model_name)))
+    for count in output_counts:
+        monitoring.OUTPUT_TOKENS.observe(count)
+    total_output = sum(output_counts)
+    monitoring.GENERATED_TOKENS_TOTAL.inc(total_output)
+    if inference_time > 0:
+        monitoring.TOKENS_PER_SECOND.observe(total_output / inference_time, endpoint=endpoint)
+
+def record_phase_times(endpoint, prefill_time, decode_time):
+    """プリフィル（最初のトークンまで）とデコードの時間をメトリクスに記録する（計測できなかった値はNone）"""
+    if prefill_time is not None:
+        monitoring.PREFILL_TIME.observe(prefill_time, endpoint=endpoint)
+    if decode_time is not None:
+        monitoring.DECODE_TIME.observe(decode_time, endpoint=endpoint)
+
+# --- 連続バッチング ---
+# デフォルトモデルの読み込み後に作成する（スレッドワーカーの場合のみ）
+decode_engine = None
+
+def start_decode_engine(pipe):
+    """連続バッチングのエンジンを作成して開始する"""
+    global decode_engine
+    if not config.CONTINUOUS_BATCHING_ENABLED or inference_executor.kind != "thread" or is_onnx_model(pipe.model):
+        return None
+    if decode_engine is None:
+        decode_engine = ContinuousBatchingEngine(
+            pipe.model,
+            pipe.tokenizer,
+            max_batch_size=config.ENGINE_MAX_BATCH_SIZE,
+            max_tokens_per_step=config.ENGINE_MAX_TOKENS_PER_STEP,
+        )
+        print("連続バッチングのエンジンを開始しました")
+    decode_engine.start()
+    return decode_engine
+
+async def run_with_engine(prompt, params):
+    """連続バッチングのエンジンで1件のプロンプトから生成する"""
+    generate_kwargs = {key: value for key, value in params.items() if key != "model"}
+    input_ids = list(prompt_token_ids(prompt))
+    result = await decode_engine.generate(input_ids, **generate_kwargs)
+    text = clean_response(result.text)
+    record_generation_metrics("generate", result.total_time - result.queue_time, [prompt], [result.generated_tokens])
+    record_phase_times("generate", result.ttft - result.queue_time, result.total_time - result.ttft)
+    return BatchResult(output=(text, result.generated_tokens), queue_time=result.queue_time, batch_size=max(decode_engine.running, 1))
+
+# --- トークン予算スケジューラ ---
+class MonitoredTokenScheduler(TokenBudgetScheduler):
+    """受け付けの判定と待ち時間をメトリクスに記録するスケジューラ"""
+
+    async def acquire(self, cost, priority="interactive", deadline_seconds=None, api_key=None):
+        try:
+            ticket = await super().acquire(cost, priority, deadline_seconds, api_key)
+        except DeadlineExceededError as e:
+            decision = "expired" if e.expired else "rejected_deadline"
+            monitoring.SCHEDULER_DECISIONS.inc(decision=decision, priority=priority)
+            print(f"スケジューラがリクエストを拒否しました ({decision}): {e}")
+            raise
+        monitoring.SCHEDULER_DECISIONS.inc(decision="admitted", priority=priority)
+        monitoring.SCHEDULER_WAIT_TIME.observe(ticket.wait_time, priority=priority)
+        monitoring.REQUEST_COST.observe(cost, priority=priority)
+        return ticket
+
+token_scheduler = MonitoredTokenScheduler(
+    max_inflight_tokens=config.SCHEDULER_MAX_INFLIGHT_TOKENS,
+    max_tokens_per_key=config.SCHEDULER_MAX_TOKENS_PER_KEY,
+    key_weights=config.SCHEDULER_KEY_WEIGHTS,
+    initial_tokens_per_second=config.SCHEDULER_INITIAL_TOKENS_PER_SECOND,
+)
+
+def request_api_key(http_request: Request):
+    """公平な配分の単位とするAPIキーをヘッダーから取り出す"""
+    return http_request.headers.get(config.API_KEY_HEADER)
+
+def validate_priority(priority):
+    """優先度クラスを確認する。未知の値なら HTTPException を送出する"""
+    priority = priority or "interactive"
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority は {', '.join(PRIORITIES)} のいずれかを指定してください。")
+    return priority
+
+def deadline_seconds(deadline_ms):
+    """リクエストの締め切り（ミリ秒）をスケジューラに渡す秒数にする"""
+    return deadline_ms / 1000 if deadline_ms is not None else None
+
+def deadline_response(e: DeadlineExceededError):
+    """締め切りに間に合わないときの503応答を作成する"""
+    return JSONResponse(
+        status_code=503,
+        # error でキューの混雑などによる503と区別できるようにする（クライアントは再試行しない）
+        content={"detail": str(e), "error": "deadline_exceeded", "estimated_seconds": e.estimated_seconds,
+                 "deadline_seconds": e.deadline_seconds},
+    )
+
+batch_scheduler = BatchScheduler(
+    run_pipeline_batch,
+    max_batch_size=config.BATCH_MAX_SIZE,
+    max_wait_ms=config.BATCH_MAX_WAIT_MS,
+)
+
+# --- 応答キャッシュ ---
+response_cache = ResponseCache(
+    max_entries=config.CACHE_MAX_ENTRIES,
+    ttl_seconds=config.CACHE_TTL_SECONDS,
+    max_bytes=config.CACHE_MAX_BYTES,
+    persist_path=config.CACHE_PERSIST_PATH,
+) if config.CACHE_ENABLED else None
+
+def cached_response_value(text, completion_tokens):
+    """キャッシュに保存する値（テキストと生成したトークン数）"""
+    return json.dumps({"text": text, "completion_tokens": completion_tokens}, ensure_ascii=False)
+
+def parse_cached_response(value):
+    """キャッシュの値から (テキスト, 生成したトークン数) を取り出す（以前の形式のテキストだけの値も読む）"""
+    if value is None:
+        return None
+    try:
+        entry = json.loads(value)
+    except ValueError:
+        entry = None
+    if not isinstance(entry, dict):
+        return value, 0
+    return entry["text"], entry.get("completion_tokens", 0)
+
+# --- 会話セッション ---
+chat_sessions = SessionStore(
+    max_sessions=config.CHAT_MAX_SESSIONS,
+    max_bytes=config.CHAT_SESSION_MAX_BYTES,
+    idle_ttl_seconds=config.CHAT_SESSION_IDLE_SECONDS,
+)
+
+def chat_context_limit(pipe):
+    """会話のトークン数の上限（モデルのコンテキスト長を超えないようにする）"""
+    window = context_window(pipe)
+    return min(config.CHAT_MAX_CONTEXT_TOKENS, window) if window else config.CHAT_MAX_CONTEXT_TOKENS
+
+# 同一プロンプトの同時リクエストを1回の生成にまとめる
+inflight_requests = SingleFlight()
+
+# --- モデルの読み込み（バックグラウンド） ---
+model_load_task = None
+
+async def load_model_in_background():
+    """モデルの読み込みとウォームアップをバックグラウンドで行い、状態を更新する"""
+    global model_status, model_error
+    model_status = "loading"
+    model_error = None
+    print("モデルの読み込みをバックグラウンドで開始...")
+
+    # 読み込みはブロックするため別スレッドで実行し、その間も/healthなどに応答できるようにする
+    loaded_pipe = await asyncio.to_thread(load_model)
+    if loaded_pipe is None:
+        model_status = "failed"
+        model_error = f"モデル '{config.MODEL_NAME}' の読み込みに失敗しました"
+        print("警告: モデルの初期化に失敗しました")
+        return
+
+    try:
+        # 短い生成を1回実行し、カーネルやキャッシュを事前に準備する
+        # （プロセスワーカーは最初のタスクでモデルを読み込むため、ここで読み込ませておく）
+        warmup_start = time.perf_counter()
+        pipe = call_worker_pipeline if inference_executor.kind == "process" else loaded_pipe
+        await inference_executor.run(pipe, config.WARMUP_PROMPT,
+                                     max_new_tokens=config.WARMUP_MAX_NEW_TOKENS, do_sample=False)
+        startup_timings["warmup"] = time.perf_counter() - warmup_start
     except Exception as e:
-        print(f"応答の抽出中にエラーが発生しました: {e}")
+        # ウォームアップに失敗してもモデル自体は使えるため、警告のみ出す
+        print(f"警告: ウォームアップ中にエラーが発生しました: {e}")
         traceback.print_exc()
-        assistant_response = "応答の抽出に失敗しました。"  # エラーメッセージを設定
 
-    if not assistant_response:
-        print("警告: アシスタントの応答を抽出できませんでした。完全な出力:", outputs)
-        # デフォルトまたはエラー応答を返す
-        assistant_response = "応答を生成できませんでした。"
+    if config.SPECULATIVE_DRAFT_MODEL:
+        await asyncio.to_thread(load_draft_model)
+    start_decode_engine(loaded_pipe)
+    model_status = "ready"
+    print("モデルの初期化が完了しました。起動時間の内訳:")
+    for phase, seconds in startup_timings.items():
+        print(f"  - {phase}: {seconds:.2f}秒")
+
+def start_model_loading():
+    """モデルの読み込みタスクを開始する（実行中であれば何もしない）"""
+    global model_load_task
+    if model_load_task is None or model_load_task.done():
+        model_load_task = asyncio.create_task(load_model_in_background())
+    return model_load_task
+
+# --- 停止処理（ドレイン） ---
+# Trueの間は新しい生成を受け付けず、/health は503を返す（ロードバランサーに振り分け先から外してもらう）
+draining = False
+drain_started_at = None
 
-    return assistant_response
+def begin_draining(reason):
+    """新しい生成の受付を止める"""
+    global draining, drain_started_at
+    if not draining:
+        draining = True
+        drain_started_at = time.time()
+        print(f"停止処理を開始しました（{reason}）。新しいリクエストの受付を停止します。")
+
+def inflight_work():
+    """実行中・待機中の生成の件数"""
+    return {
+        "admitted_requests": inference_executor.queue_depth,
+        "batch_pending": batch_scheduler.pending,
+        "engine_running": decode_engine.running if decode_engine is not None else 0,
+        "engine_pending": decode_engine.pending if decode_engine is not None else 0,
+    }
+
+async def drain(timeout):
+    """受付を止め、実行中・待機中の生成が終わるまで最大 timeout 秒待つ。すべて終わればTrueを返す"""
+    begin_draining("shutdown")
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = inflight_work()
+        if not any(remaining.values()):
+            print(f"実行中の生成はすべて完了しました（{time.time() - drain_started_at:.2f}秒）")
+            return True
+        if time.perf_counter() >= deadline:
+            print(f"警告: {timeout}秒以内に完了しなかった生成を中断します: {remaining}")
+            return False
+        await asyncio.sleep(0.1)
+
+def flush_state():
+    """停止前にキャッシュとメトリクスをディスクに書き出す"""
+    if response_cache is not None:
+        # 永続化している応答キャッシュの接続を閉じる（書き込みは set のたびにコミット済み）
+        response_cache.close()
+    if config.METRICS_SNAPSHOT_PATH:
+        try:
+            with open(config.METRICS_SNAPSHOT_PATH, "w", encoding="utf-8") as f:
+                f.write(monitoring.registry.render())
+            print(f"メトリクスを書き出しました: {config.METRICS_SNAPSHOT_PATH}")
+        except OSError as e:
+            print(f"警告: メトリクスを書き出せませんでした: {e}")
+
+def ensure_model_ready():
+    """モデルが利用可能でなければ503を送出する。読み込みに失敗していれば再読み込みを開始する"""
+    if draining:
+        raise HTTPException(
+            status_code=503,
+            detail="サーバーは停止処理中のため、新しいリクエストを受け付けていません。",
+            headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)},
+        )
+    if model_status == "ready" and model is not None:
+        return
+    if model_status == "failed":
+        print("モデルの読み込みに失敗しているため、バックグラウンドで再読み込みを開始します。")
+        start_model_loading()
+    raise HTTPException(
+        status_code=503,
+        detail=f"モデルが利用できません（状態: {model_status}）。後でもう一度お試しください。",
+        headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)},
+    )
+
+# --- ストリーミング ---
+# 生成を実行中のストリーミングのタスク（完了するまで参照を保持する）
+stream_tasks = set()
+
+class StreamLease:
+    """
+    ストリーミング1件が確保した推論ワーカーの枠・スケジューラの予算・モデルをまとめて解放する
+
+    close() は何度呼んでも1回だけ解放します。生成が実行中の場合は中止を要求し、
+    推論ワーカーのスレッドで生成が止まってから解放します（止まる前に次のリクエストに枠を渡さない）。
+    """
+
+    def __init__(self, ticket, model_name, prompt_tokens):
+        self.ticket = ticket
+        self.model_name = model_name
+        self.prompt_tokens = prompt_tokens
+        self.generation = None
+        self.task = None
+        self.closed = False
+
+    def start(self, generation):
+        """推論ワーカーのスレッドプールで生成を開始する"""
+        self.generation = generation
+        self.task = asyncio.ensure_future(inference_executor.run(generation.run))
+        stream_tasks.add(self.task)
+        self.task.add_done_callback(stream_tasks.discard)
+
+    def close(self, completed=False):
+        """
+        確保した資源を解放する
+
+        Args:
+            completed (bool): 生成を最後まで返したかどうか。切断・失敗の場合はFalse（スループットの推定に含めない）
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.generation is not None and not completed:
+            self.generation.cancel()
+        if self.task is None or self.task.done():
+            self._release(completed)
+        else:
+            self.task.add_done_callback(lambda _: self._release(completed))
+
+    def _release(self, completed):
+        generated_tokens = self.generation.streamer.generated_tokens if self.generation is not None else 0
+        token_scheduler.release(self.ticket, completed=completed, tokens=self.prompt_tokens + generated_tokens)
+        model_registry.release(self.model_name)
+        inference_executor.release()
+
+class LeasedStreamingResponse(StreamingResponse):
+    """
+    送信を終えたときに StreamLease を解放するStreamingResponse
+
+    本文を読み出す前にクライアントが切断した場合など、ジェネレーターの finally が
+    実行されないときも資源を解放します。
+    """
+
+    def __init__(self, content, lease, **kwargs):
+        super().__init__(content, **kwargs)
+        self.lease = lease
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.lease.close()
 
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
-    else:
-        print("起動時にモデルの初期化が完了しました。")
+    """起動時にモデルの読み込みをバックグラウンドで開始（読み込み完了を待たずにリクエストを受け付ける）"""
+    batch_scheduler.start()
+    start_model_loading()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時に実行中の生成の完了を待ってから、スケジューラと推論ワーカーを停止し、キャッシュとメトリクスを書き出す"""
+    await drain(config.SHUTDOWN_DRAIN_TIMEOUT_SECONDS)
+    await batch_scheduler.stop()
+    if decode_engine is not None:
+        decode_engine.stop(timeout=5)
+    inference_executor.shutdown(wait=False)
+    flush_state()
 
 @app.get("/")
 async def root():
@@ -149,41 +834,121 @@ async def root():
 async def health_check():
     """ヘルスチェックエンドポイント"""
     global model
-    if model is None:
-        return {"status": "error", "message": "No model loaded"}
+    queue = {
+        "model_status": model_status,
+        "startup_timings": startup_timings,
+        "queue_depth": inference_executor.queue_depth,
+        "batch_pending": batch_scheduler.pending,
+        "max_queue_size": inference_executor.max_queue_size,
+        "cache": response_cache.stats() if response_cache is not None else None,
+        "coalesced_requests": inflight_requests.coalesced,
+        "models": model_registry.stats(),
+        "prefix_cache": {name: cache.stats() for name, cache in prefix_caches.items()},
+        "engine": decode_engine.stats() if decode_engine is not None else None,
+        "scheduler": token_scheduler.stats(),
+        "prompt_token_cache": prompt_token_cache.stats(),
+        "chat_sessions": chat_sessions.stats(),
+        "speculative": speculative_stats.to_dict() if draft_pipe is not None else None,
+    }
+    if draining:
+        # 停止処理中は503を返し、新しいリクエストが振り分けられないようにする
+        return JSONResponse(status_code=503, content={
+            "status": "draining", "message": "Server is shutting down",
+            "draining_seconds": time.time() - drain_started_at, "inflight": inflight_work(), **queue})
+    if model_status == "loading":
+        return {"status": "loading", "message": "Model is loading", **queue}
+    if model_status == "failed" or model is None:
+        return {"status": "error", "message": model_error or "No model loaded", **queue}
+
+    return {"status": "ok", "model": config.MODEL_NAME, **queue}
 
-    return {"status": "ok", "model": config.MODEL_NAME}
+def queue_full_response(e: QueueFullError):
+    """キューが満杯のときの429応答を作成する"""
+    print(f"リクエストを拒否しました: {e}")
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "サーバーが混雑しています。しばらくしてから再試行してください。", "queue_depth": e.queue_depth},
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_simple(request: SimpleGenerationRequest):
+async def generate_simple(request: SimpleGenerationRequest, http_request: Request):
     """単純なプロンプト入力に基づいてテキストを生成"""
     global model
 
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+    ensure_model_ready()
+    model_name = resolve_model_name(request.model)
+    priority = validate_priority(request.priority)
+
+    start_time = time.time()
+    # モデルでの処理の前にトークン化し、長すぎるプロンプトはここで拒否（または先頭を削る）
+    tokenized = tokenize_request(request, model_name)
+    if tokenized.truncated:
+        request = request.model_copy(update={"prompt": tokenized.prompt})
+    params = generation_params(request, model_name)
+
+    # 決定的な生成は同じキーの生成をまとめ（キャッシュの設定によらない）、キャッシュが有効ならキャッシュ済みの応答を返す
+    request_key = make_cache_key(model_name, request.prompt, params) if not request.do_sample else None
+    if response_cache is not None and request_key is not None:
+        cached = parse_cached_response(response_cache.get(request_key))
+        if cached is not None:
+            cached_text, completion_tokens = cached
+            print(f"キャッシュヒット: prompt={request.prompt[:100]}...")
+            return GenerationResponse(
+                generated_text=cached_text,
+                response_time=time.time() - start_time,
+                model=model_name,
+                batch_size=0,
+                cached=True,
+                prompt_tokens=tokenized.token_count,
+                completion_tokens=completion_tokens,
+                prompt_truncated=tokenized.truncated,
+            )
+
+    async def generate_and_cache():
+        with inference_executor.admit():
+            # 推定コストに応じて、優先度・APIキーごとの配分の順に推論を開始する
+            async with token_scheduler.slot(estimate_cost(tokenized.token_count, request.max_new_tokens), priority,
+                                            deadline_seconds(request.deadline_ms),
+                                            request_api_key(http_request)) as ticket:
+                response = await _generate_simple(request, params, start_time)
+                ticket.processed_tokens = tokenized.token_count + response.completion_tokens
+            response.scheduler_wait = ticket.wait_time
+            response.prompt_tokens = tokenized.token_count
+            response.prompt_truncated = tokenized.truncated
+        if response_cache is not None and request_key is not None:
+            response_cache.set(request_key, cached_response_value(response.generated_text, response.completion_tokens))
+        return response
 
     try:
-        start_time = time.time()
+        if request_key is None:
+            return await generate_and_cache()
+        # 同じキーの生成が実行中であれば、その結果を受け取る
+        response = await inflight_requests.do(request_key, generate_and_cache)
+        return response.model_copy(update={"response_time": time.time() - start_time})
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except DeadlineExceededError as e:
+        return deadline_response(e)
+
+async def _generate_simple(request: SimpleGenerationRequest, params, start_time):
+    """受け付け済みのリクエストに対してテキストを生成する"""
+    try:
         print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
 
-        # プロンプトテキストで直接応答を生成
+        # 同時に届いた他のリクエストとまとめて応答を生成
         print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=request.do_sample,
-            temperature=request.temperature,
-            top_p=request.top_p,
-        )
-        print("モデル推論が完了しました。")
+        if decode_engine is not None and params["model"] == config.MODEL_NAME:
+            # 連続バッチング: 他の系列の終了を待たずにデコード中のバッチへ加わる
+            result = await run_with_engine(request.prompt, params)
+        else:
+            result = await batch_scheduler.submit(request.prompt, params)
+        print(f"モデル推論が完了しました。(バッチサイズ: {result.batch_size}, 待ち時間: {result.queue_time:.3f}秒)")
+        monitoring.QUEUE_TIME.observe(result.queue_time)
 
-        # アシスタント応答を抽出
-        assistant_response = extract_assistant_response(outputs, request.prompt)
+        # アシスタント応答（バッチ処理内で抽出済み）
+        assistant_response, completion_tokens = result.output
         print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
 
         end_time = time.time()
@@ -192,7 +957,11 @@ async def generate_simple(request: SimpleGenerationRequest):
 
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            response_time=response_time,
+            model=params["model"],
+            queue_time=result.queue_time,
+            batch_size=result.batch_size,
+            completion_tokens=completion_tokens,
         )
 
     except Exception as e:
@@ -200,23 +969,363 @@ async def generate_simple(request: SimpleGenerationRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
 
-def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
+# ストリーミングエンドポイント
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest, http_request: Request):
+    """生成されたトークンをServer-Sent Eventsで逐次返す"""
     global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    loaded_pipe = load_model()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
+
+    ensure_model_ready()
+    model_name = resolve_model_name(request.model)
+    if inference_executor.kind == "process":
+        raise HTTPException(status_code=400, detail="プロセスワーカーではストリーミングを利用できません。")
+    priority = validate_priority(request.priority)
+    tokenized = tokenize_request(request, model_name)
+
+    from streaming import StreamingGeneration, format_sse  # transformersを必要とするため遅延読み込み
+
+    try:
+        inference_executor.acquire()
+    except QueueFullError as e:
+        return queue_full_response(e)
+
+    print(f"ストリーミングリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")
+    try:
+        ticket = await token_scheduler.acquire(estimate_cost(tokenized.token_count, request.max_new_tokens), priority,
+                                               deadline_seconds(request.deadline_ms), request_api_key(http_request))
+    except DeadlineExceededError as e:
+        inference_executor.release()
+        return deadline_response(e)
+    except BaseException:
+        inference_executor.release()
+        raise
+
+    try:
+        pipe = await asyncio.to_thread(model_registry.acquire, model_name)
+    except Exception as e:
+        token_scheduler.release(ticket, completed=False)
+        inference_executor.release()
+        print(f"モデル '{model_name}' の準備中にエラーが発生しました: {e}")
+        raise HTTPException(status_code=503, detail=f"モデル '{model_name}' を利用できません: {str(e)}")
+
+    # ここから先で確保した資源は lease.close() でまとめて解放する
+    lease = StreamLease(ticket, model_name, tokenized.token_count)
+    try:
+        generation = StreamingGeneration(
+            pipe,
+            tokenized.prompt,
+            max_new_tokens=request.max_new_tokens,
+            do_sample=request.do_sample,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            timeout=config.STREAM_TOKEN_TIMEOUT_SECONDS,
+            loop=asyncio.get_running_loop(),
+        )
+    except Exception as e:
+        lease.close()
+        print(f"ストリーミング生成の準備中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+
+    async def event_stream():
+        # 生成は送信を始めてから推論ワーカーで開始する（送信前に切断された場合は生成しない）
+        lease.start(generation)
+        completed = False
+        try:
+            try:
+                async for chunk in generation:
+                    if await http_request.is_disconnected():
+                        print("クライアントが切断されたため、生成を中止します。")
+                        return
+                    if chunk:
+                        yield format_sse({"text": chunk}, event="token")
+            except TimeoutError:
+                # 送信を始めた後なのでステータスコードでは返せない。エラーのイベントで通知する
+                print(f"ストリーミング生成が {config.STREAM_TOKEN_TIMEOUT_SECONDS}秒以上進まないため中止します。")
+                yield format_sse({"detail": f"応答の生成が {config.STREAM_TOKEN_TIMEOUT_SECONDS}秒以上進まなかったため中止しました。"},
+                                 event="error")
+                return
+            # 統計とエラーが確定するまで生成の終了を待つ（キャンセルされても生成のタスクは止めない）
+            await asyncio.shield(lease.task)
+
+            if generation.error is not None:
+                yield format_sse({"detail": f"応答の生成中にエラーが発生しました: {generation.error}"}, event="error")
+            else:
+                stats = {**generation.stats(), "prompt_tokens": tokenized.token_count,
+                         "prompt_truncated": tokenized.truncated}
+                print(f"ストリーミング生成完了: TTFT={stats['ttft']}, {stats['tokens_per_second']:.2f} tokens/s, 合計 {stats['total_time']:.2f}秒")
+                record_stream_metrics(stats)
+                completed = True
+                yield format_sse(stats, event="done")
+        finally:
+            # 切断・失敗の場合は生成を中止し、生成が止まってから資源を解放する
+            lease.close(completed)
+
+    return LeasedStreamingResponse(event_stream(), lease, media_type="text/event-stream")
+
+# 会話エンドポイント
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, http_request: Request):
+    """会話の新しいメッセージを受け取り、サーバー側で保持した会話の続きとして応答を生成する"""
+    ensure_model_ready()
+    if inference_executor.kind == "process":
+        raise HTTPException(status_code=400, detail="プロセスワーカーでは /chat を利用できません。")
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="messages を1件以上指定してください。")
+    priority = validate_priority(request.priority)
+
+    if request.session_id is None:
+        session = chat_sessions.create(resolve_model_name(request.model))
     else:
-        print("load_model_task: モデルの読み込みに失敗しました。")
+        session = chat_sessions.get(request.session_id)
+        if session is None:
+            # 期限切れなどで削除された場合、クライアントは会話全体を送り直して新しいセッションを始める
+            raise HTTPException(status_code=404, detail=f"セッション '{request.session_id}' が見つかりません。"
+                                "会話全体を messages に指定して、新しいセッションを開始してください。")
+        if request.model is not None and resolve_model_name(request.model) != session.model_name:
+            raise HTTPException(status_code=400, detail="セッションの途中でモデルは変更できません。")
+
+    start_time = time.time()
+    new_messages = [message.model_dump() for message in request.messages]
+    print(f"チャットリクエストを受信: session={session.session_id}, 追加メッセージ {len(new_messages)}件")
+    cost = estimate_cost(sum(len(prompt_token_ids(message["content"], session.model_name)) for message in new_messages),
+                         request.max_new_tokens)
+    completed = False
+    try:
+        with inference_executor.admit():
+            # 同じ会話のターンは順番に処理する
+            async with session.lock:
+                async with token_scheduler.slot(cost, priority, deadline_seconds(request.deadline_ms),
+                                                request_api_key(http_request)) as ticket:
+                    async with acquire_pipeline(session.model_name) as pipe:
+                        inference_start = time.perf_counter()
+                        result = await inference_executor.run(
+                            generate_chat_turn, pipe, session, new_messages, chat_context_limit(pipe),
+                            max_new_tokens=request.max_new_tokens, do_sample=request.do_sample,
+                            temperature=request.temperature, top_p=request.top_p,
+                            use_kv_cache=config.CHAT_KV_CACHE_ENABLED and not is_onnx_model(pipe.model))
+                        inference_time = time.perf_counter() - inference_start
+                    ticket.processed_tokens = result["prefill_tokens"] + result["completion_tokens"]
+                chat_sessions.update(session)
+        completed = True
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except DeadlineExceededError as e:
+        return deadline_response(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"チャット応答の生成中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+    finally:
+        # 最初のターンが失敗した場合は、空のセッションを残さない
+        if not completed and request.session_id is None:
+            chat_sessions.delete(session.session_id)
+
+    text = clean_response(result["text"])
+    record_generation_metrics("chat", inference_time, [], [result["completion_tokens"]])
+    monitoring.PROMPT_TOKENS.observe(result["prompt_tokens"])
+    monitoring.CHAT_PREFILL_TOKENS.inc(result["prefill_tokens"])
+    monitoring.CHAT_REUSED_TOKENS.inc(result["reused_tokens"])
+    print(f"チャット応答を生成しました: プリフィル {result['prefill_tokens']}トークン"
+          f"（再利用 {result['reused_tokens']}トークン）, {inference_time:.2f}秒")
+    return ChatResponse(
+        session_id=session.session_id,
+        message=Message(role="assistant", content=text),
+        response_time=time.time() - start_time,
+        model=session.model_name,
+        prompt_tokens=result["prompt_tokens"],
+        prefill_tokens=result["prefill_tokens"],
+        reused_tokens=result["reused_tokens"],
+        completion_tokens=result["completion_tokens"],
+        truncated=result["truncated"],
+        scheduler_wait=ticket.wait_time,
+    )
+
+@app.get("/chat/{session_id}")
+async def get_chat_session(session_id: str):
+    """会話セッションの状態（メッセージとトークン数）を返す"""
+    session = chat_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"セッション '{session_id}' が見つかりません。")
+    return {**session.to_dict(), "history": session.messages}
+
+@app.delete("/chat/{session_id}")
+async def delete_chat_session(session_id: str):
+    """会話セッションを削除し、KVキャッシュのメモリを解放する"""
+    if not chat_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"セッション '{session_id}' が見つかりません。")
+    return {"status": "deleted", "session_id": session_id}
+
+# バッチ生成エンドポイント
+@app.post("/generate/batch", response_model=BatchGenerationResponse)
+async def generate_batch(requests: List[SimpleGenerationRequest], http_request: Request):
+    """複数のプロンプトを長さ順のサブバッチにまとめて生成し、入力順で返す"""
+    global model
+
+    ensure_model_ready()
+
+    print(f"バッチリクエストを受信: {len(requests)}件")
+    try:
+        with inference_executor.admit():
+            return await _generate_batch(requests, request_api_key(http_request))
+    except QueueFullError as e:
+        return queue_full_response(e)
+
+def plan_sub_batches(requests: List[SimpleGenerationRequest], sub_batch_size):
+    """
+    同じモデル・生成パラメータのリクエストを長さ順に並べ、パディングが少なくなるようにサブバッチへ分割する
+
+    長すぎるプロンプトは、その項目だけをエラーにする（切り詰める設定の場合は requests の項目を切り詰め後に置き換える）
+
+    Returns:
+        tuple: (サブバッチのリスト [(params, インデックスのリスト)], 利用できない項目のエラー {index: メッセージ},
+                項目ごとのトークン化済みプロンプト {index: TokenizedPrompt})
+    """
+    groups = {}
+    errors = {}
+    tokenized = {}
+    for index, req in enumerate(requests):
+        try:
+            model_name = resolve_model_name(req.model)
+            tokenized[index] = tokenize_request(req, model_name)
+            params = generation_params(req, model_name)
+        except HTTPException as e:
+            errors[index] = e.detail
+            continue
+        if tokenized[index].truncated:
+            requests[index] = req.model_copy(update={"prompt": tokenized[index].prompt})
+        groups.setdefault(params_key(params), (params, []))[1].append(index)
+
+    sub_batches = []
+    for params, indices in groups.values():
+        indices.sort(key=lambda i: tokenized[i].token_count)
+        for start in range(0, len(indices), sub_batch_size):
+            sub_batches.append((params, indices[start:start + sub_batch_size]))
+    return sub_batches, errors, tokenized
+
+async def _generate_batch(requests: List[SimpleGenerationRequest], api_key=None):
+    """受け付け済みのバッチリクエストを処理する（サブバッチごとに "batch" の優先度でスケジュールする）"""
+    start_time = time.perf_counter()
+    results = [BatchItemResult(index=i) for i in range(len(requests))]
+    sub_batches, errors, tokenized = plan_sub_batches(requests, config.BATCH_ENDPOINT_SUB_BATCH_SIZE)
+    for i, message in errors.items():
+        results[i].error = message
+    for i, prompt in tokenized.items():
+        results[i].prompt_tokens = prompt.token_count
+        results[i].prompt_truncated = prompt.truncated
+
+    async def run(indices, params):
+        prompts = [requests[i].prompt for i in indices]
+        cost = sum(estimate_cost(tokenized[i].token_count, requests[i].max_new_tokens) for i in indices)
+        async with token_scheduler.slot(cost, "batch", api_key=api_key) as ticket:
+            sub_batch_start = time.perf_counter()
+            timer = GenerationTimer()
+            outputs = await run_inference(prompts, params, timer)
+            inference_time = time.perf_counter() - sub_batch_start
+            ticket.processed_tokens = sum(tokenized[i].token_count + count for i, (_, count) in zip(indices, outputs))
+        record_generation_metrics("batch", inference_time, prompts, [count for _, count in outputs], params["model"])
+        record_phase_times("batch", timer.prefill_time, timer.decode_time)
+        for i, (text, count) in zip(indices, outputs):
+            results[i].generated_text = text
+            results[i].completion_tokens = count
+            results[i].response_time = inference_time
+            results[i].queue_time = sub_batch_start - start_time
+
+    for params, indices in sub_batches:
+        try:
+            await run(indices, params)
+        except Exception as e:
+            print(f"サブバッチの生成中にエラーが発生しました（{len(indices)}件）: {e}")
+            if len(indices) == 1:
+                results[indices[0]].error = str(e)
+                continue
+            # どの項目が原因か切り分けるため、1件ずつ再実行する
+            for i in indices:
+                try:
+                    await run([i], params)
+                except Exception as item_error:
+                    print(f"バッチ項目 {i} の生成に失敗しました: {item_error}")
+                    results[i].error = str(item_error)
+
+    failed = sum(1 for r in results if r.error is not None)
+    total_time = time.perf_counter() - start_time
+    print(f"バッチ生成完了: {len(requests)}件（失敗 {failed}件）, {total_time:.2f}秒")
+    return BatchGenerationResponse(
+        results=results,
+        total_time=total_time,
+        succeeded=len(requests) - failed,
+        failed=failed,
+    )
 
-print("FastAPIエンドポイントを定義しました。")
+def record_stream_metrics(stats):
+    """ストリーミング生成の統計をメトリクスに記録する（TTFTをプリフィル時間とみなす）"""
+    if stats["ttft"] is not None:
+        monitoring.PREFILL_TIME.observe(stats["ttft"], endpoint="stream")
+        monitoring.DECODE_TIME.observe(stats["total_time"] - stats["ttft"], endpoint="stream")
+    monitoring.INFERENCE_TIME.observe(stats["total_time"], endpoint="stream")
+    monitoring.OUTPUT_TOKENS.observe(stats["generated_tokens"])
+    monitoring.GENERATED_TOKENS_TOTAL.inc(stats["generated_tokens"])
+    monitoring.TOKENS_PER_SECOND.observe(stats["tokens_per_second"], endpoint="stream")
+
+@app.get("/models")
+async def list_models():
+    """利用可能なモデルと読み込み済みモデルの状態を返す"""
+    return {
+        "available": sorted(model_registry.allowed_models or [config.MODEL_NAME]),
+        **model_registry.stats(),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus形式のメトリクスを返す"""
+    # スケジューラの現在の状態をゲージに反映してから出力する
+    monitoring.SCHEDULER_INFLIGHT_TOKENS.set(token_scheduler.inflight_tokens)
+    monitoring.CHAT_SESSIONS.set(len(chat_sessions))
+    monitoring.CHAT_SESSION_BYTES.set(chat_sessions.total_bytes)
+    for priority in PRIORITIES:
+        monitoring.SCHEDULER_QUEUED.set(token_scheduler.queued(priority), priority=priority)
+    return PlainTextResponse(monitoring.registry.render(), media_type="text/plain; version=0.0.4")
+
+startup_timings["module_import"] = time.perf_counter() - _import_start
+print(f"FastAPIエンドポイントを定義しました。(モジュール読み込み: {startup_timings['module_import']:.2f}秒)")
+
+# --- サーバーの実行 ---
+class DrainingServer(uvicorn.Server):
+    """停止シグナル（SIGTERM / Ctrl+C）を受けたらすぐに新しい生成の受付を止めるuvicornサーバー"""
+
+    def handle_exit(self, sig, frame):
+        begin_draining(f"シグナル {sig}")
+        super().handle_exit(sig, frame)
+
+def run_server(host="0.0.0.0", port=8501):
+    """
+    実行中のリクエストを待ってから停止するuvicornサーバーでアプリを実行する
+
+    停止シグナルを受けると新しい接続を受け付けなくなり、実行中のリクエストの完了を
+    最大 SHUTDOWN_DRAIN_TIMEOUT_SECONDS 秒待ってから、shutdownイベントで残りの処理を片付ける
+    """
+    server_config = uvicorn.Config(
+        app,
+        host=host,
+        port=port,
+        log_level="info",
+        timeout_graceful_shutdown=config.SHUTDOWN_DRAIN_TIMEOUT_SECONDS,
+    )
+    DrainingServer(server_config).run()
+
+def run_local(port=8501, host="127.0.0.1"):
+    """ngrokを使わずにローカルでAPIサーバーを実行する（ベンチマーク用）"""
+    print(f"ローカルでAPIサーバーを起動します: http://{host}:{port} (APIドキュメント: http://{host}:{port}/docs)")
+    run_server(host=host, port=port)
 
 # --- ngrokでAPIサーバーを実行する関数 ---
 def run_with_ngrok(port=8501):
     """ngrokでFastAPIアプリを実行"""
+    import nest_asyncio
+    from pyngrok import ngrok
+
     nest_asyncio.apply()
 
     ngrok_token = os.environ.get("NGROK_TOKEN")
@@ -261,7 +1370,7 @@ def run_with_ngrok(port=8501):
         print(f"📖 APIドキュメント (Swagger UI): {public_url}/docs")
         print("---------------------------------------------------------------------")
         print("(APIクライアントやブラウザからアクセスするためにこのURLをコピーしてください)")
-        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")  # ログレベルをinfoに設定
+        run_server(host="0.0.0.0", port=port)
 
     except Exception as e:
         print(f"\n ngrokまたはUvicornの起動中にエラーが発生しました: {e}")
@@ -278,7 +1387,18 @@ def run_with_ngrok(port=8501):
 
 # --- メイン実行ブロック ---
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="ローカルLLM APIサーバー")
+    parser.add_argument("--local", action="store_true", help="ngrokを使わずにローカルで実行する（ベンチマーク用）")
+    parser.add_argument("--host", default="127.0.0.1", help="--local で待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=8501)
+    args = parser.parse_args()
+
     # 指定されたポートでサーバーを起動
-    run_with_ngrok(port=8501)  # このポート番号を確認
+    if args.local:
+        run_local(port=args.port, host=args.host)
+    else:
+        run_with_ngrok(port=args.port)  # このポート番号を確認
     # run_with_ngrokが終了したときにメッセージを表示
     print("\nサーバープロセスが終了しました。")
\ No newline at end of file
@@ -0,0 +1,134 @@
+# batching.py
+# 短い時間窓の中で届いたリクエストをまとめ、1回のパイプライン呼び出しで処理するためのモジュールです
+import asyncio
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+@dataclass
+class BatchResult:
+    """バッチ処理の結果（リクエスト1件分）"""
+    output: Any
+    queue_time: float  # キューに入ってからバッチ処理が始まるまでの時間（秒）
+    batch_size: int    # 実際にまとめて処理されたリクエスト数
+
+
+@dataclass
+class _PendingRequest:
+    prompt: Any
+    params: Dict[str, Any]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+def params_key(params):
+    """サンプリングパラメータを比較可能なキーに変換する"""
+    return tuple(sorted(params.items()))
+
+
+class BatchScheduler:
+    """
+    動的マイクロバッチングのスケジューラ
+
+    最初のリクエストが届いてから最大 max_wait_ms ミリ秒、または max_batch_size 件に
+    達するまでリクエストを集め、サンプリングパラメータが同じものごとに runner を1回呼び出します。
+    runner は (プロンプトのリスト, パラメータ) を受け取り、プロンプトと同じ順序で
+    出力のリストを返すコルーチン関数です。
+    """
+
+    def __init__(self, runner: Callable[[List[Any], Dict[str, Any]], Awaitable[List[Any]]],
+                 max_batch_size=8, max_wait_ms=10.0):
+        self.runner = runner
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = None
+        self._task = None
+
+    @property
+    def pending(self):
+        """キューで待機中のリクエスト数"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        """スケジューラのループを開始する（イベントループ内で呼び出す）"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """スケジューラのループを停止する"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, prompt, params) -> BatchResult:
+        """リクエストをキューに追加し、バッチ処理の結果を待つ"""
+        if self._task is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingRequest(prompt, dict(params), future))
+        return await future
+
+    async def _collect_batch(self):
+        """時間窓の中で届いたリクエストを集める"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                # 待ち時間は過ぎたが、すでにキューにあるものは取り込む
+                if self._queue.empty():
+                    break
+                batch.append(self._queue.get_nowait())
+                continue
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _loop(self):
+        while True:
+            batch = await self._collect_batch()
+
+            # 同じサンプリングパラメータのリクエストだけを同じバッチにまとめる
+            groups: Dict[tuple, List[_PendingRequest]] = {}
+            for item in batch:
+                groups.setdefault(params_key(item.params), []).append(item)
+
+            for items in groups.values():
+                await self._run_group(items)
+
+    async def _run_group(self, items: List[_PendingRequest]):
+        # 待機中にクライアントが切断されたリクエストは処理しない
+        items = [item for item in items if not item.future.done()]
+        if not items:
+            return
+
+        started_at = time.perf_counter()
+        try:
+            outputs = await self.runner([item.prompt for item in items], items[0].params)
+            if len(outputs) != len(items):
+                raise RuntimeError(f"バッチ出力の件数が一致しません: 入力 {len(items)} 件, 出力 {len(outputs)} 件")
+        except Exception as e:
+            print(f"バッチ処理中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        for item, output in zip(items, outputs):
+            if not item.future.done():
+                item.future.set_result(BatchResult(
+                    output=output,
+                    queue_time=started_at - item.enqueued_at,
+                    batch_size=len(items),
+                ))
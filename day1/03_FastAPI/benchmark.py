@@ -0,0 +1,387 @@
+# benchmark.py
+# LLM API（/generate, /generate/stream）の処理能力を測定する負荷生成・ベンチマークツールです
+# 使い方:
+#   python benchmark.py --url https://xxxx.ngrok.app --users 4 --requests 40
+#   python benchmark.py --url http://localhost:8000 --qps 2 --duration 60 --prompts ../../day3/data/llm04_eng.json
+#   python benchmark.py --local --requests 30 --output result.json   # 小さなモデルでローカルサーバーを起動して測定
+#   python benchmark.py --local --baseline result.json --max-regression 0.2  # 前回の結果より悪化していれば終了コード1
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PROMPTS_FILE = os.path.join(BASE_DIR, "..", "..", "day3", "data", "llm04_eng.json")
+
+
+def load_client_module():
+    """ファイル名にハイフンを含む python-client.py をモジュールとして読み込む"""
+    spec = importlib.util.spec_from_file_location("python_client", os.path.join(BASE_DIR, "python-client.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# --- プロンプトの準備 ---
+def load_prompts(path):
+    """
+    プロンプトのリストを読み込む
+
+    JSON（文字列のリスト、または "content" / "prompt" / "question" を持つオブジェクトのリスト）と
+    JSONL（1行に1つのJSON）に対応します。
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    prompts = []
+    for item in items:
+        if isinstance(item, str):
+            prompts.append(item)
+        elif isinstance(item, dict):
+            for key in ("prompt", "content", "question"):
+                if item.get(key):
+                    prompts.append(item[key])
+                    break
+    if not prompts:
+        raise ValueError(f"プロンプトが見つかりません: {path}")
+    return prompts
+
+
+def synthetic_prompts(lengths, count, seed=0):
+    """指定した文字数のプロンプトを合成する（長さごとの性能を比べるため）"""
+    rng = random.Random(seed)
+    words = ["AI", "モデル", "推論", "学習", "データ", "評価", "言語", "生成", "速度", "精度"]
+    prompts = []
+    for i in range(count):
+        length = lengths[i % len(lengths)]
+        body = ""
+        while len(body) < length:
+            body += rng.choice(words)
+        prompts.append(f"次の文章を要約してください: {body[:length]}")
+    return prompts
+
+
+def percentile(values, q):
+    """値のリストのパーセンタイル（q は0〜100）を返す"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(values):
+    if not values:
+        return None
+    return {
+        "mean": statistics.mean(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+# --- 負荷の生成 ---
+class BenchmarkRunner:
+    """クライアントからリクエストを送信し、1件ごとの結果を記録する"""
+
+    def __init__(self, client, endpoint, generation_kwargs):
+        self.client = client
+        self.endpoint = endpoint
+        self.generation_kwargs = generation_kwargs
+        self.records = []
+
+    async def send(self, index, prompt, scheduled_at=None):
+        """1件送信して結果を記録する（scheduled_at は固定QPSで送信する予定だった時刻）"""
+        start = time.perf_counter()
+        record = {
+            "index": index,
+            "prompt_chars": len(prompt),
+            "start": start,
+            # 送信が予定より遅れた分（クライアント側の遅れ）も記録する
+            "send_delay": start - scheduled_at if scheduled_at is not None else 0.0,
+            "ok": False,
+        }
+        try:
+            if self.endpoint == "stream":
+                generated_tokens, text = None, ""
+                async for event in self.client.stream(prompt, **self.generation_kwargs):
+                    if event["event"] == "token":
+                        text += event["data"].get("text", "")
+                    elif event["event"] == "done":
+                        generated_tokens = event["data"].get("generated_tokens")
+                        record.update(ok=True, ttft=event["data"]["timing"]["ttft"], retries=event["data"]["timing"]["retries"])
+                    else:
+                        record["error"] = event["data"].get("detail")
+                record["output_chars"] = len(text)
+            else:
+                result = await self.client.generate(prompt, **self.generation_kwargs)
+                generated_tokens = result.get("completion_tokens")
+                record.update(ok=True, ttft=None, retries=result["timing"]["retries"],
+                              output_chars=len(result.get("generated_text", "")))
+            record["generated_tokens"] = generated_tokens
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            record["status_code"] = getattr(e, "status_code", None)
+        record["latency"] = time.perf_counter() - start
+        self.records.append(record)
+
+    async def run_fixed_qps(self, prompts, qps, num_requests, duration, poisson=False, seed=0):
+        """開ループ: 応答を待たずに一定のQPSで送信する"""
+        rng = random.Random(seed)
+        tasks = []
+        start = time.perf_counter()
+        next_at = start
+        index = 0
+        while (num_requests is None or index < num_requests) and (duration is None or next_at - start < duration):
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.send(index, prompts[index % len(prompts)], scheduled_at=next_at)))
+            index += 1
+            next_at += rng.expovariate(qps) if poisson else 1.0 / qps
+        await asyncio.gather(*tasks)
+
+    async def run_closed_loop(self, prompts, users, num_requests, duration):
+        """閉ループ: N人のユーザーがそれぞれ応答を受け取ってから次のリクエストを送信する"""
+        start = time.perf_counter()
+        counter = iter(range(num_requests if num_requests is not None else sys.maxsize))
+
+        async def user():
+            for index in counter:
+                if duration is not None and time.perf_counter() - start >= duration:
+                    break
+                await self.send(index, prompts[index % len(prompts)])
+
+        await asyncio.gather(*(user() for _ in range(users)))
+
+
+def summarize(records, elapsed):
+    """記録からスループット・トークン/秒・TTFT・レイテンシのパーセンタイルを計算する"""
+    succeeded = [r for r in records if r["ok"]]
+    tokens = [r["generated_tokens"] for r in succeeded if r.get("generated_tokens") is not None]
+    ttfts = [r["ttft"] for r in succeeded if r.get("ttft") is not None]
+    errors = {}
+    for r in records:
+        if not r["ok"]:
+            key = str(r.get("status_code") or r.get("error", "unknown"))[:80]
+            errors[key] = errors.get(key, 0) + 1
+    return {
+        "requests": len(records),
+        "succeeded": len(succeeded),
+        "failed": len(records) - len(succeeded),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(succeeded) / elapsed if elapsed > 0 else 0.0,
+        # トークン数が分からない場合（/generate でサーバーが返さない場合）はNone
+        "tokens_per_second": sum(tokens) / elapsed if tokens and elapsed > 0 else None,
+        "generated_tokens": sum(tokens) if tokens else None,
+        "ttft": latency_summary(ttfts),
+        "latency": latency_summary([r["latency"] for r in succeeded]),
+        "retries": sum(r.get("retries") or 0 for r in records),
+        "max_send_delay": max((r["send_delay"] for r in records), default=0.0),
+    }
+
+
+# --- ローカルサーバー ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_local_server(model_path=None, port=None, timeout=300):
+    """
+    小さなモデルでAPIサーバーを別プロセスで起動し、(プロセス, URL) を返す
+
+    model_path を省略すると、ダウンロード不要のランダム初期化モデルを一時ディレクトリに作成します。
+    """
+    if model_path is None:
+        sys.path.append(os.path.join(BASE_DIR, ".."))
+        from common.tiny_model import save_tiny_model
+        model_path = save_tiny_model(os.path.join(tempfile.mkdtemp(prefix="tiny_model_"), "model"))
+    port = port or free_port()
+    env = dict(os.environ, LLM_MODEL_NAME=model_path)
+    process = subprocess.Popen(
+        [sys.executable, "app.py", "--local", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BASE_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    print(f"ローカルサーバーを起動しています: {url} (モデル: {model_path})")
+
+    import httpx
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"ローカルサーバーが終了しました (終了コード: {process.returncode})")
+        try:
+            if httpx.get(f"{url}/health", timeout=2).json().get("status") == "ok":
+                return process, url
+        except (httpx.HTTPError, ValueError):
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise TimeoutError("ローカルサーバーの起動がタイムアウトしました")
+
+
+# --- 比較 ---
+def compare_with_baseline(summary, baseline_path, max_regression):
+    """前回の結果と比べ、スループットの低下またはp50/p99レイテンシの増加が max_regression を超えた項目を返す"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["summary"]
+    regressions = []
+    checks = [("throughput_rps", summary["throughput_rps"], baseline["throughput_rps"], False)]
+    for q in ("p50", "p99"):
+        if summary["latency"] and baseline.get("latency"):
+            checks.append((f"latency_{q}", summary["latency"][q], baseline["latency"][q], True))
+    if summary["tokens_per_second"] and baseline.get("tokens_per_second"):
+        checks.append(("tokens_per_second", summary["tokens_per_second"], baseline["tokens_per_second"], False))
+    for name, current, previous, lower_is_better in checks:
+        if not previous:
+            continue
+        change = (current - previous) / previous
+        if (change > max_regression) if lower_is_better else (-change > max_regression):
+            regressions.append(f"{name}: {previous:.4f} -> {current:.4f} ({change:+.1%})")
+    return regressions
+
+
+def print_summary(summary):
+    print("\n=== ベンチマーク結果 ===")
+    print(f"リクエスト: {summary['requests']}件（成功 {summary['succeeded']}件、失敗 {summary['failed']}件）"
+          f" / {summary['elapsed_seconds']:.2f}秒")
+    print(f"スループット: {summary['throughput_rps']:.2f} リクエスト/秒")
+    if summary["tokens_per_second"] is not None:
+        print(f"生成速度: {summary['tokens_per_second']:.1f} トークン/秒（合計 {summary['generated_tokens']}トークン）")
+    for name, label in (("ttft", "TTFT"), ("latency", "レイテンシ")):
+        values = summary[name]
+        if values:
+            print(f"{label}: p50={values['p50']:.3f}秒 p90={values['p90']:.3f}秒 p99={values['p99']:.3f}秒 "
+                  f"(平均 {values['mean']:.3f}秒, 最大 {values['max']:.3f}秒)")
+    if summary["errors"]:
+        print(f"エラー: {summary['errors']}")
+
+
+async def run_benchmark(args, url, prompts):
+    client_module = load_client_module()
+    generation_kwargs = {
+        "max_new_tokens": args.max_new_tokens,
+        "do_sample": not args.greedy,
+    }
+    if args.priority:
+        generation_kwargs["priority"] = args.priority
+    concurrency = args.users or max(8, int(args.qps * 10))
+    async with client_module.AsyncLLMClient(
+        url,
+        max_connections=concurrency,
+        max_keepalive_connections=concurrency,
+        max_retries=args.retries,
+        api_key=args.api_key,
+    ) as client:
+        runner = BenchmarkRunner(client, args.endpoint, generation_kwargs)
+        # ウォームアップ（結果には含めない）
+        for _ in range(args.warmup):
+            await runner.send(-1, prompts[0])
+        runner.records.clear()
+
+        start = time.perf_counter()
+        if args.qps:
+            await runner.run_fixed_qps(prompts, args.qps, args.requests, args.duration, args.poisson, args.seed)
+        else:
+            await runner.run_closed_loop(prompts, args.users, args.requests, args.duration)
+        elapsed = time.perf_counter() - start
+    return runner.records, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM APIの負荷テストとベンチマークを行います")
+    parser.add_argument("--url", help="APIのベースURL（--local を指定しない場合は必須）")
+    parser.add_argument("--local", action="store_true", help="小さなモデルでローカルサーバーを起動して測定する")
+    parser.add_argument("--local-model", default=None, help="--local で使うモデル（省略時はランダム初期化の小さなモデル）")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--qps", type=float, default=None, help="1秒あたりの送信数（開ループ）")
+    load.add_argument("--users", type=int, default=None, help="同時ユーザー数（閉ループ、既定: 4）")
+    parser.add_argument("--poisson", action="store_true", help="--qps の送信間隔を指数分布にする")
+    parser.add_argument("--requests", type=int, default=None, help="送信するリクエスト数（既定: 20。--duration のみ指定時は無制限）")
+    parser.add_argument("--duration", type=float, default=None, help="測定時間（秒）")
+    parser.add_argument("--prompts", default=None, help=f"プロンプトのJSON/JSONLファイル（既定: {os.path.relpath(DEFAULT_PROMPTS_FILE)}）")
+    parser.add_argument("--synthetic-lengths", default=None, help="合成プロンプトの文字数（例: 32,256,1024）")
+    parser.add_argument("--endpoint", choices=["stream", "generate"], default="stream",
+                        help="stream ではTTFTと生成トークン数も測定する")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--greedy", action="store_true", help="do_sample=False で生成する（応答キャッシュが効く点に注意）")
+    parser.add_argument("--priority", default=None, help="リクエストの優先度クラス")
+    parser.add_argument("--api-key", default=None, help="X-API-Key ヘッダーの値")
+    parser.add_argument("--retries", type=int, default=0, help="429/503 のときの再試行回数（既定: 再試行しない）")
+    parser.add_argument("--warmup", type=int, default=1, help="測定前に送信するリクエスト数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="結果を保存するJSONファイル")
+    parser.add_argument("--include-records", action="store_true", help="1件ごとの記録もJSONに保存する")
+    parser.add_argument("--baseline", default=None, help="比較する前回の結果（JSON）")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="許容する悪化の割合（既定: 0.2 = 20%%）")
+    args = parser.parse_args()
+
+    if not args.url and not args.local:
+        parser.error("--url または --local を指定してください")
+    if args.qps is None and args.users is None:
+        args.users = 4
+    if args.requests is None and args.duration is None:
+        args.requests = 20
+
+    if args.synthetic_lengths:
+        lengths = [int(length) for length in args.synthetic_lengths.split(",")]
+        prompts = synthetic_prompts(lengths, max(len(lengths), args.requests or len(lengths)), args.seed)
+    else:
+        prompts = load_prompts(args.prompts or DEFAULT_PROMPTS_FILE)
+    print(f"プロンプト: {len(prompts)}件, 負荷: "
+          f"{f'{args.qps} QPS（開ループ）' if args.qps else f'{args.users}ユーザー（閉ループ）'}")
+
+    server = None
+    url = args.url
+    if args.local:
+        server, url = start_local_server(args.local_model)
+    try:
+        records, elapsed = asyncio.run(run_benchmark(args, url, prompts))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    summary = summarize(records, elapsed)
+    print_summary(summary)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("api_key",)}
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": config, "url": url, "summary": summary}
+    if args.include_records:
+        report["records"] = records
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(summary, args.baseline, args.max_regression)
+        if regressions:
+            print("性能が悪化しました:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print(f"前回の結果 ({args.baseline}) からの悪化はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# benchmark_cpu_profile.py
+# CPUプロファイル（default / int8 / onnx）ごとの精度とレイテンシを比較するレポートを作成します
+# 使い方:
+#   python benchmark_cpu_profile.py                                   # 小さなランダムモデルで比較（動作確認用）
+#   python benchmark_cpu_profile.py --model google/gemma-2-2b-jpn-it --threads 8 --output report.md
+# 精度は default（float32）を基準に、次トークンの一致率・KLダイバージェンス・貪欲法の出力の一致率で比べます。
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+# day1/common を読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.cpu_profile import CPU_PROFILES, create_cpu_pipeline, default_num_threads, model_size_bytes
+
+PROMPTS = [
+    "AIについて簡単に教えてください。",
+    "大規模言語モデルの推論を高速化する方法を説明してください。",
+    "機械学習と深層学習の違いは何ですか？",
+    "日本の首都はどこですか？",
+    "Please explain what a transformer model is.",
+]
+
+
+def build_pipeline(args, profile, base_model, tokenizer):
+    """プロファイルのパイプラインを作成し、(パイプライン, 読み込み時間) を返す"""
+    start = time.perf_counter()
+    if args.model is None:
+        # 小さなモデルは同じ重みをコピーして使う（量子化はモデルを書き換えるため）
+        pipe = create_cpu_pipeline("tiny", profile, args.threads, model=copy.deepcopy(base_model), tokenizer=tokenizer)
+    else:
+        pipe = create_cpu_pipeline(args.model, profile, args.threads, onnx_dir=args.onnx_dir)
+    return pipe, time.perf_counter() - start
+
+
+def measure_latency(pipe, prompts, max_new_tokens, repeats):
+    """貪欲法で生成し、レイテンシと生成速度、生成したトークン列を返す"""
+    import torch
+
+    tokenizer = pipe.tokenizer
+    latencies, generated_tokens, outputs = [], 0, []
+    for repeat in range(repeats):
+        for prompt in prompts:
+            input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+            start = time.perf_counter()
+            with torch.no_grad():
+                output_ids = pipe.model.generate(
+                    input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+                )
+            latencies.append(time.perf_counter() - start)
+            new_ids = output_ids[0, input_ids.shape[1]:].tolist()
+            generated_tokens += len(new_ids)
+            if repeat == 0:
+                outputs.append(new_ids)
+    total = sum(latencies)
+    return {
+        "latency_mean": statistics.mean(latencies),
+        "latency_p50": statistics.median(latencies),
+        "tokens_per_second": generated_tokens / total if total > 0 else 0.0,
+    }, outputs
+
+
+def next_token_logits(pipe, prompt_ids, continuation_ids):
+    """プロンプトと基準の続きを入力し、続きの各位置での次トークンのロジットを返す"""
+    import torch
+
+    ids = torch.tensor([prompt_ids + continuation_ids])
+    with torch.no_grad():
+        logits = pipe.model(ids, attention_mask=torch.ones_like(ids)).logits[0]
+    start = len(prompt_ids) - 1
+    return logits[start:start + len(continuation_ids)].float()
+
+
+def compare_accuracy(reference, candidate, prompts, reference_outputs, candidate_outputs):
+    """基準（default）と比べた、次トークンの一致率・KLダイバージェンス・出力の完全一致率を返す"""
+    import torch
+
+    agreements, kls, exact = [], [], 0
+    for prompt, ref_ids, cand_ids in zip(prompts, reference_outputs, candidate_outputs):
+        exact += int(ref_ids == cand_ids)
+        if not ref_ids:
+            continue
+        # 同じ入力（基準の出力）を与えて、各位置の予測分布を比べる
+        prompt_ids = reference.tokenizer(prompt)["input_ids"]
+        ref_logits = next_token_logits(reference, prompt_ids, ref_ids)
+        cand_logits = next_token_logits(candidate, prompt_ids, ref_ids)
+        agreements.append((ref_logits.argmax(-1) == cand_logits.argmax(-1)).float().mean().item())
+        ref_logp = torch.log_softmax(ref_logits, dim=-1)
+        cand_logp = torch.log_softmax(cand_logits, dim=-1)
+        kls.append(torch.sum(ref_logp.exp() * (ref_logp - cand_logp), dim=-1).mean().item())
+    return {
+        "top1_agreement": statistics.mean(agreements) if agreements else None,
+        "kl_divergence": statistics.mean(kls) if kls else None,
+        "exact_match_rate": exact / len(prompts) if prompts else None,
+    }
+
+
+def format_report(rows, args):
+    """Markdownの表を作成する"""
+    lines = [
+        f"# CPUプロファイル比較 (モデル: {args.model or 'tiny (random)'}, スレッド数: {args.threads}, "
+        f"max_new_tokens: {args.max_new_tokens})",
+        "",
+        "| プロファイル | 読み込み(秒) | 重み(MB) | レイテンシ平均(秒) | p50(秒) | トークン/秒 | 速度比 | 次トークン一致率 | KL | 出力一致率 |",
+        "|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    base_tps = rows[0]["tokens_per_second"] if rows and rows[0].get("tokens_per_second") else None
+
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else "-"
+
+    for row in rows:
+        if row.get("error"):
+            lines.append(f"| {row['profile']} | 実行できません: {row['error']} |||||||||")
+            continue
+        speedup = row["tokens_per_second"] / base_tps if base_tps else None
+        lines.append(
+            f"| {row['profile']} | {row['load_seconds']:.2f} | {row['model_bytes'] / 1024 ** 2:.1f} "
+            f"| {row['latency_mean']:.3f} | {row['latency_p50']:.3f} | {row['tokens_per_second']:.1f} "
+            f"| {fmt(speedup, '.2f')}x | {fmt(row.get('top1_agreement'), '.3f')} "
+            f"| {fmt(row.get('kl_divergence'), '.4f')} | {fmt(row.get('exact_match_rate'), '.2f')} |"
+        )
+    lines += [
+        "",
+        "- 次トークン一致率・KL・出力一致率は default（float32）を基準にした値です（default自身は1.0 / 0）。",
+        "- 一致率が高くKLが小さいほど、default と同じ応答に近くなります。",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPUプロファイルごとの精度とレイテンシを比較します")
+    parser.add_argument("--model", default=None, help="モデル名（未指定なら小さなランダムモデル）")
+    parser.add_argument("--profiles", default=",".join(CPU_PROFILES), help="比較するプロファイル（カンマ区切り）")
+    parser.add_argument("--threads", type=int, default=default_num_threads(), help="torchのスレッド数")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=2, help="レイテンシを測る回数")
+    parser.add_argument("--onnx-dir", default=None, help="ONNXモデルの書き出し先（再利用する）")
+    parser.add_argument("--output", default=None, help="レポートの保存先（.md または .json）")
+    args = parser.parse_args()
+
+    profiles = [profile.strip() for profile in args.profiles.split(",") if profile.strip()]
+    if "default" in profiles:
+        profiles.remove("default")
+    profiles.insert(0, "default")  # 精度の基準にするため最初に実行する
+
+    base_model = tokenizer = None
+    if args.model is None:
+        from common.tiny_model import build_tiny_model
+        base_model, tokenizer = build_tiny_model(n_layer=4, n_embd=256)
+
+    rows = []
+    reference = reference_outputs = None
+    for profile in profiles:
+        print(f"\n=== {profile} ===")
+        try:
+            pipe, load_seconds = build_pipeline(args, profile, base_model, tokenizer)
+        except ImportError as e:
+            print(f"スキップします: {e}")
+            rows.append({"profile": profile, "error": str(e)})
+            continue
+        # ウォームアップ
+        measure_latency(pipe, PROMPTS[:1], 4, 1)
+        latency, outputs = measure_latency(pipe, PROMPTS, args.max_new_tokens, args.repeats)
+        row = {"profile": profile, "load_seconds": load_seconds, "model_bytes": model_size_bytes(pipe.model), **latency}
+        if reference is None:
+            reference, reference_outputs = pipe, outputs
+            row.update(top1_agreement=1.0, kl_divergence=0.0, exact_match_rate=1.0)
+        else:
+            try:
+                row.update(compare_accuracy(reference, pipe, PROMPTS, reference_outputs, outputs))
+            except Exception as e:
+                # ONNX Runtimeのモデルなど、ロジットを同じ方法で取り出せない場合は出力の一致率だけを記録する
+                print(f"ロジットを比較できませんでした: {e}")
+                row["exact_match_rate"] = sum(a == b for a, b in zip(reference_outputs, outputs)) / len(PROMPTS)
+        rows.append(row)
+        print(json.dumps(row, ensure_ascii=False, indent=2))
+
+    report = format_report(rows, args)
+    print("\n" + report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            if args.output.endswith(".json"):
+                json.dump({"config": vars(args), "results": rows}, f, ensure_ascii=False, indent=2)
+            else:
+                f.write(report + "\n")
+        print(f"レポートを保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# benchmark_engine.py
+# 連続バッチングのエンジンと、1リクエストずつ生成する従来の方法を比較するCPU向けベンチマークです
+# 使い方:
+#   python benchmark_engine.py                      # ダウンロード不要の小さなランダムモデルで比較
+#   python benchmark_engine.py --model <モデル名> --requests 16 --rate 4
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+# day1/common を読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from engine import ContinuousBatchingEngine
+
+PROMPTS = [
+    "こんにちは。",
+    "AIについて簡単に教えてください。",
+    "大規模言語モデルの推論を高速化する方法を、初心者にもわかるように詳しく説明してください。",
+    "機械学習とは何ですか？",
+    "Please explain how large language models generate text, step by step.",
+]
+
+
+def percentile(values, q):
+    """値のリストのパーセンタイル（q は0〜100）を返す"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_model_and_tokenizer(model_name):
+    """モデルとトークナイザーを読み込む（未指定なら小さなランダムモデルを作成する）"""
+    if model_name is None:
+        from common.tiny_model import build_tiny_model
+        return build_tiny_model(n_layer=4, n_embd=128)
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import torch
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+    model.eval()
+    return model, tokenizer
+
+
+def make_workload(tokenizer, num_requests, min_new_tokens, max_new_tokens, rate, seed):
+    """(到着時刻, トークン列, max_new_tokens) のリストを作成する。rate=0なら全件が同時に到着する"""
+    rng = random.Random(seed)
+    workload = []
+    arrival = 0.0
+    for _ in range(num_requests):
+        prompt = rng.choice(PROMPTS)
+        input_ids = tokenizer(prompt)["input_ids"]
+        # 短い応答と長い応答が混ざるようにする
+        workload.append((arrival, input_ids, rng.randint(min_new_tokens, max_new_tokens)))
+        if rate > 0:
+            arrival += rng.expovariate(rate)
+    return workload
+
+
+def run_sequential(model, tokenizer, workload):
+    """従来の方法: 到着順に1件ずつ generate を実行する（パイプラインを1件ずつ呼ぶのと同じ）"""
+    import torch
+
+    latencies, generated = [], 0
+    start = time.perf_counter()
+    for arrival, input_ids, max_new_tokens in workload:
+        # まだ到着していなければ待つ
+        wait = start + arrival - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        input_tensor = torch.tensor([input_ids])
+        with torch.no_grad():
+            output_ids = model.generate(
+                input_tensor,
+                attention_mask=torch.ones_like(input_tensor),
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        generated += output_ids.shape[1] - len(input_ids)
+        latencies.append(time.perf_counter() - (start + arrival))
+    return latencies, generated, time.perf_counter() - start
+
+
+def run_engine(model, tokenizer, workload, max_batch_size, max_tokens_per_step):
+    """連続バッチング: 到着時刻にエンジンへ投入し、すべての完了を待つ"""
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=max_batch_size,
+                                      max_tokens_per_step=max_tokens_per_step)
+    engine.start()
+    futures = []
+    start = time.perf_counter()
+
+    def submit_all():
+        for arrival, input_ids, max_new_tokens in workload:
+            wait = start + arrival - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            futures.append(engine.submit(input_ids, max_new_tokens=max_new_tokens, do_sample=False))
+
+    submitter = threading.Thread(target=submit_all)
+    submitter.start()
+    submitter.join()
+    results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    stats = engine.stats()
+    engine.stop()
+    latencies = [result.total_time for result in results]
+    generated = sum(result.generated_tokens for result in results)
+    return latencies, generated, elapsed, stats
+
+
+def summarize(name, latencies, generated, elapsed):
+    return {
+        "method": name,
+        "requests": len(latencies),
+        "generated_tokens": generated,
+        "elapsed_seconds": elapsed,
+        "throughput_tokens_per_second": generated / elapsed if elapsed > 0 else 0.0,
+        "latency_p50_seconds": percentile(latencies, 50),
+        "latency_p99_seconds": percentile(latencies, 99),
+        "latency_mean_seconds": statistics.mean(latencies) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="連続バッチングと1件ずつの生成を比較します")
+    parser.add_argument("--model", default=None, help="モデル名（未指定なら小さなランダムモデル）")
+    parser.add_argument("--requests", type=int, default=32, help="リクエスト数")
+    parser.add_argument("--rate", type=float, default=0.0, help="1秒あたりの到着数（0なら全件同時に到着）")
+    parser.add_argument("--min-new-tokens", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-tokens-per-step", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=None, help="torchのスレッド数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="結果を保存するJSONファイル")
+    args = parser.parse_args()
+
+    import torch
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model, tokenizer = load_model_and_tokenizer(args.model)
+    workload = make_workload(tokenizer, args.requests, args.min_new_tokens, args.max_new_tokens, args.rate, args.seed)
+    # ウォームアップ
+    run_sequential(model, tokenizer, workload[:1])
+
+    print(f"1件ずつの生成を実行中... ({args.requests}件)")
+    sequential = summarize("sequential", *run_sequential(model, tokenizer, workload))
+    print(f"連続バッチングを実行中... ({args.requests}件)")
+    latencies, generated, elapsed, engine_stats = run_engine(
+        model, tokenizer, workload, args.max_batch_size, args.max_tokens_per_step)
+    continuous = summarize("continuous_batching", latencies, generated, elapsed)
+    continuous["engine"] = engine_stats
+
+    print(f"\n{'方式':<22}{'スループット(tok/s)':>20}{'p50(秒)':>10}{'p99(秒)':>10}{'合計(秒)':>10}")
+    for row in (sequential, continuous):
+        print(f"{row['method']:<22}{row['throughput_tokens_per_second']:>20.1f}"
+              f"{row['latency_p50_seconds']:>10.3f}{row['latency_p99_seconds']:>10.3f}{row['elapsed_seconds']:>10.2f}")
+    if sequential["throughput_tokens_per_second"] > 0:
+        speedup = continuous["throughput_tokens_per_second"] / sequential["throughput_tokens_per_second"]
+        print(f"\nスループットの向上: {speedup:.2f}倍 (平均バッチサイズ: {engine_stats['avg_batch_size']:.2f})")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": [sequential, continuous]}, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
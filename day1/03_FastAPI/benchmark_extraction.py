@@ -0,0 +1,129 @@
+# benchmark_extraction.py
+# 長いプロンプトで、生成結果から応答を取り出す方法の速度と結果を比較するマイクロベンチマークです
+#   find:        全体をデコードし、str.find でプロンプトを探して後ろを切り出す（以前の方法）
+#   full_text:   パイプラインの return_full_text=False（内部でプロンプトをデコードし直して文字数で切り出す）
+#   token_slice: 生成結果のトークンIDからプロンプトの部分を切り落とし、新しいトークンだけをデコードする（common/inference.py）
+# 使い方:
+#   python benchmark_extraction.py                         # 小さなランダムモデルで比較
+#   python benchmark_extraction.py --prompt-tokens 500,2000,8000 --repeats 50
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+# day1/common を読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.inference import generate_texts
+
+BASE_TEXT = "大規模言語モデルの推論を高速化する方法を説明してください。Please explain how caching works. "
+
+
+def legacy_extract(full_text, prompt):
+    """以前の方法: 生成されたテキスト全体からプロンプトを探し、その後ろを応答とする"""
+    index = full_text.find(prompt)
+    if index == -1:
+        return full_text  # プロンプトがデコード結果と一致しない場合は、プロンプトごと返してしまう
+    return full_text[index + len(prompt):].strip()
+
+
+def build_prompt(tokenizer, n_tokens):
+    """おおよそ n_tokens トークンのプロンプトを作成する"""
+    unit = len(tokenizer(BASE_TEXT, add_special_tokens=False)["input_ids"])
+    return BASE_TEXT * max(1, n_tokens // unit)
+
+
+def time_calls(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def benchmark_postprocess(pipe, prompt, max_new_tokens, repeats):
+    """生成済みのトークン列から応答を取り出す処理だけの時間を比べる（モデルの実行は含まない）"""
+    import torch
+
+    tokenizer = pipe.tokenizer
+    input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        output_ids = pipe.model.generate(input_ids, attention_mask=torch.ones_like(input_ids),
+                                         max_new_tokens=max_new_tokens, do_sample=False,
+                                         pad_token_id=tokenizer.eos_token_id)
+    prompt_length = input_ids.shape[1]
+
+    def find():
+        return legacy_extract(tokenizer.decode(output_ids[0], skip_special_tokens=True), prompt)
+
+    def full_text():
+        # return_full_text=False と同じ処理（全体とプロンプトをデコードし、プロンプトの文字数で切り出す）
+        text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
+        return text[len(tokenizer.decode(input_ids[0], skip_special_tokens=True)):]
+
+    def token_slice():
+        return tokenizer.decode(output_ids[0, prompt_length:], skip_special_tokens=True)
+
+    return {
+        "find_ms": time_calls(find, repeats) * 1000,
+        "full_text_ms": time_calls(full_text, repeats) * 1000,
+        "token_slice_ms": time_calls(token_slice, repeats) * 1000,
+        "find_matches_token_slice": find().strip() == token_slice().strip(),
+    }
+
+
+def benchmark_end_to_end(pipe, prompt, max_new_tokens, repeats):
+    """生成を含めた1リクエストの時間を比べる"""
+    params = {"max_new_tokens": max_new_tokens, "do_sample": False}
+    return {
+        "pipeline_find_s": time_calls(
+            lambda: legacy_extract(pipe(prompt, **params)[0]["generated_text"], prompt), repeats),
+        "pipeline_full_text_s": time_calls(
+            lambda: pipe(prompt, return_full_text=False, **params)[0]["generated_text"], repeats),
+        "token_slice_s": time_calls(lambda: generate_texts(pipe, [prompt], **params)[0], repeats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="応答の取り出し方の速度を長いプロンプトで比較します")
+    parser.add_argument("--model", default=None, help="モデル名（未指定なら小さなランダムモデル）")
+    parser.add_argument("--prompt-tokens", default="250,1000,4000", help="プロンプトのおおよそのトークン数（カンマ区切り）")
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=20, help="デコード処理を測る回数")
+    parser.add_argument("--e2e-repeats", type=int, default=3, help="生成を含めて測る回数（0なら省略）")
+    parser.add_argument("--output", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    if args.model is None:
+        from common.tiny_model import build_tiny_pipeline
+        pipe = build_tiny_pipeline(max_positions=16384)
+    else:
+        from transformers import pipeline
+        pipe = pipeline("text-generation", model=args.model, device="cpu")
+
+    rows = []
+    for n_tokens in [int(value) for value in args.prompt_tokens.split(",") if value.strip()]:
+        prompt = build_prompt(pipe.tokenizer, n_tokens)
+        row = {"prompt_tokens": len(pipe.tokenizer(prompt)["input_ids"]), "prompt_chars": len(prompt)}
+        row.update(benchmark_postprocess(pipe, prompt, args.max_new_tokens, args.repeats))
+        if args.e2e_repeats:
+            row.update(benchmark_end_to_end(pipe, prompt, args.max_new_tokens, args.e2e_repeats))
+        rows.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+
+    print("\n| プロンプト(トークン) | find (ms) | return_full_text=False (ms) | トークンIDで切り出し (ms) | 速度比 |")
+    print("|---|---|---|---|---|")
+    for row in rows:
+        speedup = row["find_ms"] / row["token_slice_ms"] if row["token_slice_ms"] > 0 else float("inf")
+        print(f"| {row['prompt_tokens']} | {row['find_ms']:.3f} | {row['full_text_ms']:.3f} "
+              f"| {row['token_slice_ms']:.3f} | {speedup:.1f}x |")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": rows}, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
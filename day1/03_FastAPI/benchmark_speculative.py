@@ -0,0 +1,129 @@
+# benchmark_speculative.py
+# 投機的デコーディングと通常の貪欲法（model.generate）の速度を比較し、出力が一致することを確かめます
+# 使い方:
+#   python benchmark_speculative.py                          # 小さなランダムモデルで比較（ドラフトは先頭1層だけのモデル）
+#   python benchmark_speculative.py --model google/gemma-2-2b-jpn-it --draft <同じトークナイザーの小さなモデル> --lookahead 4
+# 速度比は本体とドラフトの計算量の比と受理率で決まります。小さなランダムモデルでの値は目安です。
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+# day1/common を読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from speculative import SpeculativeStats, check_draft_compatible, speculative_generate
+
+PROMPTS = [
+    "AIについて簡単に教えてください。",
+    "大規模言語モデルの推論を高速化する方法を説明してください。",
+    "機械学習と深層学習の違いは何ですか？",
+    "日本の首都はどこですか？",
+    "Please explain what a transformer model is.",
+]
+
+
+def load_models(args):
+    """(本体のモデル, ドラフトモデル, トークナイザー) を返す"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    if args.model is None:
+        from common.tiny_model import build_tiny_model
+
+        target, tokenizer = build_tiny_model(n_layer=args.tiny_layers, n_embd=256)
+        # 本体の先頭の層だけを残したモデルをドラフトにする（同じ埋め込みを共有するため受理率が高い）
+        draft = copy.deepcopy(target)
+        draft.transformer.h = draft.transformer.h[:args.tiny_draft_layers]
+        draft.config.n_layer = args.tiny_draft_layers
+        return target, draft, tokenizer
+
+    if args.draft is None:
+        raise SystemExit("--model を指定する場合は --draft も指定してください")
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    target = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).eval()
+    draft = AutoModelForCausalLM.from_pretrained(args.draft, torch_dtype=torch.float32).eval()
+    return target, draft, tokenizer
+
+
+def run_greedy(model, tokenizer, input_ids, max_new_tokens):
+    """通常の貪欲法で生成し、新たに生成したトークンIDのリストを返す"""
+    import torch
+
+    input_tensor = torch.tensor([input_ids])
+    with torch.no_grad():
+        output_ids = model.generate(
+            input_tensor,
+            attention_mask=torch.ones_like(input_tensor),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+        )
+    return output_ids[0, len(input_ids):].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="投機的デコーディングと貪欲法の速度を比較します")
+    parser.add_argument("--model", default=None, help="本体のモデル（未指定なら小さなランダムモデル）")
+    parser.add_argument("--draft", default=None, help="ドラフトモデル（本体と同じトークナイザーを使うモデル）")
+    parser.add_argument("--lookahead", type=int, default=4, help="ドラフトモデルが1回に提案するトークン数")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--tiny-layers", type=int, default=8, help="小さなモデルの層数")
+    parser.add_argument("--tiny-draft-layers", type=int, default=1, help="小さなモデルのドラフトに残す層数")
+    parser.add_argument("--output", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    target, draft, tokenizer = load_models(args)
+    check_draft_compatible(target, draft)
+    eos_token_ids = [tokenizer.eos_token_id] if tokenizer.eos_token_id is not None else []
+    prompt_ids = [tokenizer(prompt)["input_ids"] for prompt in PROMPTS]
+
+    # ウォームアップ
+    run_greedy(target, tokenizer, prompt_ids[0], 4)
+    speculative_generate(target, draft, prompt_ids[0], max_new_tokens=4, lookahead=args.lookahead)
+
+    greedy_times, speculative_times, matches = [], [], 0
+    stats = SpeculativeStats()
+    for repeat in range(args.repeats):
+        for input_ids in prompt_ids:
+            start = time.perf_counter()
+            expected = run_greedy(target, tokenizer, input_ids, args.max_new_tokens)
+            greedy_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            actual = speculative_generate(target, draft, input_ids, max_new_tokens=args.max_new_tokens,
+                                          lookahead=args.lookahead, eos_token_ids=eos_token_ids, stats=stats)
+            speculative_times.append(time.perf_counter() - start)
+            # generate はEOSを出力に含めるため、比較の前に取り除く
+            if expected and expected[-1] in eos_token_ids:
+                expected = expected[:-1]
+            matches += int(expected == actual)
+
+    total = len(greedy_times)
+    result = {
+        "model": args.model or f"tiny ({args.tiny_layers} layers)",
+        "draft": args.draft or f"tiny ({args.tiny_draft_layers} layers)",
+        "lookahead": args.lookahead,
+        "max_new_tokens": args.max_new_tokens,
+        "greedy_latency_mean": statistics.mean(greedy_times),
+        "speculative_latency_mean": statistics.mean(speculative_times),
+        "speedup": sum(greedy_times) / sum(speculative_times),
+        "identical_outputs": f"{matches}/{total}",
+        **stats.to_dict(),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    print(f"\n速度比: {result['speedup']:.2f}x, 受理率: {stats.acceptance_rate:.2f}, "
+          f"本体1回あたりのトークン数: {stats.tokens_per_target_forward:.2f}, 出力の一致: {matches}/{total}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+    if matches != total:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
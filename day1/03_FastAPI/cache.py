@@ -0,0 +1,186 @@
+# cache.py
+# 決定的な生成（do_sample=False）の応答を再利用するためのキャッシュモジュールです
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """表記ゆれを吸収するためにプロンプトを正規化する（NFKC正規化と空白の統一）"""
+    text = unicodedata.normalize("NFKC", prompt)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_cache_key(model_name, prompt, params):
+    """(モデル名, 正規化したプロンプト, 生成パラメータ) からキャッシュキーを作成する"""
+    # 貪欲法ではtemperatureやtop_pは結果に影響しないためキーに含めない
+    relevant = {"max_new_tokens": params.get("max_new_tokens"), "do_sample": bool(params.get("do_sample"))}
+    payload = json.dumps([model_name, normalize_prompt(prompt), relevant], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU + TTL の応答キャッシュ
+
+    エントリ数 max_entries と合計バイト数 max_bytes のどちらかを超えると、
+    最も長く使われていないエントリから削除します。persist_path を指定すると
+    SQLiteファイルに書き込み、再起動後も有効期限内のエントリを復元します。
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, max_bytes=64 * 1024 * 1024, persist_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+        self._conn = None
+        if persist_path:
+            self._open_store()
+
+    # --- 永続化 ---
+    def _open_store(self):
+        self._conn = sqlite3.connect(self.persist_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache "
+            "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, last_access REAL)"
+        )
+        now = time.time()
+        self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+        rows = self._conn.execute(
+            "SELECT key, value, expires_at FROM response_cache ORDER BY last_access ASC"
+        ).fetchall()
+        for key, value, expires_at in rows:
+            self._store(key, value, expires_at, persist=False)
+        self._conn.commit()
+        print(f"応答キャッシュを復元しました: {len(self._entries)}件 ({self.persist_path})")
+
+    def _persist_set(self, key, value, expires_at):
+        if self._conn is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, time.time()),
+            )
+            self._conn.commit()
+
+    def _persist_delete(self, key):
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    # --- キャッシュ操作 ---
+    @staticmethod
+    def _entry_size(key, value):
+        return len(key.encode("utf-8")) + len(value.encode("utf-8"))
+
+    def _remove(self, key, persist=True):
+        value, _, size = self._entries.pop(key)
+        self.total_bytes -= size
+        if persist:
+            self._persist_delete(key)
+
+    def _store(self, key, value, expires_at, persist=True):
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return  # 1件で上限を超えるものはキャッシュしない
+        if key in self._entries:
+            self._remove(key, persist=False)
+        self._entries[key] = (value, expires_at, size)
+        self.total_bytes += size
+        if persist:
+            self._persist_set(key, value, expires_at)
+        # 上限を超えた分を古い順に削除
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def get(self, key):
+        """キャッシュされた値を返す。存在しないか期限切れならNoneを返す"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, _ = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """値をキャッシュに保存する"""
+        with self._lock:
+            self._store(key, value, time.time() + self.ttl_seconds)
+
+    def clear(self):
+        """すべてのエントリを削除する"""
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM response_cache")
+                self._conn.commit()
+
+    def close(self):
+        """永続化用の接続を閉じる"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self):
+        """ヒット率などの統計を返す"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中であれば、新たに実行せずその結果を共有する（リクエストの合流）
+
+    処理は独立したタスクとして実行されるため、最初のリクエストが切断されても
+    合流した他のリクエストには結果が届きます。
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.coalesced = 0  # 実行中の処理に合流したリクエスト数
+
+    @property
+    def inflight(self):
+        """実行中の処理の数"""
+        return len(self._inflight)
+
+    async def do(self, key, fn):
+        """キーに対応する処理を実行する（または実行中の処理の完了を待つ）。fnは引数なしのコルーチン関数"""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # 待っている側がキャンセルされても処理自体は継続させる
+        return await asyncio.shield(task)
@@ -0,0 +1,364 @@
+# engine.py
+# デコードのステップ単位でバッチを組み替える連続バッチング（continuous batching）の生成エンジンです
+# 静的なバッチでは最も長い系列が終わるまで全員が待たされますが、このエンジンでは
+# 1トークン生成するごとに終了した系列がバッチから抜け、待っているリクエストがすぐに加わります。
+import asyncio
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class EngineResult:
+    """エンジンでの生成結果"""
+
+    def __init__(self, text, token_ids, prompt_tokens, queue_time, ttft, total_time):
+        self.text = text
+        self.token_ids = token_ids
+        self.prompt_tokens = prompt_tokens
+        self.queue_time = queue_time  # 投入からバッチに加わるまでの時間（秒）
+        self.ttft = ttft              # 投入から最初のトークンが生成されるまでの時間（秒）
+        self.total_time = total_time  # 投入から生成が終わるまでの時間（秒）
+
+    @property
+    def generated_tokens(self):
+        return len(self.token_ids)
+
+
+class _Sequence:
+    """エンジン内で生成中の1系列"""
+
+    _ids = itertools.count()
+
+    def __init__(self, input_ids, max_new_tokens, do_sample, temperature, top_p):
+        self.id = next(self._ids)
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated = []
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+        self.admitted_at = None
+        self.first_token_at = None
+
+
+def _cache_tensors(past_key_values):
+    """KVキャッシュから層ごとの (keys, values) のリストを取り出す"""
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        return [(layer.keys, layer.values) for layer in layers]
+    if hasattr(past_key_values, "key_cache"):  # 古いtransformersのDynamicCache
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [tuple(layer[:2]) for layer in past_key_values]  # タプル形式のキャッシュ
+
+
+def _build_cache(tensors):
+    """層ごとの (keys, values) からDynamicCacheを作成する"""
+    from transformers import DynamicCache
+
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(tensors):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+class ContinuousBatchingEngine:
+    """
+    連続バッチングでテキストを生成するエンジン
+
+    専用のスレッドで次のステップを繰り返します。
+      1. 待ち行列のリクエストをプリフィルしてバッチに加える（最初のトークンもここで決まる）
+      2. バッチ全体で1トークンずつデコードする
+      3. EOSまたは max_new_tokens に達した系列をバッチから外し、結果を返す
+    各系列のKVキャッシュは左詰めのパディングでそろえて1つのキャッシュにまとめ、
+    系列が加わる・抜けるときだけ組み替えます。
+
+    1ステップで処理するトークン数（デコード中の系列数 + 新たにプリフィルするプロンプトのトークン数）は
+    max_tokens_per_step 以下に抑えます。長いプロンプトのプリフィルでデコード中の系列が止まる時間を
+    制限するためです（バッチが空のときは上限を超えるプロンプトも1件だけ受け付けます）。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, max_tokens_per_step=512):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_tokens_per_step = max_tokens_per_step
+        self.eos_token_ids = self._eos_token_ids()
+        # 統計
+        self.steps = 0
+        self.decoded_tokens = 0
+        self.prefill_tokens = 0
+        self.completed = 0
+        self._batch_size_total = 0
+        # バッチの状態（エンジンのスレッドだけが触る）
+        self._active = []          # バッチ内の系列（キャッシュの行の順）
+        self._cache = None         # バッチ全体のKVキャッシュ
+        self._mask = None          # [バッチ, キャッシュ長] のアテンションマスク（パディングは0）
+        # 待ち行列
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def _eos_token_ids(self):
+        eos = getattr(getattr(self.model, "generation_config", None), "eos_token_id", None)
+        if eos is None:
+            eos = self.tokenizer.eos_token_id
+        if eos is None:
+            return set()
+        return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+    # --- 外部から呼ぶメソッド ---
+    @property
+    def pending(self):
+        """バッチに加わるのを待っているリクエスト数"""
+        return len(self._queue)
+
+    @property
+    def running(self):
+        """生成中の系列数"""
+        return len(self._active)
+
+    def start(self):
+        """生成ループのスレッドを開始する"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._loop, name="continuous-batching", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """生成ループを停止する。生成中・待機中のリクエストはエラーにする"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, input_ids, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9):
+        """
+        トークン列の生成を依頼する（スレッドセーフ）
+
+        Returns:
+            concurrent.futures.Future: EngineResult を返すFuture。cancel()するとバッチから外れる
+        """
+        if not input_ids:
+            raise ValueError("input_ids が空です")
+        sequence = _Sequence(input_ids, max_new_tokens, do_sample, temperature, top_p)
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError("エンジンは停止しています")
+            self._queue.append(sequence)
+            self._cond.notify()
+        return sequence.future
+
+    async def generate(self, input_ids, **params):
+        """submitのasync版。呼び出し側がキャンセルされると生成も中止する"""
+        future = self.submit(input_ids, **params)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def stats(self):
+        """ステップ数や平均バッチサイズなどの統計を返す"""
+        return {
+            "running": self.running,
+            "pending": self.pending,
+            "steps": self.steps,
+            "completed": self.completed,
+            "decoded_tokens": self.decoded_tokens,
+            "prefill_tokens": self.prefill_tokens,
+            "avg_batch_size": self._batch_size_total / self.steps if self.steps else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_tokens_per_step": self.max_tokens_per_step,
+        }
+
+    # --- 生成ループ ---
+    def _loop(self):
+        import torch
+
+        while True:
+            with self._cond:
+                while not self._stopping and not self._queue and not self._active:
+                    self._cond.wait()
+                if self._stopping:
+                    break
+                admitted = self._admit()
+            try:
+                with torch.no_grad():
+                    for sequence in admitted:
+                        self._prefill(sequence)
+                    self._drop_cancelled()
+                    if self._active:
+                        self._decode_step()
+            except Exception as e:
+                print(f"連続バッチングの生成中にエラーが発生しました: {e}")
+                self._fail_all(e, admitted)
+        self._fail_all(RuntimeError("エンジンが停止しました"), list(self._queue))
+        self._queue.clear()
+
+    def _admit(self):
+        """トークン予算とバッチサイズの範囲で、待ち行列からバッチに加えるリクエストを取り出す"""
+        admitted = []
+        budget = self.max_tokens_per_step - len(self._active)
+        while self._queue and len(self._active) + len(admitted) < self.max_batch_size:
+            sequence = self._queue[0]
+            cost = len(sequence.input_ids)
+            if cost > budget and (self._active or admitted):
+                break
+            self._queue.popleft()
+            # 待っている間にキャンセルされたリクエストは捨てる
+            if not sequence.future.set_running_or_notify_cancel():
+                continue
+            sequence.admitted_at = time.perf_counter()
+            budget -= cost
+            admitted.append(sequence)
+        return admitted
+
+    def _prefill(self, sequence):
+        """1件のプロンプトをプリフィルして最初のトークンを決め、バッチに加える"""
+        import torch
+
+        device = self.model.device
+        input_tensor = torch.tensor([sequence.input_ids], device=device)
+        outputs = self.model(input_tensor, attention_mask=torch.ones_like(input_tensor), use_cache=True)
+        self.prefill_tokens += len(sequence.input_ids)
+        token = self._sample(outputs.logits[0, -1], sequence)
+        if self._append_token(sequence, token):
+            return
+
+        tensors = _cache_tensors(outputs.past_key_values)
+        length = tensors[0][0].shape[-2]
+        mask = torch.ones((1, length), dtype=torch.long, device=device)
+        if self._cache is None:
+            self._cache, self._mask = _build_cache(tensors), mask
+        else:
+            # 短い方のキャッシュを左側にパディングして長さをそろえ、バッチの次元で連結する
+            batch_tensors = _cache_tensors(self._cache)
+            target = max(length, self._mask.shape[1])
+            merged = []
+            for (batch_k, batch_v), (k, v) in zip(batch_tensors, tensors):
+                merged.append((
+                    torch.cat([self._pad_left(batch_k, target), self._pad_left(k, target)], dim=0),
+                    torch.cat([self._pad_left(batch_v, target), self._pad_left(v, target)], dim=0),
+                ))
+            self._cache = _build_cache(merged)
+            self._mask = torch.cat([self._pad_left(self._mask, target), self._pad_left(mask, target)], dim=0)
+        self._active.append(sequence)
+
+    @staticmethod
+    def _pad_left(tensor, length):
+        """シーケンス方向（キャッシュは-2次元目、マスクは最後の次元）の左側をゼロで埋める"""
+        import torch.nn.functional as F
+
+        dim = -1 if tensor.dim() == 2 else -2
+        missing = length - tensor.shape[dim]
+        if missing <= 0:
+            return tensor
+        padding = (missing, 0) if dim == -1 else (0, 0, missing, 0)
+        return F.pad(tensor, padding)
+
+    def _decode_step(self):
+        """バッチ内のすべての系列について1トークンずつ生成する"""
+        import torch
+
+        device = self.model.device
+        batch_size = len(self._active)
+        input_ids = torch.tensor([[sequence.generated[-1]] for sequence in self._active], device=device)
+        # 新しいトークンの位置はパディングを除いたトークン数
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        attention_mask = torch.cat([self._mask, torch.ones((batch_size, 1), dtype=self._mask.dtype, device=device)],
+                                   dim=1)
+        outputs = self.model(
+            input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self._cache = outputs.past_key_values
+        self._mask = attention_mask
+        self.steps += 1
+        self.decoded_tokens += batch_size
+        self._batch_size_total += batch_size
+
+        logits = outputs.logits[:, -1]
+        finished = []
+        for row, sequence in enumerate(self._active):
+            if self._append_token(sequence, self._sample(logits[row], sequence)):
+                finished.append(row)
+        if finished:
+            self._remove_rows(finished)
+
+    def _drop_cancelled(self):
+        """呼び出し側でキャンセルされた系列をバッチから外す"""
+        cancelled = [row for row, sequence in enumerate(self._active) if sequence.future.cancelled()]
+        if cancelled:
+            self._remove_rows(cancelled)
+
+    def _remove_rows(self, rows):
+        """指定した行の系列をバッチから外し、不要になった左側のパディングを削る"""
+        import torch
+
+        removed = set(rows)
+        keep = [row for row in range(len(self._active)) if row not in removed]
+        self._active = [self._active[row] for row in keep]
+        if not keep:
+            self._cache, self._mask = None, None
+            return
+        index = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask.index_select(0, index)
+        # 残った系列のどれにも使われていない先頭の列は削除できる
+        offset = int((mask.sum(dim=0) > 0).nonzero()[0])
+        tensors = [(k.index_select(0, index)[:, :, offset:], v.index_select(0, index)[:, :, offset:])
+                   for k, v in _cache_tensors(self._cache)]
+        self._cache = _build_cache(tensors)
+        self._mask = mask[:, offset:]
+
+    def _sample(self, logits, sequence):
+        """1系列分のロジットから次のトークンを選ぶ（貪欲法またはtemperature/top_pによるサンプリング）"""
+        import torch
+
+        if not sequence.do_sample:
+            return int(torch.argmax(logits))
+        probs = torch.softmax(logits.float() / max(sequence.temperature, 1e-5), dim=-1)
+        if sequence.top_p < 1.0:
+            sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+            # 累積確率が top_p を超えた後のトークンを除外する（最も確率の高いトークンは必ず残す）
+            exclude = torch.cumsum(sorted_probs, dim=-1) - sorted_probs > sequence.top_p
+            sorted_probs[exclude] = 0.0
+            return int(sorted_ids[torch.multinomial(sorted_probs, 1)])
+        return int(torch.multinomial(probs, 1))
+
+    def _append_token(self, sequence, token):
+        """生成したトークンを追加し、系列が終了したら結果を返してTrueを返す"""
+        now = time.perf_counter()
+        if sequence.first_token_at is None:
+            sequence.first_token_at = now
+        if token not in self.eos_token_ids:
+            sequence.generated.append(token)
+            if len(sequence.generated) < sequence.max_new_tokens:
+                return False
+        self.completed += 1
+        if not sequence.future.cancelled():
+            sequence.future.set_result(EngineResult(
+                text=self.tokenizer.decode(sequence.generated, skip_special_tokens=True),
+                token_ids=list(sequence.generated),
+                prompt_tokens=len(sequence.input_ids),
+                queue_time=sequence.admitted_at - sequence.submitted_at,
+                ttft=sequence.first_token_at - sequence.submitted_at,
+                total_time=now - sequence.submitted_at,
+            ))
+        return True
+
+    def _fail_all(self, error, extra=()):
+        """生成中の系列をすべてエラーで終了させ、バッチを空にする"""
+        for sequence in list(self._active) + [s for s in extra if s not in self._active]:
+            if not sequence.future.done():
+                sequence.future.set_exception(error)
+        self._active, self._cache, self._mask = [], None, None
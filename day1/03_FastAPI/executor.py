@@ -0,0 +1,110 @@
+# executor.py
+# ブロッキングする推論処理をasyncioのイベントループから切り離して実行するためのモジュールです
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class QueueFullError(Exception):
+    """推論キューが上限に達し、新しいリクエストを受け付けられないことを表す例外"""
+
+    def __init__(self, queue_depth, retry_after):
+        super().__init__(f"推論キューが満杯です (待機中: {queue_depth}件)")
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+
+# --- プロセスワーカー用の関数 ---
+# ProcessPoolExecutorでは各ワーカープロセスが自分でモデルを読み込む
+_worker_pipe = None
+
+def init_worker(loader, *args):
+    """ワーカープロセスの初期化時にモデルを読み込む"""
+    global _worker_pipe
+    _worker_pipe = loader(*args)
+
+def call_worker_pipeline(*args, **kwargs):
+    """ワーカープロセス内のモデルで推論する"""
+    if _worker_pipe is None:
+        raise RuntimeError("ワーカープロセスでモデルが読み込まれていません")
+    return _worker_pipe(*args, **kwargs)
+
+def call_with_worker_pipeline(fn, *args, **kwargs):
+    """ワーカープロセス内のモデルを第1引数にして fn を実行する（fn はモジュールの関数である必要がある）"""
+    if _worker_pipe is None:
+        raise RuntimeError("ワーカープロセスでモデルが読み込まれていません")
+    return fn(_worker_pipe, *args, **kwargs)
+
+
+class InferenceExecutor:
+    """
+    推論専用のワーカープール
+
+    kind="thread" ではスレッドプール、kind="process" ではプロセスプールで推論を実行します。
+    admit() で受け付けたリクエスト数が max_queue_size に達すると QueueFullError を送出し、
+    リクエストを溜め込まずにクライアントへ再試行を促します。
+    """
+
+    def __init__(self, kind="thread", max_workers=1, max_queue_size=32, retry_after=5,
+                 initializer=None, initargs=()):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"未対応のエグゼキュータ種別です: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        self._initializer = initializer
+        self._initargs = initargs
+        self._pool = None
+        self._queue_depth = 0
+
+    @property
+    def queue_depth(self):
+        """受け付け済みで完了していないリクエスト数（待機中と実行中の合計）"""
+        return self._queue_depth
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.kind == "process":
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    initializer=self._initializer,
+                    initargs=self._initargs,
+                )
+            else:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="inference",
+                )
+        return self._pool
+
+    def acquire(self):
+        """リクエストを1件受け付ける。キューが満杯ならQueueFullErrorを送出する"""
+        if self._queue_depth >= self.max_queue_size:
+            raise QueueFullError(self._queue_depth, self.retry_after)
+        self._queue_depth += 1
+
+    def release(self):
+        """受け付けたリクエストの処理完了を記録する"""
+        self._queue_depth -= 1
+
+    @contextmanager
+    def admit(self):
+        """with文の間だけリクエストを受け付け済みとして数える"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(self, fn, *args, **kwargs):
+        """fnをワーカープールで実行し、結果を待つ"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(), functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        """ワーカープールを終了する"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
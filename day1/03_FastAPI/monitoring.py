@@ -0,0 +1,245 @@
+# monitoring.py
+# Prometheusのテキスト形式でメトリクスを公開するための軽量な実装です
+# （prometheus_clientに依存せず、カウンタ・ゲージ・ヒストグラムのみを提供します）
+import bisect
+import threading
+import time
+
+# レイテンシ用のデフォルトのバケット境界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# トークン数用のバケット境界
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+# トークン/秒用のバケット境界
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """増減する値（実行中のリクエスト数など）"""
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """値の分布をバケットごとに数えるヒストグラム（p99などはPrometheus側で計算する）"""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [バケットごとの件数, 合計, 件数]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class MetricsRegistry:
+    """メトリクスをまとめて管理し、テキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Prometheusのテキスト形式（text/plain; version=0.0.4）で出力する"""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+# --- LLM API用のメトリクス定義 ---
+registry = MetricsRegistry()
+
+REQUESTS_TOTAL = registry.counter(
+    "llm_api_requests_total", "HTTPリクエスト数", ("method", "path", "status"))
+REQUEST_LATENCY = registry.histogram(
+    "llm_api_request_latency_seconds", "HTTPリクエストの処理時間", ("method", "path"))
+IN_FLIGHT = registry.gauge(
+    "llm_api_in_flight_requests", "処理中のHTTPリクエスト数")
+QUEUE_TIME = registry.histogram(
+    "llm_queue_time_seconds", "推論が始まるまでキューで待った時間")
+INFERENCE_TIME = registry.histogram(
+    "llm_inference_time_seconds", "推論1回（バッチ）にかかった時間", ("endpoint",))
+PREFILL_TIME = registry.histogram(
+    "llm_prefill_time_seconds", "プロンプトの処理（最初のトークンまで）にかかった時間", ("endpoint",))
+DECODE_TIME = registry.histogram(
+    "llm_decode_time_seconds", "最初のトークン以降のデコードにかかった時間", ("endpoint",))
+TOKENS_PER_SECOND = registry.histogram(
+    "llm_tokens_per_second", "生成速度（トークン/秒）", ("endpoint",), buckets=THROUGHPUT_BUCKETS)
+PROMPT_TOKENS = registry.histogram(
+    "llm_prompt_tokens", "プロンプトのトークン数", buckets=TOKEN_BUCKETS)
+OUTPUT_TOKENS = registry.histogram(
+    "llm_output_tokens", "生成されたトークン数", buckets=TOKEN_BUCKETS)
+GENERATED_TOKENS_TOTAL = registry.counter(
+    "llm_generated_tokens_total", "生成されたトークンの合計")
+MODEL_LOAD_SECONDS = registry.gauge(
+    "llm_model_load_seconds", "モデルの読み込みにかかった時間", ("model",))
+SPECULATIVE_PROPOSED_TOKENS = registry.counter(
+    "llm_speculative_proposed_tokens_total", "投機的デコーディングでドラフトモデルが提案したトークン数")
+SPECULATIVE_ACCEPTED_TOKENS = registry.counter(
+    "llm_speculative_accepted_tokens_total", "投機的デコーディングで本体のモデルが受理したトークン数")
+SPECULATIVE_ACCEPTANCE_RATE = registry.histogram(
+    "llm_speculative_acceptance_rate", "リクエストごとの提案の受理率",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+SPECULATIVE_TOKENS_PER_FORWARD = registry.histogram(
+    "llm_speculative_tokens_per_target_forward", "本体のモデル1回の順伝播で進んだトークン数（高速化率の目安）",
+    buckets=(1, 1.5, 2, 2.5, 3, 4, 5, 6, 8))
+PROMPT_OVERFLOWS = registry.counter(
+    "llm_prompt_overflows_total", "コンテキスト長を超えたプロンプトの数（action: reject / truncate）", ("action",))
+CHAT_SESSIONS = registry.gauge("llm_chat_sessions", "保持している会話セッションの数")
+CHAT_SESSION_BYTES = registry.gauge("llm_chat_session_bytes", "会話セッション（KVキャッシュを含む）のメモリ使用量")
+CHAT_PREFILL_TOKENS = registry.counter(
+    "llm_chat_prefill_tokens_total", "/chat でプリフィルしたトークン数")
+CHAT_REUSED_TOKENS = registry.counter(
+    "llm_chat_reused_tokens_total", "/chat でKVキャッシュを再利用してプリフィルを省略したトークン数")
+SCHEDULER_DECISIONS = registry.counter(
+    "llm_scheduler_decisions_total", "スケジューラの判定（admitted / rejected_deadline / expired）", ("decision", "priority"))
+SCHEDULER_WAIT_TIME = registry.histogram(
+    "llm_scheduler_wait_seconds", "スケジューラの待ち行列で推論の開始を待った時間", ("priority",))
+REQUEST_COST = registry.histogram(
+    "llm_request_cost_tokens", "リクエストの推定コスト（プロンプトのトークン数 + max_new_tokens）", ("priority",),
+    buckets=TOKEN_BUCKETS)
+SCHEDULER_INFLIGHT_TOKENS = registry.gauge(
+    "llm_scheduler_inflight_tokens", "実行中のリクエストの推定コストの合計")
+SCHEDULER_QUEUED = registry.gauge(
+    "llm_scheduler_queued_requests", "スケジューラの待ち行列にあるリクエスト数", ("priority",))
+
+
+class MetricsMiddleware:
+    """
+    リクエスト数・処理時間・処理中のリクエスト数を記録するASGIミドルウェア
+
+    BaseHTTPMiddlewareを使わずASGIのsendをフックするだけなので、
+    ストリーミング応答にも影響せずオーバーヘッドもごくわずかです。
+    ストリーミング応答の処理時間は最後のチャンクを送り終えるまでを計測します。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_FLIGHT.dec()
+            # ルートのパステンプレートを使い、ラベルの種類が増えすぎないようにする
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            method = scope.get("method", "")
+            REQUESTS_TOTAL.inc(method=method, path=path, status=status["code"])
+            REQUEST_LATENCY.observe(time.perf_counter() - start, method=method, path=path)
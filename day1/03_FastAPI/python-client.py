@@ -4,6 +4,9 @@
 import requests
 import json
 import time
+import random
+import asyncio
+import httpx
 
 class LLMClient:
     """LLM API クライアントクラス"""
@@ -28,7 +31,7 @@ class LLMClient:
         response = self.session.get(f"{self.api_url}/health")
         return response.json()
     
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, model=None):
         """
         テキスト生成
         
@@ -38,6 +41,7 @@ class LLMClient:
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
         
         Returns:
             dict: 生成結果
@@ -47,7 +51,8 @@ class LLMClient:
             "max_new_tokens": max_new_tokens,
             "temperature": temperature,
             "top_p": top_p,
-            "do_sample": do_sample
+            "do_sample": do_sample,
+            "model": model
         }
         
         start_time = time.time()
@@ -64,6 +69,325 @@ class LLMClient:
         else:
             raise Exception(f"API error: {response.status_code} - {response.text}")
 
+    def generate_batch(self, prompts, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, model=None):
+        """
+        複数プロンプトの一括生成（/generate/batch を1回呼び出す）
+        
+        Args:
+            prompts (list): プロンプト文字列のリスト
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
+        
+        Returns:
+            dict: 入力順に並んだ結果（results）と処理時間。失敗した項目は error に内容が入る
+        """
+        payload = [
+            {
+                "prompt": prompt,
+                "max_new_tokens": max_new_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "do_sample": do_sample,
+                "model": model
+            }
+            for prompt in prompts
+        ]
+        
+        start_time = time.time()
+        response = self.session.post(
+            f"{self.api_url}/generate/batch",
+            json=payload
+        )
+        total_time = time.time() - start_time
+        
+        if response.status_code == 200:
+            result = response.json()
+            result["total_request_time"] = total_time
+            return result
+        else:
+            raise Exception(f"API error: {response.status_code} - {response.text}")
+
+class APIError(Exception):
+    """API がエラー応答を返したことを表す例外"""
+    
+    def __init__(self, status_code, body, retry_after=None):
+        super().__init__(f"API error: {status_code} - {body}")
+        self.status_code = status_code
+        self.body = body
+        self.retry_after = retry_after
+
+class AsyncLLMClient:
+    """
+    LLM API の非同期クライアントクラス
+    
+    接続プールとキープアライブを使って接続を再利用し、429/503 応答や接続エラーは
+    ジッター付きの指数バックオフで再試行します（締め切りに間に合わないとして拒否された503は再試行しません）。
+    各呼び出しの結果には、クライアント側で
+    計測した時間（timing: 接続、最初のバイトまで、合計、再試行回数）が含まれます。
+    
+    使い方:
+        async with AsyncLLMClient(url) as client:
+            results = await client.generate_many(prompts, concurrency=4)
+    """
+    
+    # 再試行の対象とするステータスコード
+    RETRY_STATUS_CODES = (429, 503)
+    # サーバーが締め切りに間に合わないと判断して拒否した503の error（再試行しても間に合わない）
+    DEADLINE_ERROR_CODE = "deadline_exceeded"
+    
+    def __init__(self, api_url, max_connections=10, max_keepalive_connections=10, keepalive_expiry=30.0,
+                 timeout=300.0, connect_timeout=10.0, max_retries=3, backoff_base=0.5, backoff_max=30.0,
+                 api_key=None):
+        """
+        初期化
+        
+        Args:
+            api_url (str): API のベース URL（ngrok URL）
+            max_connections (int, optional): 接続プールの最大接続数
+            max_keepalive_connections (int, optional): キープアライブで保持する最大接続数
+            keepalive_expiry (float, optional): 使われていない接続を保持する秒数
+            timeout (float, optional): 応答を待つ最大秒数（生成に時間がかかるため長めにする）
+            connect_timeout (float, optional): 接続を確立するまでの最大秒数
+            max_retries (int, optional): 429/503 応答や接続エラーのときに再試行する最大回数
+            backoff_base (float, optional): 指数バックオフの基準となる秒数
+            backoff_max (float, optional): 再試行までに待つ最大秒数
+            api_key (str, optional): X-API-Key ヘッダーで送る API キー
+        """
+        self.api_url = api_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        headers = {"X-API-Key": api_key} if api_key else None
+        self.client = httpx.AsyncClient(
+            base_url=self.api_url,
+            headers=headers,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        )
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    async def aclose(self):
+        """接続プールを閉じる"""
+        await self.client.aclose()
+    
+    # --- 内部処理 ---
+    @staticmethod
+    def _payload(prompt, max_new_tokens, temperature, top_p, do_sample, model, priority=None, deadline_ms=None):
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample,
+            "model": model
+        }
+        if priority is not None:
+            payload["priority"] = priority
+        if deadline_ms is not None:
+            payload["deadline_ms"] = deadline_ms
+        return payload
+    
+    def _backoff_delay(self, attempt, retry_after=None):
+        """再試行までに待つ秒数（ジッター付きの指数バックオフ。Retry-After があればそれ以上待つ）"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay += min(self.backoff_max, retry_after)
+        return delay
+    
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return None
+    
+    async def _should_retry(self, response):
+        """
+        再試行する応答かどうか
+        
+        503 のうち Retry-After のないもので、締め切りに間に合わないとして拒否されたもの（error が
+        deadline_exceeded、または deadline_seconds を含む）は、送り直しても間に合わず負荷を増やすだけのため再試行しない
+        """
+        if response.status_code not in self.RETRY_STATUS_CODES:
+            return False
+        if response.status_code != 503 or self._retry_after(response) is not None:
+            return True
+        await response.aread()
+        try:
+            body = response.json()
+        except ValueError:
+            return True
+        if not isinstance(body, dict):
+            return True
+        return body.get("error") != self.DEADLINE_ERROR_CODE and "deadline_seconds" not in body
+    
+    async def _send(self, method, path, json=None, stream=False):
+        """
+        リクエストを送信し、(応答, timing) を返す（429/503 応答や接続エラーは再試行する）
+        
+        stream=True の場合は本文を読み込まずに返すため、呼び出し側で aclose() する必要がある
+        """
+        start = time.perf_counter()
+        retries = 0
+        while True:
+            timing = {"connect": 0.0, "ttfb": None, "total": None, "retries": retries}
+            events = {}
+            
+            async def trace(event_name, info):
+                # 接続（TCP/TLS）の確立と、応答ヘッダーの受信にかかった時間を記録する
+                events[event_name] = time.perf_counter()
+            
+            attempt_start = time.perf_counter()
+            try:
+                request = self.client.build_request(method, path, json=json, extensions={"trace": trace})
+                response = await self.client.send(request, stream=True)
+            except httpx.TransportError as e:
+                if retries >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(retries)
+                print(f"接続エラーのため {delay:.2f}秒後に再試行します: {e}")
+            else:
+                for name in ("connection.connect_tcp", "connection.start_tls"):
+                    if f"{name}.complete" in events and f"{name}.started" in events:
+                        timing["connect"] += events[f"{name}.complete"] - events[f"{name}.started"]
+                headers_received = events.get("http11.receive_response_headers.complete",
+                                              events.get("http2.receive_response_headers.complete"))
+                timing["ttfb"] = (headers_received or time.perf_counter()) - attempt_start
+                
+                if retries < self.max_retries and await self._should_retry(response):
+                    retry_after = self._retry_after(response)
+                    await response.aclose()
+                    delay = self._backoff_delay(retries, retry_after)
+                    print(f"API が {response.status_code} を返したため {delay:.2f}秒後に再試行します")
+                else:
+                    if not stream:
+                        await response.aread()
+                        timing["total"] = time.perf_counter() - start
+                    return response, timing
+            
+            retries += 1
+            await asyncio.sleep(delay)
+    
+    @classmethod
+    def _raise_for_status(cls, response):
+        if response.status_code != 200:
+            raise APIError(response.status_code, response.text, cls._retry_after(response))
+    
+    # --- API ---
+    async def health_check(self):
+        """
+        ヘルスチェック
+        
+        Returns:
+            dict: ヘルスチェック結果
+        """
+        response, _ = await self._send("GET", "/health")
+        return response.json()
+    
+    async def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, model=None,
+                       priority=None, deadline_ms=None):
+        """
+        テキスト生成
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルトモデル）
+            priority (str, optional): 優先度クラス（"interactive" または "batch"）
+            deadline_ms (float, optional): 生成を終えるまでの締め切り（ミリ秒）
+        
+        Returns:
+            dict: 生成結果。timing にクライアント側で計測した時間（秒）が入る
+        
+        Raises:
+            APIError: 再試行しても成功しなかった場合
+        """
+        payload = self._payload(prompt, max_new_tokens, temperature, top_p, do_sample, model, priority, deadline_ms)
+        response, timing = await self._send("POST", "/generate", json=payload)
+        self._raise_for_status(response)
+        result = response.json()
+        result["timing"] = timing
+        result["total_request_time"] = timing["total"]
+        return result
+    
+    async def generate_many(self, prompts, concurrency=4, return_exceptions=False, **kwargs):
+        """
+        複数のプロンプトを同時に最大 concurrency 件ずつ /generate に送信する
+        
+        Args:
+            prompts (list): プロンプト文字列のリスト
+            concurrency (int, optional): 同時に送信する最大リクエスト数
+            return_exceptions (bool, optional): True なら失敗した項目に例外を入れて返す（False なら最初の例外を送出）
+            **kwargs: generate() に渡す生成パラメータ
+        
+        Returns:
+            list: 入力と同じ順に並んだ生成結果
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run(prompt):
+            async with semaphore:
+                return await self.generate(prompt, **kwargs)
+        
+        return await asyncio.gather(*(run(prompt) for prompt in prompts), return_exceptions=return_exceptions)
+    
+    async def stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, model=None,
+                     priority=None, deadline_ms=None):
+        """
+        ストリーミング生成（/generate/stream）のイベントを順に返す非同期ジェネレータ
+        
+        Args:
+            prompt (str) など: generate() と同じ
+        
+        Yields:
+            dict: {"event": "token" | "done" | "error", "data": dict}。
+                  最後のイベントの data["timing"] には接続・最初のバイト・最初のトークン（ttft）・合計の時間が入る
+        
+        Raises:
+            APIError: ストリーミングを開始できなかった場合
+        """
+        payload = self._payload(prompt, max_new_tokens, temperature, top_p, do_sample, model, priority, deadline_ms)
+        start = time.perf_counter()
+        response, timing = await self._send("POST", "/generate/stream", json=payload, stream=True)
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                self._raise_for_status(response)
+            timing["ttft"] = None
+            event, data_lines = "message", []
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data_lines.append(line[len("data:"):].strip())
+                elif not line and data_lines:
+                    # 空行でイベントが区切られる
+                    data = json.loads("\n".join(data_lines))
+                    if event == "token" and timing["ttft"] is None:
+                        timing["ttft"] = time.perf_counter() - start
+                    if event in ("done", "error"):
+                        timing["total"] = time.perf_counter() - start
+                        data["timing"] = timing
+                    yield {"event": event, "data": data}
+                    event, data_lines = "message", []
+        finally:
+            await response.aclose()
+
 # 使用例
 if __name__ == "__main__":
     # ngrok URLを設定（実際のURLに置き換えてください）
@@ -79,9 +403,32 @@ if __name__ == "__main__":
     
     # 単一の質問
     print("Simple question:")
-    result = client.generate([
-        {"prompt": "AIについて100文字で教えてください"}
-    ])
+    result = client.generate("AIについて100文字で教えてください")
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # 非同期クライアントで複数の質問を同時に送信し、ストリーミングでも受け取る
+    async def async_example():
+        async with AsyncLLMClient(NGROK_URL, max_connections=4) as async_client:
+            print("Concurrent questions:")
+            prompts = ["AIとは何ですか？", "機械学習について教えてください", "LLMの使い道を3つ挙げてください"]
+            results = await async_client.generate_many(prompts, concurrency=2, max_new_tokens=128)
+            for prompt, result in zip(prompts, results):
+                timing = result["timing"]
+                print(f"{prompt} -> {result['generated_text'][:50]}... "
+                      f"(connect {timing['connect']:.3f}s, TTFB {timing['ttfb']:.2f}s, total {timing['total']:.2f}s)")
+            print()
+            
+            print("Streaming:")
+            async for event in async_client.stream("AIについて100文字で教えてください", max_new_tokens=128):
+                if event["event"] == "token":
+                    print(event["data"]["text"], end="", flush=True)
+                elif event["event"] == "done":
+                    timing = event["data"]["timing"]
+                    print(f"\n(TTFT {timing['ttft']:.2f}s, total {timing['total']:.2f}s)")
+                else:
+                    print(f"\nError: {event['data']}")
+    
+    asyncio.run(async_example())
@@ -0,0 +1,225 @@
+# registry.py
+# 複数のモデルを名前で切り替えて利用するためのモデルレジストリです
+import gc
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+class UnknownModelError(Exception):
+    """利用が許可されていないモデル名が指定されたことを表す例外"""
+
+
+def estimate_pipeline_memory(pipe):
+    """パイプラインのモデルが占めるメモリ量（パラメータとバッファの合計バイト数）を見積もる"""
+    model = getattr(pipe, "model", pipe)
+    total = 0
+    for tensors in (getattr(model, "parameters", None), getattr(model, "buffers", None)):
+        if tensors is None:
+            continue
+        for tensor in tensors():
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelEntry:
+    """読み込み済みモデルの情報"""
+
+    def __init__(self, name, pipe, memory_bytes, load_time, pinned=False):
+        self.name = name
+        self.pipe = pipe
+        self.memory_bytes = memory_bytes
+        self.load_time = load_time
+        self.pinned = pinned
+        self.in_use = 0  # 推論中の数。0より大きい間は削除しない
+        self.last_used = time.time()
+        self.use_count = 0
+
+    def to_dict(self):
+        return {
+            "memory_bytes": self.memory_bytes,
+            "load_time": self.load_time,
+            "pinned": self.pinned,
+            "in_use": self.in_use,
+            "use_count": self.use_count,
+            "last_used": self.last_used,
+        }
+
+
+class ModelRegistry:
+    """
+    モデルを名前で管理し、必要になったときに読み込むレジストリ
+
+    読み込み済みモデルの合計メモリが memory_budget_bytes を超えると、
+    使われていない（推論中でない）モデルを最も長く使われていない順に削除します。
+    default_model は常に保持され、削除の対象になりません。
+    allowed_models を指定すると、それ以外のモデル名は UnknownModelError になります。
+
+    モデルの読み込みはロックの外で行います。同じモデルを読み込み中に呼び出した側は
+    そのモデルの読み込みだけを待ち、release() や読み込み済みのモデルの get() は読み込みを待ちません。
+    """
+
+    def __init__(self, loader, default_model, memory_budget_bytes=16 * 1024 ** 3, allowed_models=None,
+                 memory_estimator=estimate_pipeline_memory):
+        self.loader = loader
+        self.default_model = default_model
+        self.memory_budget_bytes = memory_budget_bytes
+        self.allowed_models = set(allowed_models) if allowed_models else None
+        if self.allowed_models is not None:
+            self.allowed_models.add(default_model)
+        self.memory_estimator = memory_estimator
+        self.evictions = 0
+        self._entries = {}
+        self._loading = {}  # 読み込み中のモデル名 -> 読み込みの完了を通知する Future
+        self._lock = threading.RLock()
+
+    def resolve(self, name=None):
+        """モデル名を確定する（未指定ならデフォルトモデル）"""
+        name = name or self.default_model
+        if self.allowed_models is not None and name not in self.allowed_models:
+            raise UnknownModelError(f"モデル '{name}' は利用できません。利用可能: {sorted(self.allowed_models)}")
+        return name
+
+    def is_loaded(self, name=None):
+        return self.resolve(name) in self._entries
+
+    @property
+    def total_memory_bytes(self):
+        return sum(entry.memory_bytes for entry in list(self._entries.values()))
+
+    def get(self, name=None):
+        """モデルのパイプラインを返す。読み込まれていなければ読み込む（ブロックする）"""
+        return self.get_entry(name).pipe
+
+    def get_entry(self, name=None):
+        name = self.resolve(name)
+        while True:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    entry.last_used = time.time()
+                    return entry
+                loading = self._loading.get(name)
+                if loading is None:
+                    loading = self._loading[name] = Future()
+                    break
+            # 別のスレッドが読み込み中なので、そのモデルの読み込みだけを待つ（失敗した場合は同じ例外を送出する）
+            loading.result()
+        try:
+            return self._load(name)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(name, None)
+            loading.set_exception(e)
+            raise
+
+    def acquire(self, name=None):
+        """モデルを推論中として確保し、パイプラインを返す（必要なら読み込むためブロックする）"""
+        name = self.resolve(name)
+        while True:
+            entry = self.get_entry(name)
+            with self._lock:
+                # 読み込んでから確保するまでの間に削除されていなければ確保する
+                if self._entries.get(name) is entry:
+                    entry.in_use += 1
+                    entry.use_count += 1
+                    return entry.pipe
+
+    def release(self, name=None):
+        """acquireで確保したモデルを解放する"""
+        with self._lock:
+            entry = self._entries.get(self.resolve(name))
+            if entry is not None:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+
+    @contextmanager
+    def use(self, name=None):
+        """with文の間モデルを推論中として扱い、削除されないようにする"""
+        pipe = self.acquire(name)
+        try:
+            yield pipe
+        finally:
+            self.release(name)
+
+    def _load(self, name):
+        """モデルを読み込んで登録する（ロックを持たずに呼び出す）"""
+        print(f"モデルレジストリ: '{name}' を読み込みます...")
+        start = time.perf_counter()
+        pipe = self.loader(name)
+        load_time = time.perf_counter() - start
+        entry = ModelEntry(
+            name,
+            pipe,
+            memory_bytes=self.memory_estimator(pipe),
+            load_time=load_time,
+            pinned=(name == self.default_model),
+        )
+        with self._lock:
+            self._entries[name] = entry
+            loading = self._loading.pop(name, None)
+        if loading is not None:
+            loading.set_result(entry)
+        print(f"モデルレジストリ: '{name}' を読み込みました ({load_time:.2f}秒, {entry.memory_bytes / 1024 ** 2:.1f}MB)")
+        self._evict_if_needed(keep=name)
+        return entry
+
+    def _evict_if_needed(self, keep=None):
+        """メモリ予算を超えている間、使われていないモデルを古い順に削除する"""
+        with self._lock:
+            candidates = sorted(
+                (entry for entry in self._entries.values()
+                 if not entry.pinned and entry.in_use == 0 and entry.name != keep),
+                key=lambda entry: entry.last_used,
+            )
+        for entry in candidates:
+            if self.total_memory_bytes <= self.memory_budget_bytes:
+                break
+            if self._unload_if_idle(entry):
+                self.evictions += 1
+        if self.total_memory_bytes > self.memory_budget_bytes:
+            print(f"警告: モデルの合計メモリ ({self.total_memory_bytes / 1024 ** 2:.1f}MB) が予算を超えています。"
+                  "推論中または固定されたモデルは削除できません。")
+
+    def _unload_if_idle(self, entry):
+        """候補を選んだ後に推論で確保されていなければ削除する"""
+        with self._lock:
+            if entry.in_use or self._entries.get(entry.name) is not entry:
+                return False
+            del self._entries[entry.name]
+        self._dispose(entry)
+        return True
+
+    def unload(self, name):
+        """モデルをメモリから削除する"""
+        with self._lock:
+            entry = self._entries.pop(name, None)
+        if entry is None:
+            return False
+        self._dispose(entry)
+        return True
+
+    def _dispose(self, entry):
+        """削除したモデルのメモリを解放する（ロックを持たずに呼び出す）"""
+        print(f"モデルレジストリ: '{entry.name}' を削除しました ({entry.memory_bytes / 1024 ** 2:.1f}MB)")
+        # 削除の候補のリストなどが entry を参照していてもモデルを解放できるように参照を外す
+        entry.pipe = None
+        gc.collect()
+        # GPUメモリも解放する（torchが読み込まれている場合のみ）
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        """モデルごとのメモリ使用量や読み込み時間を返す"""
+        # 読み込み中もイベントループを止めないよう、ロックを取らずにスナップショットを返す
+        entries = list(self._entries.items())
+        return {
+            "default_model": self.default_model,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "total_memory_bytes": sum(entry.memory_bytes for _, entry in entries),
+            "evictions": self.evictions,
+            "models": {name: entry.to_dict() for name, entry in entries},
+        }
@@ -0,0 +1,242 @@
+# scheduler.py
+# リクエストのコスト（トークン数）に基づいて推論の実行順を決めるスケジューラです
+# 優先度クラス、締め切り（間に合わないリクエストの早期拒否）、APIキーごとの公平な配分に対応します。
+import asyncio
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# 優先度クラス（先に並んでいるものほど優先される）
+PRIORITIES = ("interactive", "batch")
+DEFAULT_API_KEY = "anonymous"
+
+
+class DeadlineExceededError(Exception):
+    """締め切りまでに生成を終えられないため、リクエストを拒否したことを表す例外"""
+
+    def __init__(self, estimated_seconds, deadline_seconds, expired=False):
+        if expired:
+            message = f"締め切り ({deadline_seconds:.2f}秒) までに推論を開始できませんでした"
+        else:
+            message = f"推定完了時間 ({estimated_seconds:.2f}秒) が締め切り ({deadline_seconds:.2f}秒) を超えています"
+        super().__init__(message)
+        self.estimated_seconds = estimated_seconds
+        self.deadline_seconds = deadline_seconds
+        self.expired = expired  # 待機中に締め切りを過ぎた場合はTrue
+
+
+def estimate_cost(prompt_tokens, max_new_tokens):
+    """リクエストのコストを、プロンプトのトークン数と生成する最大トークン数の合計で見積もる"""
+    return max(1, prompt_tokens + max_new_tokens)
+
+
+class Ticket:
+    """スケジューラに受け付けられたリクエスト1件"""
+
+    _seq = itertools.count()
+
+    def __init__(self, cost, priority, api_key, deadline_at, virtual_start):
+        self.seq = next(self._seq)
+        self.cost = cost
+        self.priority = priority
+        self.api_key = api_key
+        self.deadline_at = deadline_at  # 締め切りの時刻（perf_counter基準）。Noneなら締め切りなし
+        self.virtual_start = virtual_start
+        self.enqueued_at = time.perf_counter()
+        self.dispatched_at = None
+        self.future = None
+        self.processed_tokens = None  # 実際に処理したトークン数（完了時に呼び出し側が設定する。Noneならcostで記録）
+
+    @property
+    def wait_time(self):
+        """待ち行列で待った時間（秒）"""
+        end = self.dispatched_at if self.dispatched_at is not None else time.perf_counter()
+        return end - self.enqueued_at
+
+    def sort_key(self):
+        return (PRIORITIES.index(self.priority), self.virtual_start, self.seq)
+
+
+class TokenBudgetScheduler:
+    """
+    トークン数の予算に基づいて推論の開始を制御するスケジューラ
+
+    - 実行中のリクエストのコストの合計が max_inflight_tokens を超えないように開始を待たせます。
+      先頭のリクエストが予算に収まらないときは、後ろの小さなリクエストにも追い越させません
+      （大きなリクエストが飢餓状態にならないようにするため）。実行中が0件なら予算を超えるものも開始します。
+    - 優先度クラスが高い（interactive）リクエストを先に開始します。
+    - 同じ優先度の中では、APIキーごとに消費したコストに応じた仮想時刻の順（重み付き公平キューイング）に開始します。
+      さらに1つのAPIキーが同時に使えるトークン数を max_tokens_per_key に制限します。
+    - 締め切りが指定されたリクエストは、直近のスループットから推定した完了時間が締め切りを超える場合、
+      待ち行列に入れずに DeadlineExceededError で拒否します。待機中に締め切りを過ぎた場合も拒否します。
+    """
+
+    def __init__(self, max_inflight_tokens=8192, max_tokens_per_key=None, key_weights=None,
+                 initial_tokens_per_second=50.0, throughput_window_seconds=60.0):
+        self.max_inflight_tokens = max_inflight_tokens
+        self.max_tokens_per_key = max_tokens_per_key
+        self.key_weights = dict(key_weights or {})
+        self.initial_tokens_per_second = initial_tokens_per_second
+        self.throughput_window_seconds = throughput_window_seconds
+        self.inflight_tokens = 0
+        self._inflight_by_key = {}
+        self._virtual_finish = {}  # APIキー -> 最後に受け付けたリクエストの仮想終了時刻
+        self._virtual_time = 0.0
+        self._queue = []
+        self._completions = deque()  # (完了時刻, トークン数)
+
+    # --- スループットの推定 ---
+    def record_completion(self, tokens):
+        """完了したトークン数を記録する（完了時間の推定に使う）"""
+        now = time.perf_counter()
+        self._completions.append((now, tokens))
+        while self._completions and now - self._completions[0][0] > self.throughput_window_seconds:
+            self._completions.popleft()
+
+    @property
+    def tokens_per_second(self):
+        """直近に処理されたトークン数から推定したスループット"""
+        if len(self._completions) < 2:
+            return self.initial_tokens_per_second
+        elapsed = self._completions[-1][0] - self._completions[0][0]
+        if elapsed <= 0:
+            return self.initial_tokens_per_second
+        # 最初の完了より前に処理された分は期間に含まれないため除く
+        tokens = sum(tokens for _, tokens in itertools.islice(self._completions, 1, None))
+        return max(tokens / elapsed, 1e-3)
+
+    def estimate_completion_seconds(self, cost, priority):
+        """今受け付けた場合に完了するまでの時間を推定する（実行中と、先に開始される待機中のコストを含める）"""
+        rank = PRIORITIES.index(priority)
+        ahead = sum(ticket.cost for ticket in self._queue if PRIORITIES.index(ticket.priority) <= rank)
+        return (self.inflight_tokens + ahead + cost) / self.tokens_per_second
+
+    # --- 受け付けと開始 ---
+    async def acquire(self, cost, priority="interactive", deadline_seconds=None, api_key=None):
+        """
+        推論を開始できるまで待ち、Ticketを返す（終わったら release する）
+
+        Args:
+            cost (int): リクエストのコスト（estimate_cost で見積もったトークン数）
+            priority (str): 優先度クラス（"interactive" または "batch"）
+            deadline_seconds (float, optional): 今から生成を終えるまでの締め切り（秒）
+            api_key (str, optional): 公平な配分の単位となるAPIキー
+
+        Raises:
+            ValueError: 未知の優先度クラスが指定された場合
+            DeadlineExceededError: 締め切りに間に合わない場合
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"未知の優先度です: {priority}（{', '.join(PRIORITIES)} のいずれか）")
+        api_key = api_key or DEFAULT_API_KEY
+
+        deadline_at = None
+        if deadline_seconds is not None:
+            estimated = self.estimate_completion_seconds(cost, priority)
+            if estimated > deadline_seconds:
+                raise DeadlineExceededError(estimated, deadline_seconds)
+            deadline_at = time.perf_counter() + deadline_seconds
+
+        # 重み付き公平キューイング: 重みが大きいキーほど仮想時刻の進みが遅く、多く配分される
+        weight = self.key_weights.get(api_key, 1.0)
+        virtual_start = max(self._virtual_time, self._virtual_finish.get(api_key, 0.0))
+        self._virtual_finish[api_key] = virtual_start + cost / weight
+
+        ticket = Ticket(cost, priority, api_key, deadline_at, virtual_start)
+        ticket.future = asyncio.get_running_loop().create_future()
+        self._queue.append(ticket)
+        self._dispatch()
+
+        try:
+            if deadline_at is None:
+                await ticket.future
+            else:
+                await asyncio.wait_for(asyncio.shield(ticket.future), timeout=max(0.0, deadline_at - time.perf_counter()))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 開始と同時にタイムアウト・キャンセルされた場合は予算を返す
+                self.release(ticket, completed=False)
+            else:
+                ticket.future.cancel()
+                self._queue.remove(ticket)
+                self._dispatch()
+            if isinstance(e, asyncio.TimeoutError):
+                raise DeadlineExceededError(ticket.wait_time, deadline_seconds, expired=True)
+            raise
+        return ticket
+
+    def release(self, ticket, completed=True, tokens=None):
+        """
+        実行を終えたリクエストの予算を返し、待機中のリクエストを開始する
+
+        Args:
+            ticket (Ticket): acquire で受け取ったTicket
+            completed (bool): 生成を終えたかどうか。失敗・中止した場合はFalseにし、スループットの推定に含めない
+            tokens (int, optional): 実際に処理したトークン数（省略時は ticket.processed_tokens、それもなければ見積もりのコスト）
+        """
+        self.inflight_tokens -= ticket.cost
+        self._inflight_by_key[ticket.api_key] -= ticket.cost
+        if not self._inflight_by_key[ticket.api_key]:
+            del self._inflight_by_key[ticket.api_key]
+        if completed:
+            if tokens is None:
+                tokens = ticket.processed_tokens if ticket.processed_tokens is not None else ticket.cost
+            self.record_completion(tokens)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, cost, priority="interactive", deadline_seconds=None, api_key=None):
+        """
+        with文の間、予算を確保して推論を実行する
+
+        ブロック内で ticket.processed_tokens に実際に処理したトークン数を設定すると、その値でスループットを記録する。
+        例外で抜けた場合は完了として記録しない。
+        """
+        ticket = await self.acquire(cost, priority, deadline_seconds, api_key)
+        try:
+            yield ticket
+        except BaseException:
+            self.release(ticket, completed=False)
+            raise
+        self.release(ticket)
+
+    def _key_has_room(self, ticket):
+        if self.max_tokens_per_key is None:
+            return True
+        used = self._inflight_by_key.get(ticket.api_key, 0)
+        # 実行中のものがなければ、上限を超える大きなリクエストも開始できる
+        return used == 0 or used + ticket.cost <= self.max_tokens_per_key
+
+    def _dispatch(self):
+        """予算の範囲で、優先度と公平性の順に待機中のリクエストを開始する"""
+        self._queue.sort(key=Ticket.sort_key)
+        index = 0
+        while index < len(self._queue):
+            ticket = self._queue[index]
+            if not self._key_has_room(ticket):
+                # このAPIキーは上限に達しているため、他のキーのリクエストを先に開始する
+                index += 1
+                continue
+            if self.inflight_tokens > 0 and self.inflight_tokens + ticket.cost > self.max_inflight_tokens:
+                break
+            self._queue.pop(index)
+            ticket.dispatched_at = time.perf_counter()
+            self.inflight_tokens += ticket.cost
+            self._inflight_by_key[ticket.api_key] = self._inflight_by_key.get(ticket.api_key, 0) + ticket.cost
+            self._virtual_time = max(self._virtual_time, ticket.virtual_start)
+            ticket.future.set_result(None)
+
+    # --- 統計 ---
+    def queued(self, priority=None):
+        """待機中のリクエスト数"""
+        return sum(1 for ticket in self._queue if priority is None or ticket.priority == priority)
+
+    def stats(self):
+        return {
+            "inflight_tokens": self.inflight_tokens,
+            "max_inflight_tokens": self.max_inflight_tokens,
+            "queued": {priority: self.queued(priority) for priority in PRIORITIES},
+            "inflight_tokens_by_key": dict(self._inflight_by_key),
+            "tokens_per_second": self.tokens_per_second,
+        }
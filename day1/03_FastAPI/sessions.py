@@ -0,0 +1,272 @@
+# sessions.py
+# /chat エンドポイントの会話の状態（メッセージ、トークンID、KVキャッシュ）をサーバー側で保持するモジュールです
+# 新しいターンのメッセージだけをトークン化し、KVキャッシュの続きからプリフィルするため、
+# 会話が長くなっても毎ターン会話全体を処理し直す必要がありません。
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from common.prefix_cache import cache_nbytes
+
+TOKEN_ID_BYTES = 8  # トークンID 1つあたりのメモリの目安（バイト）
+
+
+class ChatSession:
+    """1つの会話の状態"""
+
+    def __init__(self, session_id, model_name):
+        self.session_id = session_id
+        self.model_name = model_name
+        self.messages = []             # これまでのメッセージ（{"role", "content"} のリスト）
+        self.token_ids = []            # モデルに入力した、または生成したトークン列（会話全体）
+        self.rendered = ""             # token_ids に対応するチャットテンプレートのテキスト
+        self.past_key_values = None    # token_ids の先頭 cached_tokens 個のKVキャッシュ
+        self.cached_tokens = 0
+        self.nbytes = 0
+        self.turns = 0
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.lock = asyncio.Lock()     # 同じ会話のリクエストを1件ずつ処理する
+
+    def reset_cache(self):
+        self.past_key_values = None
+        self.cached_tokens = 0
+
+    def to_dict(self):
+        return {
+            "session_id": self.session_id,
+            "model": self.model_name,
+            "turns": self.turns,
+            "messages": len(self.messages),
+            "context_tokens": len(self.token_ids),
+            "cached_tokens": self.cached_tokens,
+            "bytes": self.nbytes,
+            "idle_seconds": time.time() - self.last_access,
+        }
+
+
+class SessionStore:
+    """
+    会話のセッションを保持するストア
+
+    最後の利用から idle_ttl_seconds を過ぎたセッションは削除します。
+    KVキャッシュを含む合計バイト数が max_bytes を、セッション数が max_sessions を超えると、
+    最も長く使われていないセッションから削除します（処理中のセッションは削除しません）。
+    """
+
+    def __init__(self, max_sessions=1000, max_bytes=1024 ** 3, idle_ttl_seconds=1800):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.total_bytes = 0
+        self.created = 0
+        self.evictions = {"idle": 0, "memory": 0}
+        self._sessions = OrderedDict()  # session_id -> ChatSession（最後の利用順）
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, model_name):
+        """新しいセッションを作成する"""
+        session = ChatSession(uuid.uuid4().hex, model_name)
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self.created += 1
+            self._evict()
+        return session
+
+    def get(self, session_id):
+        """セッションを返す。存在しない・期限切れの場合はNone"""
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_access = time.time()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def update(self, session):
+        """ターンの処理後にセッションのメモリ使用量を更新し、上限を超えていれば古いセッションを削除する"""
+        nbytes = cache_nbytes(session.past_key_values) if session.past_key_values is not None else 0
+        nbytes += len(session.token_ids) * TOKEN_ID_BYTES
+        with self._lock:
+            session.last_access = time.time()
+            if session.session_id not in self._sessions:
+                return  # 処理中に削除された
+            self.total_bytes += nbytes - session.nbytes
+            session.nbytes = nbytes
+            self._sessions.move_to_end(session.session_id)
+            self._evict()
+
+    def delete(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self.total_bytes -= session.nbytes
+            return session is not None
+
+    def _remove(self, session_id, reason):
+        session = self._sessions.pop(session_id)
+        self.total_bytes -= session.nbytes
+        self.evictions[reason] += 1
+
+    def _evict(self):
+        """期限切れのセッションと、上限を超えた分の古いセッションを削除する（ロックを保持して呼び出す）"""
+        now = time.time()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_access <= self.idle_ttl_seconds:
+                break  # 以降のセッションはより最近使われている
+            if not session.lock.locked():
+                self._remove(session_id, "idle")
+        for session_id, session in list(self._sessions.items()):
+            if self.total_bytes <= self.max_bytes and len(self._sessions) <= self.max_sessions:
+                break
+            if not session.lock.locked():
+                self._remove(session_id, "memory")
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "created": self.created,
+            "evictions": dict(self.evictions),
+        }
+
+
+def render_messages(tokenizer, messages, add_generation_prompt=True):
+    """メッセージのリストをチャットテンプレートでテキストにする（テンプレートがなければ簡単な形式を使う）"""
+    if getattr(tokenizer, "chat_template", None):
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+    text = "".join(f"{message['role']}: {message['content']}\n" for message in messages)
+    return text + ("assistant: " if add_generation_prompt else "")
+
+
+def _tokenize(tokenizer, text, full=False):
+    """テキストをトークン化する（テンプレートの出力には特殊トークンが含まれるため、差分には追加しない）"""
+    add_special_tokens = full and not getattr(tokenizer, "chat_template", None)
+    return tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+
+
+def _slide_window(tokenizer, messages, keep_last, max_prompt_tokens):
+    """
+    古いメッセージから削除して、プロンプトを max_prompt_tokens 以下にする
+
+    system メッセージと、今回のターンで追加した最後の keep_last 件は残す。
+    削除するたびに会話全体のプリフィルが必要になるため、上限の半分まで一度に削除して回数を減らす。
+
+    Returns:
+        tuple: (残したメッセージ, プロンプトのテキスト, トークンID)
+    """
+    target = max_prompt_tokens // 2
+    messages = list(messages)
+    while True:
+        prompt_text = render_messages(tokenizer, messages)
+        input_ids = _tokenize(tokenizer, prompt_text, full=True)
+        if len(input_ids) <= target:
+            return messages, prompt_text, input_ids
+        removable = [i for i, message in enumerate(messages[:len(messages) - keep_last])
+                     if message["role"] != "system"]
+        if not removable:
+            if len(input_ids) <= max_prompt_tokens:
+                return messages, prompt_text, input_ids
+            raise ValueError(f"メッセージが長すぎます（{len(input_ids)}トークン。上限は{max_prompt_tokens}トークン）")
+        # ユーザーとアシスタントの組を崩さないよう、先頭のターンをまとめて削除する
+        first = removable[0]
+        del messages[first]
+        if first < len(messages) - keep_last and messages[first]["role"] == "assistant":
+            del messages[first]
+
+
+def generate_chat_turn(pipe, session, new_messages, max_context_tokens, max_new_tokens=512, do_sample=True,
+                       temperature=0.7, top_p=0.9, use_kv_cache=True):
+    """
+    セッションに新しいメッセージを追加して、アシスタントの応答を生成する
+
+    チャットテンプレートのテキストが前回までの会話の続きになっていれば、追加分だけをトークン化し、
+    KVキャッシュに入っていないトークンだけをプリフィルする。会話が max_context_tokens を超える場合は
+    古いターンを削除して（スライディングウィンドウ）、会話全体をプリフィルし直す。
+
+    Args:
+        pipe: transformersのtext-generationパイプライン（model と tokenizer を使用）
+        session (ChatSession): 会話のセッション（呼び出し側でロックしておく）
+        new_messages (list): 追加するメッセージ（{"role", "content"} のリスト）
+        max_context_tokens (int): 会話（プロンプト + 生成）のトークン数の上限
+        max_new_tokens, do_sample, temperature, top_p: 生成パラメータ
+        use_kv_cache (bool): ターン間でKVキャッシュを保持するかどうか
+
+    Returns:
+        dict: 応答のテキストと、このターンで処理したトークン数の内訳
+    """
+    import torch
+
+    model = pipe.model
+    tokenizer = pipe.tokenizer
+    max_prompt_tokens = max_context_tokens - max_new_tokens
+    if max_prompt_tokens <= 0:
+        raise ValueError(f"max_new_tokens ({max_new_tokens}) が会話の上限 ({max_context_tokens}) 以上です")
+
+    messages = session.messages + list(new_messages)
+    prompt_text = render_messages(tokenizer, messages)
+    truncated = False
+    if session.rendered and prompt_text.startswith(session.rendered):
+        # 前回までの会話の続き: 追加分だけをトークン化する
+        input_ids = session.token_ids + _tokenize(tokenizer, prompt_text[len(session.rendered):])
+    else:
+        # 最初のターン、またはテンプレートの出力が前回の続きにならない場合は会話全体をトークン化する
+        input_ids = _tokenize(tokenizer, prompt_text, full=True)
+        session.reset_cache()
+    if len(input_ids) > max_prompt_tokens:
+        messages, prompt_text, input_ids = _slide_window(tokenizer, messages, len(new_messages), max_prompt_tokens)
+        session.reset_cache()
+        truncated = True
+    if not use_kv_cache:
+        session.reset_cache()
+
+    generate_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": do_sample}
+    if do_sample:
+        generate_kwargs.update(temperature=temperature, top_p=top_p)
+    reused_tokens = session.cached_tokens
+    if session.past_key_values is not None:
+        # キャッシュ済みの部分はプリフィルされず、残りのトークンだけが処理される
+        generate_kwargs["past_key_values"] = session.past_key_values
+
+    input_tensor = torch.tensor([input_ids], device=model.device)
+    with torch.no_grad():
+        outputs = model.generate(
+            input_tensor,
+            attention_mask=torch.ones_like(input_tensor),
+            pad_token_id=tokenizer.pad_token_id,
+            return_dict_in_generate=True,
+            use_cache=True,
+            **generate_kwargs,
+        )
+    generated = outputs.sequences[0, len(input_ids):].tolist()
+    reply = tokenizer.decode(generated, skip_special_tokens=True)
+
+    # 応答を会話に加え、テンプレートでのターンの終わり（区切りのトークンなど）をトークン列にも加える
+    messages = messages + [{"role": "assistant", "content": reply}]
+    full_text = render_messages(tokenizer, messages, add_generation_prompt=False)
+    consumed = prompt_text + tokenizer.decode(generated, skip_special_tokens=False)
+    session.messages = messages
+    session.rendered = full_text
+    if use_kv_cache and full_text.startswith(consumed):
+        session.token_ids = input_ids + generated + _tokenize(tokenizer, full_text[len(consumed):])
+        session.past_key_values = outputs.past_key_values
+        session.cached_tokens = outputs.past_key_values.get_seq_length()
+    else:
+        # 生成したトークン列とテンプレートのテキストが一致しない場合は、次のターンで会話全体をプリフィルし直す
+        session.token_ids = _tokenize(tokenizer, full_text, full=True)
+        session.reset_cache()
+    session.turns += 1
+    return {
+        "text": reply,
+        "prompt_tokens": len(input_ids),
+        "prefill_tokens": len(input_ids) - reused_tokens,
+        "reused_tokens": reused_tokens,
+        "completion_tokens": len(generated),
+        "truncated": truncated,
+    }
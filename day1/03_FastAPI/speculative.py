@@ -0,0 +1,167 @@
+# speculative.py
+# 小さなドラフトモデルで数トークンを先に提案し、本体のモデルの1回の順伝播でまとめて検証する
+# 投機的デコーディング（speculative decoding）の実装です
+# 検証では本体のモデルの貪欲法の予測と一致したトークンだけを採用するため、出力は貪欲法と同じになります。
+import threading
+import time
+
+
+class SpeculativeStats:
+    """投機的デコーディングの統計（受理率と、本体のモデル1回あたりの生成トークン数）"""
+
+    def __init__(self):
+        self.proposed = 0        # ドラフトモデルが提案したトークン数
+        self.accepted = 0        # そのうち本体のモデルが受理したトークン数
+        self.target_forwards = 0  # 本体のモデルの順伝播の回数（プリフィルを除く）
+        self.generated = 0       # 生成したトークン数
+        self.elapsed = 0.0
+        self.prefill_time = 0.0  # プロンプトのプリフィルにかかった時間
+        self._lock = threading.Lock()
+
+    def add(self, other):
+        with self._lock:
+            self.proposed += other.proposed
+            self.accepted += other.accepted
+            self.target_forwards += other.target_forwards
+            self.generated += other.generated
+            self.elapsed += other.elapsed
+            self.prefill_time += other.prefill_time
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_target_forward(self):
+        """本体のモデル1回の順伝播で進んだトークン数（通常のデコードでは1。理論上の高速化率の目安）"""
+        return self.generated / self.target_forwards if self.target_forwards else 0.0
+
+    def to_dict(self):
+        return {
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": self.acceptance_rate,
+            "target_forwards": self.target_forwards,
+            "generated": self.generated,
+            "tokens_per_target_forward": self.tokens_per_target_forward,
+            "tokens_per_second": self.generated / self.elapsed if self.elapsed > 0 else 0.0,
+        }
+
+
+def check_draft_compatible(target, draft):
+    """ドラフトモデルが本体と同じ語彙を使っているか確認する（異なると提案を検証できない）"""
+    target_vocab = target.get_input_embeddings().weight.shape[0]
+    draft_vocab = draft.get_input_embeddings().weight.shape[0]
+    if target_vocab != draft_vocab:
+        raise ValueError(f"ドラフトモデルの語彙数 ({draft_vocab}) が本体のモデル ({target_vocab}) と異なります。"
+                         "同じトークナイザーを使うモデルを指定してください。")
+
+
+def _forward(model, token_ids, past_key_values, device):
+    """トークン列をKVキャッシュの続きとして入力し、(ロジット, KVキャッシュ) を返す"""
+    import torch
+
+    input_tensor = torch.tensor([token_ids], device=device)
+    outputs = model(input_tensor, past_key_values=past_key_values, use_cache=True)
+    return outputs.logits[0], outputs.past_key_values
+
+
+def speculative_generate(target, draft, input_ids, max_new_tokens=512, lookahead=4, eos_token_ids=(),
+                         stats=None):
+    """
+    投機的デコーディングで貪欲法と同じトークン列を生成する
+
+    Args:
+        target: 本体のモデル（AutoModelForCausalLM）
+        draft: ドラフトモデル（本体と同じトークナイザーを使う小さなモデル）
+        input_ids (list): プロンプトのトークンIDのリスト
+        max_new_tokens (int): 生成する最大トークン数
+        lookahead (int): ドラフトモデルが1回に提案するトークン数
+        eos_token_ids (iterable): 生成を終了するトークンID
+        stats (SpeculativeStats, optional): 統計を加算するオブジェクト
+
+    Returns:
+        list: 新たに生成されたトークンIDのリスト
+    """
+    import torch
+
+    start = time.perf_counter()
+    local = SpeculativeStats()
+    eos_token_ids = set(eos_token_ids)
+    target_device = target.device
+    draft_device = draft.device
+    sequence = list(input_ids)
+    generated = []
+
+    with torch.no_grad():
+        # 最後のトークン以外をプリフィルしておく（最後のトークンは次の検証で入力する）
+        target_cache = draft_cache = None
+        if len(sequence) > 1:
+            _, target_cache = _forward(target, sequence[:-1], None, target_device)
+            _, draft_cache = _forward(draft, sequence[:-1], None, draft_device)
+        target_len = draft_len = len(sequence) - 1  # それぞれのKVキャッシュに入っているトークン数
+        local.prefill_time = time.perf_counter() - start
+
+        while len(generated) < max_new_tokens:
+            remaining = max_new_tokens - len(generated)
+            # 検証で必ず1トークン（修正またはボーナス）が追加されるため、提案は残り-1まで
+            k = min(lookahead, remaining - 1)
+
+            # 1. ドラフトモデルで k トークンを貪欲に提案する
+            proposal = []
+            pending = sequence[draft_len:]
+            for _ in range(k):
+                logits, draft_cache = _forward(draft, pending, draft_cache, draft_device)
+                draft_len += len(pending)
+                token = int(torch.argmax(logits[-1]))
+                proposal.append(token)
+                if token in eos_token_ids:
+                    break
+                pending = [token]
+
+            # 2. 本体のモデルで、未処理のトークンと提案をまとめて1回で検証する
+            verify_input = sequence[target_len:] + proposal
+            logits, target_cache = _forward(target, verify_input, target_cache, target_device)
+            local.target_forwards += 1
+            # 提案の i 番目の位置に対する本体の予測は、未処理のトークン数 - 1 + i 番目のロジット
+            offset = len(verify_input) - len(proposal) - 1
+            predictions = torch.argmax(logits[offset:], dim=-1).tolist()
+
+            accepted = 0
+            while accepted < len(proposal) and proposal[accepted] == predictions[accepted]:
+                accepted += 1
+            # 受理したトークンに、本体の予測（最初に一致しなかった位置の修正、または全受理時の次のトークン）を加える
+            new_tokens = proposal[:accepted] + [predictions[accepted]]
+            local.proposed += len(proposal)
+            local.accepted += accepted
+
+            # 3. 終了条件を確認しながらトークンを追加する
+            finished = False
+            for token in new_tokens:
+                if token in eos_token_ids:
+                    finished = True
+                    break
+                sequence.append(token)
+                generated.append(token)
+                if len(generated) >= max_new_tokens:
+                    finished = True
+                    break
+            if finished:
+                break
+
+            # 4. 採用されなかった提案の分をKVキャッシュから取り除く（最後のトークンは次の検証で入力する）
+            # （crop に負の値を渡すと、末尾からその数だけ取り除く）
+            keep = len(sequence) - 1
+            target_len += len(verify_input)
+            if target_len > keep:
+                target_cache.crop(keep - target_len)
+                target_len = keep
+            if draft_len > keep:
+                draft_cache.crop(keep - draft_len)
+                draft_len = keep
+
+    local.generated = len(generated)
+    local.elapsed = time.perf_counter() - start
+    if stats is not None:
+        stats.add(local)
+    return generated
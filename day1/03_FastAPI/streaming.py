@@ -0,0 +1,176 @@
+# streaming.py
+# バックグラウンドスレッドで生成したトークンを逐次受け取るためのモジュールです
+import asyncio
+import json
+import threading
+import time
+import traceback
+
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+
+class CancelCriteria(StoppingCriteria):
+    """キャンセルが要求されたら生成を打ち切る停止条件"""
+
+    def __init__(self, cancel_event: threading.Event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.cancel_event.is_set()
+
+
+class TimedTextStreamer(TextIteratorStreamer):
+    """
+    生成トークン数と最初のトークンが届いた時刻を記録するストリーマー
+
+    loop を指定すると、テキストの断片をそのイベントループの asyncio.Queue に入れ、
+    async for で読み出せるようにします（読み出しのためにスレッドを使いません）。
+    timeout は生成が始まった後（generation_started が True になった後）に次のテキストを待つ最大時間で、
+    推論ワーカーの空きを待っている間は数えません。
+    """
+
+    def __init__(self, tokenizer, loop=None, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.generated_tokens = 0
+        self.first_token_time = None
+        self.loop = loop
+        self.async_queue = asyncio.Queue() if loop is not None else None
+        self.generation_started = False
+
+    def put(self, value):
+        # 最初のputはプロンプトなので数えない
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+            self.generated_tokens += value.numel()
+        super().put(value)
+
+    def on_finalized_text(self, text, stream_end=False):
+        if self.loop is None:
+            super().on_finalized_text(text, stream_end=stream_end)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.async_queue.put_nowait, text)
+            if stream_end:
+                self.loop.call_soon_threadsafe(self.async_queue.put_nowait, self.stop_signal)
+        except RuntimeError:
+            # イベントループが終了している（サーバーの停止中）場合は読み出す側がいない
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                value = await asyncio.wait_for(self.async_queue.get(), self.timeout)
+                break
+            except TimeoutError:
+                # 推論ワーカーの空きを待っている間はタイムアウトにしない
+                if self.generation_started:
+                    raise
+        if value is self.stop_signal:
+            raise StopAsyncIteration
+        return value
+
+
+class StreamingGeneration:
+    """
+    1件のプロンプトをバックグラウンドスレッドで生成し、テキストを逐次取り出せるようにする
+
+    イテレートするとテキストの断片が順に得られます。cancel() を呼ぶと
+    次のデコードステップで生成が止まります。
+    loop を指定した場合は async for で読み出し、生成は start() の代わりに run() を
+    推論ワーカーのスレッドプールなどで実行します。
+    """
+
+    def __init__(self, pipe, prompt, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9,
+                 timeout=300.0, loop=None):
+        self.pipe = pipe
+        self.prompt = prompt
+        self.generate_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": do_sample}
+        if do_sample:
+            self.generate_kwargs.update(temperature=temperature, top_p=top_p)
+        self.cancel_event = threading.Event()
+        self.streamer = TimedTextStreamer(pipe.tokenizer, loop=loop, skip_prompt=True, skip_special_tokens=True,
+                                          timeout=timeout)
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self._thread = threading.Thread(target=self._run, name="stream-generation", daemon=True)
+
+    def start(self):
+        """生成スレッドを開始する"""
+        self.start_time = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """生成の中止を要求する"""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def run(self):
+        """呼び出したスレッドで生成する（開始前に中止された場合は何もせずに終了する）"""
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        if self.cancelled:
+            self.streamer.end()
+            self.end_time = time.perf_counter()
+            return
+        self.streamer.generation_started = True
+        self._run()
+
+    def _run(self):
+        try:
+            tokenizer = self.pipe.tokenizer
+            inputs = tokenizer(self.prompt, return_tensors="pt").to(self.pipe.model.device)
+            self.pipe.model.generate(
+                **inputs,
+                streamer=self.streamer,
+                stopping_criteria=StoppingCriteriaList([CancelCriteria(self.cancel_event)]),
+                pad_token_id=tokenizer.pad_token_id,
+                **self.generate_kwargs,
+            )
+        except Exception as e:
+            print(f"ストリーミング生成中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            self.error = e
+            # 読み出し側が待ち続けないように終了を通知
+            self.streamer.end()
+        finally:
+            self.end_time = time.perf_counter()
+
+    def __iter__(self):
+        return iter(self.streamer)
+
+    def __aiter__(self):
+        return self.streamer.__aiter__()
+
+    def stats(self):
+        """TTFT、トークン/秒、合計時間などの統計を返す"""
+        end_time = self.end_time or time.perf_counter()
+        first = self.streamer.first_token_time
+        total_time = end_time - self.start_time
+        decode_time = end_time - first if first is not None else 0.0
+        tokens = self.streamer.generated_tokens
+        return {
+            "ttft": (first - self.start_time) if first is not None else None,
+            "total_time": total_time,
+            "generated_tokens": tokens,
+            # 最初のトークン以降の生成速度
+            "tokens_per_second": (tokens - 1) / decode_time if tokens > 1 and decode_time > 0 else 0.0,
+            "cancelled": self.cancelled,
+        }
+
+
+def format_sse(data, event=None):
+    """Server-Sent Events形式の文字列を作成する"""
+    message = ""
+    if event:
+        message += f"event: {event}\n"
+    message += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return message
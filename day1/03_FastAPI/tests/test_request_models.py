@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+# 03_FastAPI のモジュールを読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+from scheduler import estimate_cost  # noqa: E402
+
+
+class WhitespaceTokenizer:
+    """空白で区切った単語を1トークンとして数えるテスト用のトークナイザー"""
+
+    model_max_length = 1024
+
+    def __call__(self, text):
+        return {"input_ids": list(range(len(text.split())))}
+
+
+class TokenizerPipeline:
+    tokenizer = WhitespaceTokenizer()
+
+
+@pytest.fixture
+def tokenizer_pipeline(monkeypatch):
+    """モデルを読み込まずにトークン化できるようにする"""
+    pipe = TokenizerPipeline()
+    monkeypatch.setattr(app, "tokenizer_pipeline", lambda model_name=None: (pipe, "test-model"))
+    monkeypatch.setattr(app, "context_limit", lambda model_name=None: WhitespaceTokenizer.model_max_length)
+    return pipe
+
+
+@pytest.mark.parametrize("model", [app.SimpleGenerationRequest, app.ChatRequest])
+def test_null_max_new_tokens_uses_default(model):
+    """max_new_tokens に null を指定すると既定値になることを確認"""
+    fields = {"prompt": "こんにちは"} if model is app.SimpleGenerationRequest else {"messages": []}
+    request = model.model_validate({**fields, "max_new_tokens": None})
+    assert request.max_new_tokens == app.DEFAULT_MAX_NEW_TOKENS
+
+
+def test_explicit_max_new_tokens_is_kept():
+    """max_new_tokens を指定した場合はその値を使うことを確認"""
+    request = app.SimpleGenerationRequest.model_validate({"prompt": "こんにちは", "max_new_tokens": 8})
+    assert request.max_new_tokens == 8
+
+
+def test_null_max_new_tokens_can_be_tokenized_and_costed(tokenizer_pipeline):
+    """max_new_tokens が null のリクエストもトークン化とコストの見積もりができることを確認"""
+    request = app.SimpleGenerationRequest.model_validate({"prompt": "a b c", "max_new_tokens": None})
+    tokenized = app.tokenize_request(request, "test-model")
+    assert tokenized.token_count == 3
+    assert estimate_cost(tokenized.token_count, request.max_new_tokens) == 3 + app.DEFAULT_MAX_NEW_TOKENS
@@ -0,0 +1,153 @@
+# tokenization.py
+# 推論の前にプロンプトをトークン化し、コンテキスト長を超えるプロンプトをモデルに渡す前に拒否・切り詰めるモジュールです
+# トークン化の結果はLRUキャッシュに保持し、スケジューラのコスト見積もり・メトリクス・推論で使い回します。
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Tuple
+
+OVERFLOW_POLICIES = ("reject", "truncate")
+
+
+class PromptTooLongError(Exception):
+    """プロンプトと max_new_tokens の合計がコンテキスト長を超える場合のエラー"""
+
+    def __init__(self, prompt_tokens, max_new_tokens, context_window):
+        self.prompt_tokens = prompt_tokens
+        self.max_new_tokens = max_new_tokens
+        self.context_window = context_window
+        super().__init__(
+            f"プロンプトが長すぎます（{prompt_tokens}トークン + max_new_tokens {max_new_tokens} が"
+            f"コンテキスト長 {context_window} を超えています）"
+        )
+
+
+@dataclass
+class TokenizedPrompt:
+    """トークン化済みのプロンプト"""
+    prompt: str                 # 推論に使うプロンプト（切り詰めた場合は切り詰め後のテキスト）
+    token_ids: Tuple[int, ...]
+    original_tokens: int        # 切り詰める前のトークン数
+    truncated: bool = False
+
+    @property
+    def token_count(self):
+        return len(self.token_ids)
+
+
+def context_window(pipe):
+    """モデルが扱える最大のトークン数（モデルの設定から取得できなければNone）"""
+    model_config = getattr(pipe.model, "config", None)
+    for attr in ("max_position_embeddings", "n_positions", "max_sequence_length"):
+        value = getattr(model_config, attr, None)
+        if value:
+            return int(value)
+    # トークナイザーの既定値は上限がないことを表す非常に大きな値のことがある
+    limit = getattr(pipe.tokenizer, "model_max_length", None)
+    return int(limit) if limit and limit < 10 ** 7 else None
+
+
+class TokenizedPromptCache:
+    """
+    (モデル名, プロンプト) -> トークンID列 のLRUキャッシュ
+
+    同じプロンプトはリクエストの受付、スケジューラのコスト見積もり、推論、メトリクスの記録で
+    何度もトークン化されるため、1回目の結果を保持して使い回します。
+    エントリ数が max_entries を、概算の合計バイト数が max_bytes を超えると古いものから削除します。
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # (モデル名, プロンプト) -> (トークンID列, バイト数)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(prompt, token_ids):
+        # 文字列は1文字最大4バイト、トークンIDは1つ8バイトとして概算する
+        return len(prompt) * 4 + len(token_ids) * 8
+
+    def encode(self, tokenizer, model_name, prompt):
+        """プロンプトをトークン化する（キャッシュにあればトークン化しない）"""
+        key = (model_name, prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        token_ids = tuple(tokenizer(prompt)["input_ids"])
+        size = self._entry_size(prompt, token_ids)
+        if size > self.max_bytes:
+            return token_ids
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (token_ids, size)
+                self.total_bytes += size
+                while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.total_bytes -= evicted_size
+        return token_ids
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def _truncate_left(cache, tokenizer, model_name, token_ids, max_prompt_tokens):
+    """プロンプトの先頭を削って max_prompt_tokens 以下にし、(テキスト, トークンID列) を返す（直近の内容を残す）"""
+    bos_token_id = getattr(tokenizer, "bos_token_id", None)
+    keep = max_prompt_tokens
+    for _ in range(4):
+        tail = list(token_ids[-keep:]) if keep > 0 else []
+        if tail and bos_token_id is not None and tail[0] == bos_token_id:
+            tail = tail[1:]
+        text = tokenizer.decode(tail, skip_special_tokens=True)
+        new_ids = cache.encode(tokenizer, model_name, text)
+        if len(new_ids) <= max_prompt_tokens:
+            return text, new_ids
+        # デコードし直すとトークンの区切りが変わることがあるため、超えた分だけさらに削る
+        keep -= len(new_ids) - max_prompt_tokens
+    raise PromptTooLongError(len(token_ids), 0, max_prompt_tokens)
+
+
+def prepare_prompt(cache, tokenizer, model_name, prompt, max_new_tokens, window, overflow="reject"):
+    """
+    プロンプトをトークン化し、コンテキスト長に収まるか確認する
+
+    Args:
+        cache (TokenizedPromptCache): トークン化の結果のキャッシュ
+        tokenizer: モデルのトークナイザー
+        model_name (str): キャッシュのキーにするモデル名
+        prompt (str): プロンプト
+        max_new_tokens (int): 生成する最大トークン数
+        window (int, optional): コンテキスト長（Noneなら確認しない）
+        overflow (str): 超えた場合の動作。"reject"（PromptTooLongErrorを送出）または "truncate"（先頭を削る）
+
+    Returns:
+        TokenizedPrompt: トークン化済みのプロンプト
+    """
+    token_ids = cache.encode(tokenizer, model_name, prompt)
+    if window is None or len(token_ids) + max_new_tokens <= window:
+        return TokenizedPrompt(prompt, token_ids, len(token_ids))
+    max_prompt_tokens = window - max_new_tokens
+    if overflow != "truncate" or max_prompt_tokens <= 0:
+        raise PromptTooLongError(len(token_ids), max_new_tokens, window)
+    text, new_ids = _truncate_left(cache, tokenizer, model_name, token_ids, max_prompt_tokens)
+    return TokenizedPrompt(text, new_ids, len(token_ids), truncated=True)
@@ -0,0 +1,151 @@
+# cpu_profile.py
+# GPUのない環境で推論を速くするためのCPU向けプロファイル（スレッド数の調整、int8動的量子化、ONNX Runtime）です
+#
+# プロファイル:
+#   "default": float32 のまま実行する（CPUではbfloat16より速いことが多い）
+#   "int8":    Linear層の重みをint8に動的量子化する（メモリ削減と高速化。精度はわずかに低下する）
+#   "onnx":    optimum でONNX形式に書き出し、ONNX Runtimeで実行する（optimum[onnxruntime] が必要）
+import os
+import warnings
+
+CPU_PROFILES = ("default", "int8", "onnx")
+
+
+def default_num_threads():
+    """推論に使うスレッド数の既定値（利用できるCPUコア数。ハイパースレッドの分は除く）"""
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+    # 論理コアの半分（物理コア数の目安）を使うと、行列演算ではハイパースレッドより速いことが多い
+    return max(1, available // 2) if available > 2 else available
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    """
+    torchのスレッド数を設定する
+
+    Args:
+        num_threads (int, optional): 演算内の並列数（省略時は default_num_threads()）
+        num_interop_threads (int, optional): 演算間の並列数（並列処理の開始前にしか変更できない）
+
+    Returns:
+        int: 設定したスレッド数
+    """
+    import torch
+
+    num_threads = num_threads or default_num_threads()
+    torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            print(f"警告: interopスレッド数を変更できませんでした: {e}")
+    return num_threads
+
+
+def _conv1d_to_linear(model):
+    """GPT-2系のConv1D層を同じ計算をするLinear層に置き換える（動的量子化の対象にするため）"""
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features, dtype=child.weight.dtype)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
+
+def quantize_dynamic_int8(model):
+    """Linear層の重みをint8に動的量子化したモデルを返す（活性化は実行時に量子化される）"""
+    import torch
+
+    model = _conv1d_to_linear(model.float())
+    # 出力層（lm_head）は量子化すると精度の低下が大きいため、float32のまま残す
+    output_layer = model.get_output_embeddings()
+    targets = {name for name, module in model.named_modules()
+               if isinstance(module, torch.nn.Linear) and module is not output_layer}
+    with warnings.catch_warnings():
+        # torch.ao.quantization は非推奨の警告を出すが、CPUの動的量子化はまだこちらが手軽に使える
+        warnings.simplefilter("ignore")
+        from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+        quantized = quantize_dynamic(model, {name: default_dynamic_qconfig for name in targets}, dtype=torch.qint8)
+    quantized.eval()
+    return quantized
+
+
+def export_onnx_model(model_name, export_dir=None):
+    """
+    optimum でモデルをONNX形式に書き出し、ONNX Runtimeのモデルとして読み込む
+
+    export_dir に書き出し済みのモデルがあれば、それを読み込む（書き出しには時間がかかるため）
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise ImportError("onnx プロファイルには optimum[onnxruntime] が必要です: "
+                          "pip install 'optimum[onnxruntime]'") from e
+
+    if export_dir and os.path.exists(os.path.join(export_dir, "config.json")):
+        print(f"書き出し済みのONNXモデルを読み込みます: {export_dir}")
+        return ORTModelForCausalLM.from_pretrained(export_dir)
+    print(f"モデル '{model_name}' をONNX形式に書き出しています...")
+    ort_model = ORTModelForCausalLM.from_pretrained(model_name, export=True)
+    if export_dir:
+        ort_model.save_pretrained(export_dir)
+    return ort_model
+
+
+def create_cpu_pipeline(model_name, profile="default", num_threads=None, onnx_dir=None, model=None, tokenizer=None):
+    """
+    CPU向けのプロファイルでtext-generationパイプラインを作成する
+
+    Args:
+        model_name (str): モデル名またはパス
+        profile (str): "default" / "int8" / "onnx"
+        num_threads (int, optional): torchのスレッド数（省略時は default_num_threads()）
+        onnx_dir (str, optional): onnx プロファイルで書き出したモデルを保存・再利用するディレクトリ
+        model, tokenizer (optional): 読み込み済みのモデルとトークナイザー（比較用。onnx以外で使う）
+
+    Returns:
+        transformers.Pipeline: CPUで動作するパイプライン
+    """
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+
+    if profile not in CPU_PROFILES:
+        raise ValueError(f"未知のCPUプロファイルです: {profile}（{', '.join(CPU_PROFILES)} のいずれか）")
+    threads = configure_threads(num_threads)
+    print(f"CPUプロファイル: {profile}（スレッド数: {threads}）")
+
+    tokenizer = tokenizer or AutoTokenizer.from_pretrained(model_name)
+    if profile == "onnx":
+        model = export_onnx_model(model_name, onnx_dir)
+    else:
+        # CPUではbfloat16の行列演算が遅い環境が多いため、float32で読み込む
+        model = model or AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        model = model.float().eval()
+        if profile == "int8":
+            model = quantize_dynamic_int8(model)
+    return pipeline("text-generation", model=model, tokenizer=tokenizer, device="cpu")
+
+
+def is_onnx_model(model):
+    """ONNX Runtimeで実行するモデルかどうか（KVキャッシュを直接扱う機能は使えない）"""
+    return type(model).__module__.startswith("optimum.")
+
+
+def model_size_bytes(model):
+    """モデルの重み（量子化済みの重みを含む）のバイト数を返す"""
+    total = 0
+    for value in model.state_dict().values():
+        if hasattr(value, "element_size") and hasattr(value, "numel"):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, tuple):
+            # 量子化されたLinear層の (重み, バイアス)
+            total += sum(t.numel() * t.element_size() for t in value if hasattr(t, "numel"))
+    return total
@@ -0,0 +1,182 @@
+# inference.py
+# 02_streamlit_app と 03_FastAPI で共有するテキスト生成の処理です
+# 生成結果のトークンIDからプロンプトの部分を切り落としてから、新しく生成されたトークンだけをデコードします。
+# 生成されたテキスト全体からプロンプトを探して取り除く処理（str.find）や、プロンプトのデコードし直しが不要になり、
+# 出力の中にプロンプトと同じ文字列が現れても誤って切り取ることがありません。
+
+import time
+
+FALLBACK_RESPONSE = "応答を生成できませんでした。"
+
+
+class GenerationTimer:
+    """
+    model.generate に streamer として渡し、プリフィル（最初のトークンまで）とデコードの時間を計測する
+
+    generate は最初にプロンプトを、その後はステップごとに生成したトークンを put に渡し、最後に end を呼ぶ。
+    テキストをデコードしないため、バッチでの生成にも渡せる（複数回 generate した場合は最初の回のプリフィルを計測する）。
+    """
+
+    def __init__(self):
+        self.prompt_time = None
+        self.first_token_time = None
+        self.end_time = None
+
+    def put(self, value):
+        now = time.perf_counter()
+        if self.prompt_time is None:
+            self.prompt_time = now
+        elif self.first_token_time is None:
+            self.first_token_time = now
+
+    def end(self):
+        self.end_time = time.perf_counter()
+
+    @property
+    def prefill_time(self):
+        """プロンプトを受け取ってから最初のトークンが生成されるまでの秒数（生成しなかった場合はNone）"""
+        if self.prompt_time is None or self.first_token_time is None:
+            return None
+        return self.first_token_time - self.prompt_time
+
+    @property
+    def decode_time(self):
+        """最初のトークン以降のデコードにかかった秒数（生成しなかった場合はNone）"""
+        if self.first_token_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.first_token_time
+
+
+def generation_kwargs(max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9):
+    """model.generate に渡す生成パラメータ（貪欲法ではサンプリングのパラメータを渡さない）"""
+    kwargs = {"max_new_tokens": max_new_tokens, "do_sample": do_sample}
+    if do_sample:
+        kwargs.update(temperature=temperature, top_p=top_p)
+    return kwargs
+
+
+def pad_token_id(tokenizer):
+    return tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+
+def stop_token_ids(pipe):
+    """生成の終了を表すトークンID（EOSとパディング）のリスト"""
+    eos_token_id = getattr(getattr(pipe.model, "generation_config", None), "eos_token_id", None)
+    ids = list(eos_token_id) if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
+    ids.append(pad_token_id(pipe.tokenizer))
+    return [token for token in ids if token is not None]
+
+
+def generated_lengths(pipe, generated_ids):
+    """
+    生成部分のトークンID（バッチ）から、系列ごとに生成したトークン数を求める
+
+    先に終わった系列の後ろに詰められたパディングは数えない（最初の終了トークンまでを数える）。
+    """
+    import torch
+
+    stop_ids = torch.tensor(stop_token_ids(pipe), device=generated_ids.device)
+    is_stop = torch.isin(generated_ids, stop_ids)
+    first_stop = is_stop.int().argmax(dim=1) + 1
+    full = torch.full_like(first_stop, generated_ids.shape[1])
+    return torch.where(is_stop.any(dim=1), first_stop, full).tolist()
+
+
+def chat_input_ids(tokenizer, messages):
+    """チャットテンプレートを適用したトークンIDのリストを返す"""
+    input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+    # transformersのバージョンによっては辞書形式で返る
+    if hasattr(input_ids, "keys"):
+        input_ids = input_ids["input_ids"]
+    return list(input_ids)
+
+
+def generate_from_ids(pipe, input_ids, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9,
+                      past_key_values=None, streamer=None, stopping_criteria=None, return_token_count=False):
+    """
+    1件のトークン列から生成し、新しく生成された部分だけをデコードして返す
+
+    Args:
+        pipe: transformersのtext-generationパイプライン（model と tokenizer を使用）
+        input_ids (list): プロンプトのトークンIDのリスト
+        max_new_tokens, do_sample, temperature, top_p: 生成パラメータ
+        past_key_values (optional): input_ids の接頭辞のKVキャッシュ（その部分のプリフィルを省略する）
+        streamer (optional): 生成したトークンを逐次受け取るストリーマー（TextIteratorStreamer など）
+        stopping_criteria (StoppingCriteriaList, optional): 生成を途中で止める条件（中止の要求など）
+        return_token_count (bool): 生成したトークン数も返すかどうか
+
+    Returns:
+        str: 生成されたテキスト（return_token_count=True の場合は (テキスト, 生成したトークン数)）
+    """
+    import torch
+
+    kwargs = generation_kwargs(max_new_tokens, do_sample, temperature, top_p)
+    if past_key_values is not None:
+        kwargs["past_key_values"] = past_key_values
+    if streamer is not None:
+        kwargs["streamer"] = streamer
+    if stopping_criteria is not None:
+        kwargs["stopping_criteria"] = stopping_criteria
+    input_tensor = torch.tensor([list(input_ids)], device=pipe.model.device)
+    with torch.no_grad():
+        output_ids = pipe.model.generate(
+            input_tensor,
+            attention_mask=torch.ones_like(input_tensor),
+            pad_token_id=pad_token_id(pipe.tokenizer),
+            **kwargs,
+        )
+    generated = output_ids[0, input_tensor.shape[1]:]
+    text = pipe.tokenizer.decode(generated, skip_special_tokens=True)
+    return (text, len(generated)) if return_token_count else text
+
+
+def generate_texts(pipe, prompts, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9, batch_size=None,
+                   streamer=None, return_token_counts=False):
+    """
+    複数のプロンプトから生成し、プロンプトごとに新しく生成された部分のテキストを返す
+
+    左詰めのパディングでまとめて生成するため、出力のトークン列は入力の長さの位置から先がすべて新しいトークンになる。
+
+    Args:
+        pipe: transformersのtext-generationパイプライン（model と tokenizer を使用）
+        prompts (list): プロンプトのリスト
+        max_new_tokens, do_sample, temperature, top_p: 生成パラメータ
+        batch_size (int, optional): 1回の generate でまとめる件数（省略時はすべて）
+        streamer (optional): 生成したトークンを受け取るストリーマー（GenerationTimer など、バッチに対応したもの）
+        return_token_counts (bool): プロンプトごとの生成したトークン数も返すかどうか
+
+    Returns:
+        list: 生成されたテキストのリスト（prompts と同じ順序）。
+            return_token_counts=True の場合は (テキストのリスト, 生成したトークン数のリスト)
+    """
+    import torch
+
+    tokenizer = pipe.tokenizer
+    kwargs = generation_kwargs(max_new_tokens, do_sample, temperature, top_p)
+    if streamer is not None:
+        kwargs["streamer"] = streamer
+    batch_size = batch_size or len(prompts) or 1
+    texts = []
+    counts = []
+    for start in range(0, len(prompts), batch_size):
+        batch = list(prompts[start:start + batch_size])
+        encoded = tokenizer(batch, return_tensors="pt", padding=True, padding_side="left").to(pipe.model.device)
+        with torch.no_grad():
+            output_ids = pipe.model.generate(**encoded, pad_token_id=pad_token_id(tokenizer), **kwargs)
+        generated = output_ids[:, encoded["input_ids"].shape[1]:]
+        texts.extend(tokenizer.batch_decode(generated, skip_special_tokens=True))
+        if return_token_counts:
+            counts.extend(generated_lengths(pipe, generated))
+    return (texts, counts) if return_token_counts else texts
+
+
+def generate_chat(pipe, messages, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9):
+    """チャット形式のメッセージにチャットテンプレートを適用して生成し、アシスタントの応答だけを返す"""
+    input_ids = chat_input_ids(pipe.tokenizer, messages)
+    return generate_from_ids(pipe, input_ids, max_new_tokens, do_sample, temperature, top_p)
+
+
+def clean_response(text, fallback=FALLBACK_RESPONSE):
+    """生成されたテキストの前後の空白を取り除く（空になった場合は fallback を返す）"""
+    text = (text or "").strip()
+    return text or fallback
@@ -0,0 +1,182 @@
+# prefix_cache.py
+# 共通のプロンプト接頭辞（システムプロンプトなど）のKVキャッシュを再利用し、プリフィルを省略するためのモジュールです
+import copy
+import threading
+from collections import OrderedDict
+
+from .inference import generate_from_ids
+
+
+def cache_nbytes(past_key_values):
+    """KVキャッシュが占めるバイト数を数える"""
+    total = 0
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        # 古いtransformersのDynamicCache、またはタプル形式のキャッシュ
+        tensors = list(getattr(past_key_values, "key_cache", [])) + list(getattr(past_key_values, "value_cache", []))
+        if not tensors and isinstance(past_key_values, (tuple, list)):
+            tensors = [t for layer in past_key_values for t in layer]
+    for tensor in tensors:
+        if tensor is not None and hasattr(tensor, "numel"):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class PrefixKVCache:
+    """
+    トークン列の接頭辞ごとにKVキャッシュ（past_key_values）を保持するキャッシュ
+
+    トークン列を block_size ごとのブロックに分け、先頭からの連鎖ハッシュで接頭辞を識別します。
+    同じ接頭辞が min_occurrences 回以上現れたらそのKVキャッシュを保存し、以降のリクエストでは
+    最も長く一致する接頭辞のKVキャッシュを使って残りのトークンだけをプリフィルします。
+    保存したKVキャッシュの合計が max_bytes を超えると、最も長く使われていないものから削除します。
+    """
+
+    def __init__(self, max_bytes=512 * 1024 ** 2, block_size=16, min_occurrences=2, max_tracked_prefixes=10000):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.min_occurrences = min_occurrences
+        self.max_tracked_prefixes = max_tracked_prefixes
+        self.total_bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.prefill_tokens_saved = 0
+        self.prefill_tokens_total = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # 接頭辞ハッシュ -> (接頭辞のトークン列, KVキャッシュ, バイト数)
+        self._seen = OrderedDict()     # 接頭辞ハッシュ -> 出現回数
+        self._lock = threading.Lock()
+
+    def _block_hashes(self, token_ids, usable):
+        """先頭 usable トークンまでの、ブロック境界ごとの接頭辞ハッシュを返す"""
+        hashes = []
+        h = None
+        for end in range(self.block_size, usable + 1, self.block_size):
+            h = hash((h, tuple(token_ids[end - self.block_size:end])))
+            hashes.append((end, h))
+        return hashes
+
+    def lookup(self, token_ids):
+        """
+        最も長く一致する接頭辞のKVキャッシュを探す
+
+        Returns:
+            tuple: (接頭辞の長さ, KVキャッシュのコピー, 新たに保存すべき接頭辞の長さ)。
+                   一致しなければKVキャッシュはNone。保存すべき接頭辞がなければ最後の値は0
+        """
+        # 最後のトークンは必ずモデルに入力する必要があるため、接頭辞には含めない
+        hashes = self._block_hashes(token_ids, len(token_ids) - 1)
+        with self._lock:
+            self.lookups += 1
+            self.prefill_tokens_total += len(token_ids)
+
+            # 接頭辞の出現回数を数える
+            for _, h in hashes:
+                self._seen[h] = self._seen.get(h, 0) + 1
+                self._seen.move_to_end(h)
+            while len(self._seen) > self.max_tracked_prefixes:
+                self._seen.popitem(last=False)
+
+            match_len, match_cache = 0, None
+            for end, h in reversed(hashes):
+                entry = self._entries.get(h)
+                # ハッシュの衝突に備えてトークン列も比較する
+                if entry is not None and entry[0] == tuple(token_ids[:end]):
+                    self._entries.move_to_end(h)
+                    match_len, match_cache = end, entry[1]
+                    break
+
+            # 一致した接頭辞より長く、頻繁に現れる接頭辞があれば保存候補にする
+            store_len = 0
+            for end, h in reversed(hashes):
+                if end <= match_len:
+                    break
+                if self._seen.get(h, 0) >= self.min_occurrences and h not in self._entries:
+                    store_len = end
+                    break
+
+            if match_cache is not None:
+                self.hits += 1
+                self.prefill_tokens_saved += match_len
+                # generateがキャッシュを書き換えるため、コピーを返す
+                match_cache = copy.deepcopy(match_cache)
+            return match_len, match_cache, store_len
+
+    def store(self, prefix_ids, past_key_values):
+        """接頭辞のKVキャッシュを保存する（past_key_valuesはprefix_idsだけをプリフィルしたもの）"""
+        hashes = self._block_hashes(prefix_ids, len(prefix_ids))
+        if not hashes or hashes[-1][0] != len(prefix_ids):
+            return False  # ブロック境界でない接頭辞は保存しない
+        h = hashes[-1][1]
+        size = cache_nbytes(past_key_values)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if h in self._entries:
+                return False
+            self._entries[h] = (tuple(prefix_ids), copy.deepcopy(past_key_values), size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._seen.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """ヒット率と省略できたプリフィルのトークン数を返す"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+            "prefill_tokens_total": self.prefill_tokens_total,
+            "evictions": self.evictions,
+        }
+
+
+def generate_with_prefix_cache(pipe, input_ids, prefix_cache, max_new_tokens=512, do_sample=True,
+                               temperature=0.7, top_p=0.9, streamer=None, stopping_criteria=None,
+                               return_token_count=False):
+    """
+    接頭辞のKVキャッシュを使って1件のトークン列から生成する
+
+    Args:
+        pipe: transformersのtext-generationパイプライン（model と tokenizer を使用）
+        input_ids (list): プロンプトのトークンIDのリスト
+        prefix_cache (PrefixKVCache): 接頭辞キャッシュ
+        max_new_tokens, do_sample, temperature, top_p: 生成パラメータ
+        streamer (optional): 生成したトークンを逐次受け取るストリーマー
+        stopping_criteria (StoppingCriteriaList, optional): 生成を途中で止める条件
+        return_token_count (bool): 生成したトークン数も返すかどうか
+
+    Returns:
+        str: 新たに生成された部分だけをデコードしたテキスト（return_token_count=True の場合は (テキスト, トークン数)）
+    """
+    import torch
+
+    model = pipe.model
+    device = model.device
+
+    prefix_len, past_key_values, store_len = prefix_cache.lookup(input_ids)
+    if store_len:
+        # 頻繁に現れる接頭辞を（一致した接頭辞の続きから）先にプリフィルして保存し、そのまま生成に使う
+        with torch.no_grad():
+            prefix_tensor = torch.tensor([input_ids[prefix_len:store_len]], device=device)
+            outputs = model(prefix_tensor, past_key_values=past_key_values, use_cache=True)
+        prefix_cache.store(input_ids[:store_len], outputs.past_key_values)
+        prefix_len, past_key_values = store_len, outputs.past_key_values
+
+    # キャッシュ済みの接頭辞の分はプリフィルされず、残りのトークンだけが処理される
+    return generate_from_ids(pipe, input_ids, max_new_tokens, do_sample, temperature, top_p,
+                             past_key_values=past_key_values, streamer=streamer,
+                             stopping_criteria=stopping_criteria, return_token_count=return_token_count)
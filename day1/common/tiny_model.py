@@ -0,0 +1,76 @@
+# tiny_model.py
+# ベンチマークや動作確認用に、ダウンロードなしで小さなランダム初期化の言語モデルを作成するモジュールです
+# （生成されるテキストに意味はありません。速度やキャッシュの動作を確かめるためのものです）
+
+# トークナイザーの学習に使う短いコーパス（日本語の質問文を含める）
+_CORPUS = [
+    "こんにちは。AIについて教えてください。",
+    "大規模言語モデルの推論を高速化する方法を説明してください。",
+    "Please explain how large language models generate text.",
+    "The quick brown fox jumps over the lazy dog.",
+    "機械学習とは何ですか？ 簡単に答えてください。",
+]
+
+
+def build_tiny_tokenizer(vocab_size=512):
+    """コーパスからバイトレベルBPEのトークナイザーを学習して返す（どんな文字列もトークン化できる）"""
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(_CORPUS * 10, vocab_size=vocab_size, min_frequency=1,
+                                  special_tokens=["<|endoftext|>"])
+    special = "<|endoftext|>"
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token=special, bos_token=special, unk_token=special, pad_token=special)
+
+
+def build_tiny_model(n_layer=2, n_embd=64, n_head=4, max_positions=4096, seed=0):
+    """
+    小さなGPT-2形式のモデルとトークナイザーを作成する
+
+    Returns:
+        tuple: (model, tokenizer)
+    """
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    tokenizer = build_tiny_tokenizer()
+    torch.manual_seed(seed)
+    model_config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=max_positions,
+        n_embd=n_embd,
+        n_layer=n_layer,
+        n_head=n_head,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = GPT2LMHeadModel(model_config)
+    model.eval()
+    return model, tokenizer
+
+
+def save_tiny_model(path, **kwargs):
+    """小さなモデルをディレクトリに保存する（MODEL_NAME にこのパスを指定するとアプリで読み込める）"""
+    model, tokenizer = build_tiny_model(**kwargs)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    print(f"小さなモデルを保存しました: {path}")
+    return path
+
+
+def build_tiny_pipeline(**kwargs):
+    """小さなモデルのtext-generationパイプラインを作成する"""
+    from transformers import pipeline
+
+    model, tokenizer = build_tiny_model(**kwargs)
+    tokenizer.padding_side = "left"
+    return pipeline("text-generation", model=model, tokenizer=tokenizer, device="cpu")
+
+
+if __name__ == "__main__":
+    import sys
+
+    save_tiny_model(sys.argv[1] if len(sys.argv) > 1 else "tiny_model")